@@ -110,6 +110,31 @@ CHANNEL_LAYERS = {
     },
 }
 
+# relay the lobby groups once per process, fanning messages out to its sockets in memory,
+# instead of the channel layer sending every message to every lobby socket
+CONNECT4_LOBBY_RELAY = os.environ.get('CONNECT4_LOBBY_RELAY', '') == '1'
+
+# available games the seed worker keeps, creating games with computer players
+CONNECT4_SEEDED_GAMES = int(os.environ.get('CONNECT4_SEEDED_GAMES', '5'))
+
+# game player shards, each game player worker runs one of the channels game-player.0 up to game-player.<shards - 1>
+# on heroku scale the player dynos to the number of shards, the Procfile takes the shard from the dyno number
+CONNECT4_PLAYER_SHARDS = int(os.environ.get('CONNECT4_PLAYER_SHARDS', '1'))
+
+# computer player search
+# the transposition table is shared by every AI game in a process, set a file path to memory map it,
+# so every worker process on the box shares the same entries.  Size is in slots, of 16 bytes each
+CONNECT4_TRANSPOSITION_SIZE = 2 ** 20
+CONNECT4_TRANSPOSITION_PATH = os.environ.get('CONNECT4_TRANSPOSITION_PATH')
+# number of solved positions the endgame solver keeps, per process
+CONNECT4_SOLVER_CACHE_SIZE = 2 ** 18
+# number of Monte Carlo search trees kept between moves, per process, one for each game playing
+CONNECT4_MONTE_CARLO_TREES = 16
+# opening book, built with the build_book management command; the strategies search if it's missing
+CONNECT4_OPENING_BOOK = os.path.join(BASE_DIR, 'connect4', 'data', 'opening_book.bin')
+# game history for the learning strategy, trained with the train_learning management command
+CONNECT4_PATTERN_STATS = os.path.join(BASE_DIR, 'connect4', 'data', 'pattern_stats.bin')
+
 WSGI_APPLICATION = 'app.wsgi.application'
 ASGI_APPLICATION = "app.routing.application"
 
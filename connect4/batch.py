@@ -0,0 +1,81 @@
+''' One ply move choice for many positions at once, with numpy
+
+    Each position becomes a row of cells, indexed by engine bit index, with 1 for the player to move,
+    -1 for the opponent, and 0 for empty cells and sentinels.  The 69 winning lines are a fixed table
+    of bit indices, so counting coins in every line of every position is a few array operations.
+
+    A move is scored by where its coin lands:
+        a win, completing three of the player's coins in a line
+        a block, filling the last cell of three of the opponent's coins in a line
+        otherwise the number of the player's coins next to the cell
+    with random tie breaks.
+'''
+import numpy
+from . import engine
+
+BITS = engine.COLS * engine.H1
+
+
+def _bit_index(row, column):
+    return column * engine.H1 + row
+
+
+# bit indices of the four cells of each winning line
+LINES = numpy.array([
+    [_bit_index(row + step * row_step, col + step * col_step) for step in range(4)]
+    for (row_step, col_step) in ((1, 0), (0, 1), (1, 1), (-1, 1))
+    for row in range(engine.ROWS) for col in range(engine.COLS)
+    if 0 <= row + 3 * row_step < engine.ROWS and col + 3 * col_step < engine.COLS
+], dtype = numpy.intp)
+
+# LINE_CELLS[bit index, line] is 1 if the cell is in the line
+LINE_CELLS = numpy.zeros((BITS, len(LINES)), dtype = numpy.int16)
+LINE_CELLS[LINES, numpy.arange(len(LINES))[:, None]] = 1
+
+# NEIGHBOURS[bit index, bit index] is 1 for cells next to each other, diagonals included
+NEIGHBOURS = numpy.zeros((BITS, BITS), dtype = numpy.int16)
+for (row, col) in ((row, col) for row in range(engine.ROWS) for col in range(engine.COLS)):
+    for (row_step, col_step) in ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)):
+        if 0 <= row + row_step < engine.ROWS and 0 <= col + col_step < engine.COLS:
+            NEIGHBOURS[_bit_index(row, col), _bit_index(row + row_step, col + col_step)] = 1
+
+# True for the bit indices of board cells, False for the sentinels
+ON_BOARD = numpy.array([bit_index % engine.H1 != engine.ROWS for bit_index in range(BITS)])
+
+WIN_SCORE = 1000
+BLOCK_SCORE = 100
+
+_SHIFTS = numpy.arange(BITS, dtype = numpy.uint64)
+
+
+def cell_arrays(positions):
+    ''' returns the (positions, BITS) cell array, from the point of view of each player to move '''
+    me = numpy.array([position.boards[position.player] for position in positions], dtype = numpy.uint64)
+    them = numpy.array([position.boards[1 - position.player] for position in positions], dtype = numpy.uint64)
+    return (((me[:, None] >> _SHIFTS) & 1).astype(numpy.int8) -
+            ((them[:, None] >> _SHIFTS) & 1).astype(numpy.int8))
+
+
+def score_columns(positions, rng = numpy.random):
+    ''' returns the (positions, COLS) array of move scores, -inf for full columns '''
+    board = cell_arrays(positions)
+    landing = numpy.array([position.heights for position in positions], dtype = numpy.intp)
+    playable = ON_BOARD[landing]
+    line_cells = board[:, LINES]
+    mine = (line_cells == 1).sum(axis = 2)
+    theirs = (line_cells == -1).sum(axis = 2)
+    empty = board == 0
+    # empty cells completing a line of three, for either player
+    wins = (((mine == 3) & (theirs == 0)).astype(numpy.int16) @ LINE_CELLS.T > 0) & empty
+    blocks = (((theirs == 3) & (mine == 0)).astype(numpy.int16) @ LINE_CELLS.T > 0) & empty
+    adjacent = (board == 1).astype(numpy.int16) @ NEIGHBOURS
+    scores = (WIN_SCORE * wins + BLOCK_SCORE * blocks + adjacent).astype(numpy.float64)
+    scores = scores[numpy.arange(len(positions))[:, None], landing] + rng.random_sample(landing.shape)
+    scores[~playable] = -numpy.inf
+    return scores
+
+
+def choose_columns(positions, rng = numpy.random):
+    ''' returns the best column for each position, the positions must not be full '''
+    return score_columns(positions, rng).argmax(axis = 1).tolist()
+
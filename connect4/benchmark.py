@@ -0,0 +1,264 @@
+''' Micro benchmarks for the engine, the game model and the strategies
+
+    Each benchmark runs over a fixed corpus of positions and games, from a seeded random generator,
+    and measures operations per second, relative to a reference workload of plain Python measured in the same run,
+    so results from a faster or slower machine compare.  Baselines for each benchmark are kept in the repository,
+    and a run fails the check when a benchmark is slower than its baseline by more than the tolerance.
+
+    The relative speeds still shift a little between Python versions and machines, and with a busy machine,
+    so compare changes against baselines saved on the same, otherwise idle, machine when it matters.
+'''
+import json
+import os
+import random
+import time
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.template.loader import render_to_string
+from . import batch, engine, mcts, search
+from .models import Game
+from .snapshot import GameSnapshot
+from .transposition import TranspositionTable
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'data', 'benchmark_baselines.json')
+# fraction slower than the baseline that still passes
+TOLERANCE = 0.25
+# seconds each benchmark runs for, and the number of runs, the fastest run counts, to ride out noise
+DURATION = 0.25
+REPEATS = 3
+
+CORPUS_SEED = 2018
+CORPUS_POSITIONS = 200
+CORPUS_GAMES = 20
+
+# name: (function, needs the database), in the order they run
+BENCHMARKS = {}
+
+
+def benchmark(name, database = False):
+    ''' registers a benchmark function, called with the Corpus, returning operations per second '''
+    def register(function):
+        BENCHMARKS[name] = (function, database)
+        return function
+    return register
+
+
+class Corpus():
+    ''' the fixed positions and games the benchmarks run on
+        positions are part way through random games, games are the moves of whole random games
+    '''
+
+    def __init__(self, seed = CORPUS_SEED):
+        rng = random.Random(seed)
+        self.games = [self._random_game(rng) for _ in range(CORPUS_GAMES)]
+        self.positions = []
+        while len(self.positions) < CORPUS_POSITIONS:
+            moves = self._random_game(rng)
+            self.positions.append(engine.Position(moves[:rng.randrange(len(moves))]))
+        # saved Game models for the games, only set while the database benchmarks run
+        self.saved_games = None
+
+    @staticmethod
+    def _random_game(rng):
+        ''' returns the moves of a random game, played to the end '''
+        position = engine.Position()
+        while not position.is_full:
+            column = rng.choice(position.legal_moves())
+            position.play(column)
+            if position.is_winner(1 - position.player):
+                break
+        return position.history
+
+    def save_games(self):
+        ''' saves the games as Game models with their coins, for the database benchmarks '''
+        player1 = User.objects.create_user('benchmark1', first_name = 'Bench').userplayer
+        player2 = User.objects.create_user('benchmark2', first_name = 'Mark').userplayer
+        self.saved_games = []
+        for moves in self.games:
+            game = Game.objects.create(player1 = player1)
+            game.join_up(player2)
+            for (ply, column) in enumerate(moves):
+                game.make_move(player1 if ply % 2 == 0 else player2, column)
+            self.saved_games.append(game)
+
+
+def measure(function, operations, duration = DURATION):
+    ''' calls function until duration has passed, at least once, returns operations per second
+        operations is the number of operations in each call
+    '''
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while not calls or elapsed < duration:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls * operations / elapsed
+
+
+def reference():
+    ''' returns runs per second of the reference workload, integer and list work in plain Python,
+        like the engine's, that changes here don't make faster or slower
+    '''
+    values = list(range(1000))
+
+    def run():
+        total = 0
+        for value in values:
+            total += (value * 7) ^ (value >> 3)
+        sorted(values, key = lambda value : -value)
+    return measure(run, 1)
+
+
+@benchmark('move_generation')
+def move_generation(corpus):
+    def run():
+        for position in corpus.positions:
+            position.legal_moves()
+    return measure(run, len(corpus.positions))
+
+
+@benchmark('play_undo')
+def play_undo(corpus):
+    moves = sum(len(position.legal_moves()) for position in corpus.positions)
+
+    def run():
+        for position in corpus.positions:
+            for column in position.legal_moves():
+                position.play(column)
+                position.undo()
+    return measure(run, moves)
+
+
+@benchmark('win_detection')
+def win_detection(corpus):
+    moves = sum(len(position.legal_moves()) for position in corpus.positions)
+
+    def run():
+        for position in corpus.positions:
+            for column in position.legal_moves():
+                position.is_winning_move(column)
+    return measure(run, moves)
+
+
+@benchmark('replay_moves')
+def replay_moves(corpus):
+    strings = [''.join(str(column) for column in moves) for moves in corpus.games]
+
+    def run():
+        for moves in strings:
+            engine.Position(int(column) for column in moves)
+    return measure(run, len(strings))
+
+
+@benchmark('replay_coins', database = True)
+def replay_coins(corpus):
+    def run():
+        for game in corpus.saved_games:
+            engine.Position(coin.column for coin in game.coin_set.order_by('ply'))
+    return measure(run, len(corpus.saved_games))
+
+
+@benchmark('build_board', database = True)
+def build_board(corpus):
+    def run():
+        for game in corpus.saved_games:
+            game._build_board
+    return measure(run, len(corpus.saved_games))
+
+
+@benchmark('render_board', database = True)
+def render_board(corpus):
+    snapshots = [GameSnapshot(game) for game in corpus.saved_games]
+
+    def run():
+        for snapshot in snapshots:
+            render_to_string('connect4/board.html', {'game' : snapshot})
+    return measure(run, len(snapshots))
+
+
+@benchmark('smart_nodes')
+def smart_nodes(corpus):
+    ''' nodes per second of the alpha-beta search, from the empty board '''
+    searcher = search.Searcher(time_budget = DURATION, table = TranspositionTable(2 ** 16))
+    searcher.search(engine.Position())
+    return searcher.nodes_per_second
+
+
+@benchmark('solver_nodes')
+def solver_nodes(corpus):
+    ''' nodes per second of the endgame solver, on the late corpus positions '''
+    solver = search.Solver(time_budget = DURATION)
+    positions = [position for position in corpus.positions if engine.CELLS - position.ply <= 14]
+    (nodes, elapsed) = (0, 0.0)
+    for position in positions:
+        try:
+            solver.solve(position)
+        except search.SearchTimeout:
+            pass
+        (nodes, elapsed) = (nodes + solver.nodes, elapsed + solver.elapsed)
+        if elapsed >= DURATION:
+            break
+    return nodes / elapsed if elapsed else 0.0
+
+
+@benchmark('monte_carlo_playouts')
+def monte_carlo_playouts(corpus):
+    searcher = mcts.MonteCarloSearch(time_budget = DURATION)
+    searcher.search(engine.Position())
+    return searcher.nodes_per_second
+
+
+@benchmark('dumb_batch')
+def dumb_batch(corpus):
+    positions = [position for position in corpus.positions if position.legal_moves()]
+    return measure(lambda : batch.choose_columns(positions), len(positions))
+
+
+def run(names = None, database = True, progress = None):
+    ''' runs the benchmarks, all of them or the names, returns name: operations per reference run
+        The database benchmarks save games, in a transaction that's rolled back afterwards,
+        they are skipped if database is False. progress is an optional callable, given each name and result
+    '''
+    corpus = Corpus()
+    selected = [name for name in BENCHMARKS if names is None or name in names]
+    results = {}
+    with transaction.atomic():
+        if database and any(BENCHMARKS[name][1] for name in selected):
+            corpus.save_games()
+        for name in selected:
+            (function, needs_database) = BENCHMARKS[name]
+            if needs_database and not database:
+                continue
+            # the reference runs next to each benchmark, so a machine getting busier part way doesn't count
+            speed = max(reference() for _ in range(REPEATS))
+            results[name] = max(function(corpus) for _ in range(REPEATS)) / speed
+            if progress:
+                progress(name, results[name])
+        transaction.set_rollback(True)
+    return results
+
+
+def load_baselines(path = BASELINES):
+    ''' returns the saved baselines, name: operations per reference run, empty if there are none '''
+    try:
+        with open(path) as baselines_file:
+            return json.load(baselines_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(results, path = BASELINES):
+    ''' saves results as the baselines, keeping the baselines of benchmarks that weren't run '''
+    baselines = load_baselines(path)
+    baselines.update(results)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent = 4, sort_keys = True)
+        baselines_file.write('\n')
+
+
+def regressions(results, baselines, tolerance = TOLERANCE):
+    ''' returns a list of (name, result, baseline) for results slower than their baseline by more than tolerance '''
+    return [(name, result, baselines[name]) for (name, result) in results.items()
+            if name in baselines and result < baselines[name] * (1 - tolerance)]
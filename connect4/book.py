@@ -0,0 +1,77 @@
+''' Opening book for the searching strategies
+
+    The book is a record file, see records, of fixed size records sorted by canonical position key,
+    so looking up a move needs no search.
+
+    File layout, little endian:
+        header: magic b'C4BK', record count (uint32)
+        records: canonical key (uint64), best move (int8), score (int16)
+    Moves are stored for the canonical orientation of the position, and mirrored on lookup if needed.
+'''
+import struct
+from . import engine, records, search
+
+MAGIC = b'C4BK'
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<Qbh')
+
+
+class OpeningBook(records.RecordFile):
+    ''' read only opening book, memory mapped from a file '''
+
+    MAGIC = MAGIC
+    HEADER = HEADER
+    RECORD = RECORD
+    KIND = 'an opening book'
+
+    def lookup(self, position):
+        ''' returns (column, score) for the player to move in the position, or None if it's not in the book '''
+        (key, mirrored) = position.canonical_key
+        record = self.find(key)
+        if record is None:
+            return None
+        (_, move, score) = record
+        return (engine.COLS - 1 - move if mirrored else move, score)
+
+
+def build(plies, time_budget, table = None, progress = None):
+    ''' searches the book positions, returns a dictionary of canonical key: (move, score)
+
+        The book covers the positions up to plies moves, where the book player follows its own
+        best move and the opponent can play anything, for the book player moving first or second.
+        progress is an optional callable, given the number of positions searched so far
+    '''
+    entries = {}
+    seen = set()
+    # positions to expand, with True if the book player is to move
+    pending = [(engine.Position(), True), (engine.Position(), False)]
+    while pending:
+        (position, book_move) = pending.pop()
+        if position.ply >= plies:
+            continue
+        (key, mirrored) = position.canonical_key
+        if (key, book_move) in seen:
+            continue
+        seen.add((key, book_move))
+        if book_move:
+            if key not in entries:
+                (column, score) = search.Searcher(time_budget = time_budget, table = table).search(position)
+                entries[key] = (engine.COLS - 1 - column if mirrored else column, score)
+                if progress:
+                    progress(len(entries))
+            (column, score) = entries[key]
+            columns = [engine.COLS - 1 - column if mirrored else column]
+        else:
+            columns = position.legal_moves()
+        for column in columns:
+            if not position.is_winning_move(column):
+                child = position.copy()
+                child.play(column)
+                pending.append((child, not book_move))
+    return entries
+
+
+def write(path, entries):
+    ''' writes the book entries from build to a file, sorted by key '''
+    records.write(path, HEADER.pack(MAGIC, len(entries)), RECORD,
+                  ((key, move, score) for (key, (move, score)) in entries.items()))
@@ -1,19 +1,31 @@
 
 import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import datetime
 import json
 import logging
+import multiprocessing
+import os
 import random
 import sys
 import time
 import threading
 from asgiref.sync import async_to_sync, sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.conf import settings
 from django.utils import timezone
 from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.layers import get_channel_layer
-from .models import Game, ComputerPlayer, STRATEGIES
-from . import strategies
+from .models import Game, ComputerPlayer, GameLease, PlayerShard, describe_move
+from .snapshot import GameSnapshot
+from . import engine, lists, sharding, strategies
+from .relay import lobby_relay
+from .scheduler import JobScheduler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -21,11 +33,14 @@ logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
 class GamesConsumer(AsyncJsonWebsocketConsumer):
-    ''' Websocket from clients for games lists updates '''
+    ''' Websocket from clients for games lists updates
+
+        List changes go to the GamesListConsumer worker, which coalesces them and sends the list differences.
+    '''
 
     _CHANNEL_AVAILABLE = 'connect4.availablegames'
     _CHANNEL_RUNNING = 'connect4.runninggames'
-    _CHANNEL_USER = 'connect4.usergames.%s'
+    _CHANNEL_USER = 'connect4.usergames.%d'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -36,53 +51,73 @@ class GamesConsumer(AsyncJsonWebsocketConsumer):
         await super().connect()
         self.user = self.scope['user']
         logger.info('Games connection; %s; user %s' % (self.channel_name, self.user))
-        await self.channel_layer.group_add(self._CHANNEL_AVAILABLE, self.channel_name)
-        await self.channel_layer.group_add(self._CHANNEL_RUNNING, self.channel_name)
+        await self.group_join(self, self._CHANNEL_AVAILABLE)
+        await self.group_join(self, self._CHANNEL_RUNNING)
         if self.user.is_authenticated:
-            self.user_channel = self._CHANNEL_USER % self.user.get_short_name()
+            self.user_channel = self._CHANNEL_USER % self.user.pk
             await self.channel_layer.group_add(self.user_channel, self.channel_name)
 
+    @classmethod
+    async def group_join(cls, consumer, group):
+        ''' adds a lobby consumer to a group, the lobby groups go through the process's relay if it's on '''
+        relay = lobby_relay()
+        if relay and group in (cls._CHANNEL_AVAILABLE, cls._CHANNEL_RUNNING):
+            await relay.add(group, consumer)
+        else:
+            await consumer.channel_layer.group_add(group, consumer.channel_name)
+
+    @classmethod
+    async def group_leave(cls, consumer, group):
+        ''' removes a lobby consumer from a group, see group_join '''
+        relay = lobby_relay()
+        if relay and group in (cls._CHANNEL_AVAILABLE, cls._CHANNEL_RUNNING):
+            await relay.discard(group, consumer)
+        else:
+            await consumer.channel_layer.group_discard(group, consumer.channel_name)
+
     @classmethod
     def send_available_update(cls):
-        cls._send_update(cls._CHANNEL_AVAILABLE)
+        cls._send_update(cls._CHANNEL_AVAILABLE, lists.AVAILABLE)
 
     @classmethod
     def send_running_update(cls):
-        cls._send_update(cls._CHANNEL_RUNNING)
+        cls._send_update(cls._CHANNEL_RUNNING, lists.RUNNING)
 
     @classmethod
     def send_user_update(cls, player):
-        cls._send_update(cls._CHANNEL_USER % player.get_short_name())
+        # only users have a previous games list
+        if hasattr(player, 'user_id'):
+            cls._send_update(cls._CHANNEL_USER % player.user_id, lists.USER, player.user_id)
 
     @classmethod
     async def send_available_update_async(cls):
-        await cls._send_update_async(cls._CHANNEL_AVAILABLE)
+        await cls._send_update_async(cls._CHANNEL_AVAILABLE, lists.AVAILABLE)
 
     @classmethod
     async def send_running_update_async(cls):
-        await cls._send_update_async(cls._CHANNEL_RUNNING)
+        await cls._send_update_async(cls._CHANNEL_RUNNING, lists.RUNNING)
 
     @classmethod
     async def send_user_update_async(cls, player):
-        await cls._send_update_async(cls._CHANNEL_USER % player.get_short_name())
+        if hasattr(player, 'user_id'):
+            await cls._send_update_async(cls._CHANNEL_USER % player.user_id, lists.USER, player.user_id)
     
     @classmethod
-    def _send_update(cls, channel):
-        ''' sends a games list update to all clients '''
-        async_to_sync(cls._send_update_async)(channel)
+    def _send_update(cls, channel, list_id, user_id = None):
+        ''' tells the lists worker a games list changed '''
+        async_to_sync(cls._send_update_async)(channel, list_id, user_id)
 
     @classmethod
-    async def _send_update_async(cls, channel):
-        ''' sends a games list update to all clients '''
-        logger.info('Sending games update to channel %s' % channel)
-        if channel == cls._CHANNEL_AVAILABLE:
-            list = 'available_games'
-        elif channel == cls._CHANNEL_RUNNING:
-            list = 'running_games'
-        else:
-            list = 'user_games'
+    async def _send_update_async(cls, channel, list_id, user_id = None):
+        ''' tells the lists worker a games list changed '''
+        logger.info('Sending games list change for channel %s' % channel)
         channel_layer = get_channel_layer()
-        await channel_layer.group_send(channel, {'type' : 'games.update', 'list' : list })
+        await channel_layer.send(GamesListConsumer.CHANNEL, {
+            'type' : 'lists.changed',
+            'channel' : channel,
+            'list' : list_id,
+            'user' : user_id,
+        })
 
     async def games_update(self, data):
         logger.info('Games update recieved, sending: %s; %s' % (self.channel_name, data))
@@ -91,13 +126,83 @@ class GamesConsumer(AsyncJsonWebsocketConsumer):
     async def disconnect(self, close_code):
         ''' Remove consumer from group channels '''
         logger.info('Games disconnect; %s' % self.channel_name)
-        await self.channel_layer.group_discard(self._CHANNEL_AVAILABLE, self.channel_name)
-        await self.channel_layer.group_discard(self._CHANNEL_RUNNING, self.channel_name)
+        await self.group_leave(self, self._CHANNEL_AVAILABLE)
+        await self.group_leave(self, self._CHANNEL_RUNNING)
         if self.user_channel:
             await self.channel_layer.group_discard(self.user_channel, self.channel_name)
         await super().disconnect(close_code)
 
 
+class GamesListConsumer(AsyncConsumer):
+    ''' This worker consumer sends the games lists differences to the lobby
+
+        Changes to a list are coalesced for DEBOUNCE seconds from the first one, then the list is queried once,
+        and the games added, removed and updated since the last update go to everyone watching it.
+        Updates are numbered per list, so a client that misses one fetches the whole list instead.
+    '''
+
+    CHANNEL = 'games-lists'
+    DEBOUNCE = 0.5
+    # previous user games lists kept to compare against, the oldest are dropped
+    USER_LISTS = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # channel: (list id, user id) of the lists waiting to be sent
+        self._pending = {}
+        # channel: (version, summaries) of the last update sent
+        self._sent = OrderedDict()
+
+    async def lists_changed(self, data):
+        ''' a list changed, send its update after the debounce window '''
+        if not self._pending:
+            self._schedule_updates()
+        self._pending[data['channel']] = (data['list'], data['user'])
+
+    def _schedule_updates(self):
+        asyncio.get_event_loop().call_later(self.DEBOUNCE, lambda : asyncio.ensure_future(self._send_updates()))
+
+    async def _send_updates(self):
+        ''' queries each changed list once, and sends the differences
+            A list that fails is logged and tried again after the debounce window, with any new changes
+        '''
+        (pending, self._pending) = (self._pending, {})
+        for (channel, (list_id, user_id)) in pending.items():
+            try:
+                await self._send_update(channel, list_id, user_id)
+            except Exception:
+                logger.exception('Games list update for channel %s failed, trying again' % channel)
+                if not self._pending:
+                    self._schedule_updates()
+                self._pending.setdefault(channel, (list_id, user_id))
+
+    async def _send_update(self, channel, list_id, user_id):
+        ''' queries the list, and sends the differences from the last update sent, if there are any '''
+        summaries = await database_sync_to_async(lists.summaries)(list_id, user_id)
+        (version, previous) = self._sent.get(channel, (0, None))
+        (added, removed, updated) = lists.diff(previous or {}, summaries)
+        if previous is not None and not (added or removed or updated) and list(previous) == list(summaries):
+            self._sent.move_to_end(channel)
+            return
+        version += 1
+        logger.info('Sending games update %d to channel %s; %d added, %d removed, %d updated' % (
+            version, channel, len(added), len(removed), len(updated)))
+        await self.channel_layer.group_send(channel, {
+            'type' : 'games.update',
+            'list' : list_id,
+            'version' : version,
+            'added' : added,
+            'removed' : removed,
+            'updated' : updated,
+            'order' : list(summaries),
+        })
+        # only counted once it's sent, so after a failure the next update differs from the last one clients got
+        self._sent.pop(channel, None)
+        self._sent[channel] = (version, summaries)
+        while len(self._sent) > self.USER_LISTS:
+            self._sent.popitem(last = False)
+
+
 class PlayConsumer(AsyncJsonWebsocketConsumer):
     ''' websockets from client for playing a game and getting game moves '''
 
@@ -123,21 +228,119 @@ class PlayConsumer(AsyncJsonWebsocketConsumer):
     @classmethod
     def send_play_update(cls, game):
         ''' sends a game play update to clients '''
-        async_to_sync(cls.send_play_update_async)(game)
+        async_to_sync(cls._send_play_message)(game.id, cls.play_message(game))
 
     @classmethod
     async def send_play_update_async(cls, game):
-        ''' sends a game play update to clients '''
+        ''' sends a game play update to clients, with the last move, see play_message '''
+        message = await database_sync_to_async(cls.play_message)(game)
+        await cls._send_play_message(game.id, message)
+
+    @classmethod
+    async def _send_play_message(cls, game_id, message):
         channel_layer = get_channel_layer()
-        channel = cls._CHANNEL_PLAY % game.id
+        channel = cls._CHANNEL_PLAY % game_id
         logger.info('Sending async player update to channel %s' % channel)
-        await channel_layer.group_send(channel, { 'type' : 'play.update', 'game' : game.id })
+        await channel_layer.group_send(channel, message)
+
+    @staticmethod
+    def play_message(game):
+        ''' the play update for the game as it is now, so clients can add the last move in place
+            ply is the board version, clients that missed a ply reload the board instead
+            move is the last coin played, or None when nothing was played, like a join
+        '''
+        snapshot = GameSnapshot(game)
+        message = {
+            'type' : 'play.update',
+            'game' : game.id,
+            'ply' : game.ply,
+            'status' : game.status,
+            'next_player' : game.next_player if snapshot.next_move else None,
+            'next_move' : snapshot.next_move.get_short_name() if snapshot.next_move else None,
+            'move' : None,
+            'winners' : [],
+        }
+        if game.ply:
+            position = snapshot.position
+            (row, column) = position.last_move
+            player = 2 - game.ply % 2
+            name = snapshot.player1_name if player == 1 else snapshot.player2_name
+            winners = position.winning_cells(row, column) if game.winner else []
+            message['move'] = {
+                'column' : column,
+                'row' : row,
+                'player' : player,
+                'name' : name,
+                'color' : snapshot.player1_color_web if player == 1 else snapshot.player2_color_web,
+                'description' : describe_move(name, column, row, bool(winners), snapshot.is_draw),
+            }
+            message['winners'] = winners
+        return message
 
     async def play_update(self, data):
         ''' play update recieved, relay to clients '''
         logger.info('Games update received, sending: %s; %s' % (self.channel_name, data))
         await self.send_json(data)
 
+    async def receive_json(self, content):
+        ''' commands from the client, on the socket they're already logged in with, see play_command '''
+        game_id = int(self.scope['url_route']['kwargs']['pk']) if self.play_channel else None
+        await self.play_command(self, game_id, content)
+
+    @classmethod
+    async def play_command(cls, consumer, game_id, content):
+        ''' runs a play command from the consumer's client on the game
+            {'action' : 'move', 'column' : column, 'ply' : ply the client saw} or {'action' : 'join'}
+            Each command is answered with a play.ack, with ok and the game's ply, and the id from the command if any
+        '''
+        if not isinstance(content, dict):
+            # a frame that isn't a JSON object is an invalid command
+            content = {'frame' : content}
+        action = content.get('action')
+        user = consumer.scope['user']
+        ack = {'type' : 'play.ack', 'action' : action, 'id' : content.get('id'), 'game' : game_id,
+               'ok' : False, 'ply' : None}
+        if game_id is None or not user.is_authenticated or action not in ('move', 'join'):
+            logger.warning('Invalid play command %s from %s on %s' % (content, user, consumer.channel_name))
+            await consumer.send_json(ack)
+            return
+        try:
+            if action == 'move':
+                column = int(content['column'])
+                ply = int(content['ply']) if content.get('ply') is not None else None
+                (ok, game, message) = await database_sync_to_async(cls._make_move)(game_id, user, column, ply)
+            else:
+                (ok, game, message) = await database_sync_to_async(cls._join_game)(game_id, user)
+        except (KeyError, TypeError, ValueError, Game.DoesNotExist):
+            logger.warning('Invalid play command %s from %s on %s' % (content, user, consumer.channel_name))
+            await consumer.send_json(ack)
+            return
+        ack.update(ok = ok, ply = game.ply)
+        await consumer.send_json(ack)
+        if ok:
+            await cls._send_play_message(game.id, message)
+            if action == 'join':
+                await GamesConsumer.send_available_update_async()
+                await GamesConsumer.send_running_update_async()
+            elif game.status == Game.Status.FINISHED.value:
+                await GamesConsumer.send_running_update_async()
+                await GamesConsumer.send_user_update_async(game.player1)
+                await GamesConsumer.send_user_update_async(game.player2)
+
+    @classmethod
+    def _make_move(cls, game_id, user, column, ply):
+        ''' makes the move for the user, returns (ok, game, play update message or None) '''
+        game = Game.objects.get(pk = game_id)
+        ok = game.make_move(user.userplayer, column, ply)
+        return (ok, game, cls.play_message(game) if ok else None)
+
+    @classmethod
+    def _join_game(cls, game_id, user):
+        ''' joins the user to the game, returns (ok, game, play update message or None) '''
+        game = Game.objects.get(pk = game_id)
+        ok = game.join_up(user.userplayer)
+        return (ok, game, cls.play_message(game) if ok else None)
+
     async def disconnect(self, close_code):        
         if self.play_channel:
             logger.info('Play Command disconnecting from channel %s for %s' % (self.play_channel, self.channel_name))
@@ -145,10 +348,106 @@ class PlayConsumer(AsyncJsonWebsocketConsumer):
         await super().disconnect(close_code)
 
 
+class StreamConsumer(AsyncJsonWebsocketConsumer):
+    ''' One websocket per client, for the lobby lists and any number of games
+
+        Clients subscribe and unsubscribe to streams, and get the same updates the lobby and play sockets get,
+        {'action' : 'subscribe' or 'unsubscribe', 'stream' : 'lists'} for the lobby lists,
+        or {..., 'stream' : 'game', 'game' : pk} for a game's play updates, answered with a stream.ack.
+        Play commands name their game, {'action' : 'move' or 'join', 'game' : pk, ...}, see PlayConsumer.play_command
+    '''
+
+    # games one connection can watch at once
+    MAX_GAMES = 20
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # groups this connection is in, and the games it watches
+        self._subscribed = set()
+        self._games = set()
+
+    async def connect(self):
+        await super().connect()
+        self.user = self.scope['user']
+        logger.info('Stream connection; %s; user %s' % (self.channel_name, self.user))
+
+    def _stream_groups(self, content):
+        ''' returns (group names, game id or None) for a subscribe or unsubscribe, raises ValueError if invalid '''
+        stream = content.get('stream')
+        if stream == 'lists':
+            groups = [GamesConsumer._CHANNEL_AVAILABLE, GamesConsumer._CHANNEL_RUNNING]
+            if self.user.is_authenticated:
+                groups.append(GamesConsumer._CHANNEL_USER % self.user.pk)
+            return (groups, None)
+        elif stream == 'game':
+            game_id = int(content['game'])
+            return ([PlayConsumer._CHANNEL_PLAY % game_id], game_id)
+        raise ValueError('Unknown stream %s' % stream)
+
+    async def receive_json(self, content):
+        if not isinstance(content, dict):
+            # a frame that isn't a JSON object is an invalid command
+            content = {'frame' : content}
+        action = content.get('action')
+        if action in ('move', 'join'):
+            try:
+                game_id = int(content['game'])
+            except (KeyError, TypeError, ValueError):
+                game_id = None
+            await PlayConsumer.play_command(self, game_id, content)
+            return
+        ack = {'type' : 'stream.ack', 'action' : action, 'stream' : content.get('stream'),
+               'game' : content.get('game'), 'id' : content.get('id'), 'ok' : False}
+        try:
+            if action not in ('subscribe', 'unsubscribe'):
+                raise ValueError('Unknown action %s' % action)
+            (groups, game_id) = self._stream_groups(content)
+        except (KeyError, TypeError, ValueError):
+            logger.warning('Invalid stream command %s from %s on %s' % (content, self.user, self.channel_name))
+            await self.send_json(ack)
+            return
+        if action == 'subscribe':
+            if game_id is not None and game_id not in self._games and len(self._games) >= self.MAX_GAMES:
+                logger.warning('Too many games on %s' % self.channel_name)
+                await self.send_json(ack)
+                return
+            for group in groups:
+                if group not in self._subscribed:
+                    self._subscribed.add(group)
+                    await GamesConsumer.group_join(self, group)
+            if game_id is not None:
+                self._games.add(game_id)
+        else:
+            for group in groups:
+                if group in self._subscribed:
+                    self._subscribed.discard(group)
+                    await GamesConsumer.group_leave(self, group)
+            self._games.discard(game_id)
+        ack['ok'] = True
+        await self.send_json(ack)
+
+    async def games_update(self, data):
+        await self.send_json(data)
+
+    async def play_update(self, data):
+        await self.send_json(data)
+
+    async def disconnect(self, close_code):
+        logger.info('Stream disconnect; %s' % self.channel_name)
+        for group in self._subscribed:
+            await GamesConsumer.group_leave(self, group)
+        self._subscribed.clear()
+        self._games.clear()
+        await super().disconnect(close_code)
+
+
 class GameSeedConsumer(AsyncConsumer):
-    ''' This worker consumer creates games with computer players, and joins unstarted games '''
+    ''' This worker consumer creates games with computer players, and joins unstarted games
+
+        Seeding and joining are jobs in a scheduler, one per game at most, and the database work runs in threads.
+        Available games come from the available games list updates, only a missed update queries them all again.
+    '''
     
-    SEEDED_GAMES = 5
     SEED_WAIT_MIN = 10
     SEED_WAIT_MAX = SEED_WAIT_MIN * 5
     JOIN_WAIT_MIN = 60
@@ -157,7 +456,9 @@ class GameSeedConsumer(AsyncConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._added = False
-        self._join_games_schedule = set()
+        self._scheduler = None
+        # version of the last available games list update, None to query the games
+        self._list_version = None
 
     @classmethod
     def register(cls):
@@ -176,132 +477,467 @@ class GameSeedConsumer(AsyncConsumer):
         logger.info('Seed register games received')
         if not self._added:
             self._added = True
+            self._scheduler = JobScheduler(self._run_job)
             logger.info('Registering for group; %s' % self.channel_name)
             await self.channel_layer.group_add(GamesConsumer._CHANNEL_AVAILABLE, self.channel_name)
+            await GamePlayerConsumer.start_shards_async()
             await self._check_for_updates()
 
     async def games_update(self, data):
-        ''' get a games update '''
-        logger.info('Seed Games update; %s' % (self.channel_name))
-        await self._check_for_updates()
+        ''' get a games update, the available games list differences '''
+        logger.info('Seed Games update %s; %s' % (data.get('version'), self.channel_name))
+        if self._scheduler is None:
+            return
+        version = data.get('version')
+        if self._list_version is None or version != self._list_version + 1:
+            self._list_version = version
+            await self._check_for_updates()
+            return
+        self._list_version = version
+        for game_id in data['removed']:
+            self._scheduler.cancel(('join', game_id))
+        for game in data['added']:
+            self._schedule_join(game['id'])
+        self._schedule_seed()
 
     async def _check_for_updates(self):
-        ''' schedules checks for new data '''
-        self._seed_games_delayed()
-        self._join_games_delayed()
+        ''' schedules seeding, and joining every available game '''
+        self._schedule_seed()
+        for game_id in await database_sync_to_async(self._available_games)():
+            self._schedule_join(game_id)
 
-    def _seed_games_delayed(self):
-        ''' helper to schedule delayed seeding '''
-        loop = asyncio.get_event_loop()
+    @staticmethod
+    def _available_games():
+        return list(Game.objects.filter(status = Game.Status.AVAILABLE.value).values_list('id', flat = True))
+
+    def _schedule_seed(self):
         wait = random.randint(self.SEED_WAIT_MIN, self.SEED_WAIT_MAX)
-        logger.info('Sleeping %d to seed games' % wait)
-        loop.call_later(wait, lambda : asyncio.ensure_future(self._seed_games()))
+        if self._scheduler.schedule(('seed',), wait):
+            logger.info('Waiting %d to seed games' % wait)
+
+    def _schedule_join(self, game_id):
+        wait = random.randint(self.JOIN_WAIT_MIN, self.JOIN_WAIT_MAX)
+        if self._scheduler.schedule(('join', game_id), wait):
+            logger.info('Waiting %d to join game %s' % (wait, game_id))
+
+    async def _run_job(self, job):
+        if job[0] == 'seed':
+            await self._seed_games()
+        else:
+            await self._join_game(job[1])
 
     async def _seed_games(self):
-        ''' adds games with computer players '''
+        ''' adds a game with a computer player, and seeds again later until there are enough '''
         logger.info('Seeding games')
-        num_games = Game.objects.filter(status = Game.Status.AVAILABLE.value).count()
-        if num_games < self.SEEDED_GAMES:
-            logger.info('Adding new seeded game')
-            player = random.choice(ComputerPlayer.objects.all())
-            game = Game(player1 = player)
-            game.save()
+        (game, more) = await database_sync_to_async(self._seed_game)()
+        if game:
+            logger.info('Added new seeded game %s' % game.id)
             await GamePlayerConsumer.send_play_game_async(game)
             await GamesConsumer.send_available_update_async()
-            if num_games + 1 < self.SEEDED_GAMES:
-                self._seed_games_delayed()
+        if more:
+            self._schedule_seed()
+
+    @staticmethod
+    def _seed_game():
+        ''' creates a game for a random computer player if there are fewer available than the target,
+            returns (the game or None, True if more are needed)
+        '''
+        num_games = Game.objects.filter(status = Game.Status.AVAILABLE.value).count()
+        if num_games >= settings.CONNECT4_SEEDED_GAMES:
+            return (None, False)
+        player = ComputerPlayer.objects.order_by('?').first()
+        if player is None:
+            return (None, False)
+        game = Game.objects.create(player1 = player)
+        return (game, num_games + 1 < settings.CONNECT4_SEEDED_GAMES)
 
-    def _join_games_delayed(self):
-        ''' Schedule joining delay for waiting games '''
-        logger.info('Checking for games to join')
-        games = Game.objects.filter(status = Game.Status.AVAILABLE.value)
-        loop = asyncio.get_event_loop()
-        for game in games:
-            if game.id not in self._join_games_schedule:
-                wait = random.randint(self.JOIN_WAIT_MIN, self.JOIN_WAIT_MAX)
-                logger.info('Waiting %d to join game %s' % (wait, game.id))
-                loop.call_later(wait, lambda : asyncio.ensure_future(self._join_game(game.id)))
-                self._join_games_schedule.add(game.id)
-        
     async def _join_game(self, game_id):
-        ''' Get any available games '''
+        ''' joins the game with a computer player, if it's still available '''
         logger.info('Checking to join game %s' % game_id)
-        game = Game.objects.get(pk = game_id)
-        if game.status == Game.Status.AVAILABLE.value:
-            logger.info('Joining game %s' % game)
-            player = game.player1
-            while player == game.player1:            
-                player = random.choice(ComputerPlayer.objects.all())
-            logger.info('Joining game %s; chose player %s' % (game, player))
-            if game.join_up(player):
-                logger.info('Joined game %s; player %s' % (game, player))
-                await GamePlayerConsumer.send_play_game_async(game)
-                await GamesConsumer.send_available_update_async()
-                await GamesConsumer.send_running_update_async()
-                await PlayConsumer.send_play_update_async(game)
+        (game, joined) = await database_sync_to_async(self._join_up)(game_id)
+        if game:
+            logger.info(joined)
+            await GamePlayerConsumer.send_play_game_async(game)
+            await GamesConsumer.send_available_update_async()
+            await GamesConsumer.send_running_update_async()
+            await PlayConsumer.send_play_update_async(game)
+
+    @staticmethod
+    def _join_up(game_id):
+        ''' joins the available game with a random other computer player,
+            returns (the game if it joined or None, the text to log), the text is built here as it queries the players
+        '''
+        game = Game.objects.filter(pk = game_id, status = Game.Status.AVAILABLE.value).first()
+        if game is None:
+            return (None, None)
+        player = ComputerPlayer.objects.exclude(pk = game.player1_id).order_by('?').first()
+        if player and game.join_up(player):
+            return (game, 'Joined game %s; player %s' % (game, player))
+        return (None, None)
 
 
 class GamePlayerConsumer(AsyncConsumer):
-    ''' This consumer plays a game as a computer player '''
-
+    ''' This consumer plays a game as a computer player
+
+        Thinking runs in think processes, so a slow search doesn't stall the other games and messages.
+        Each process is a lane, and a game always thinks in the same lane, see lane, so its searches
+        reuse the transposition table, solver cache and Monte Carlo trees in that process.
+        A lane's moves wait in a queue ordered by when they are due, and the database work runs in threads.
+        Strategies that ponder search the opponent's replies in the game's lane after each move, when it has
+        no moves to think about, so when the reply comes in, the answer is usually ready without thinking again.
+
+        Games are partitioned across shard channels, one per worker, see sharding.  A shard leases its games
+        in the database and renews the leases with its heartbeat.  Games whose lease expired, because
+        their shard stopped, are taken by their live shard on the ring, which plays on from the database,
+        and the first live shard wakes the configured shards that aren't live, every WAKE seconds at most.
+    '''
+
+    # delay between moves when both players are computers, so people can watch
     MOVE_DELAY = 5
+    # processes thinking for computer players, shared by every game in this worker
+    THINK_PROCESSES = os.cpu_count() or 1
+    # lane queue priorities, moves to play before pondering
+    THINK = 0
+    PONDER = 1
+    # seconds to collect moves for batched strategies, before choosing them all at once
+    BATCH_INTERVAL = 0.05
+    # seconds a shard holds its games without renewing, and between renewals
+    LEASE = 30
+    HEARTBEAT = 10
+    # seconds between waking a shard that isn't live
+    WAKE = 60
+
+    _lanes = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # game players is a dictionary of (game, player) = strategy
         self._game_players = {}
+        # lane: queue of work for the lane, (priority, due time, sequence, game id, player, strategy, moves)
+        self._lane_queues = {}
+        # game id = moves string being pondered, and game id = {moves after a reply: column} pondered
+        self._pondering = {}
+        self._pondered = {}
+        # lane = game id pondering in the lane's process now
+        self._lane_ponders = {}
+        # game id = ply of moves already queued, so repeated updates don't queue a move twice
+        self._queued_moves = {}
+        self._sequence = 0
+        # moves for batched strategies waiting for the next batch, (game id, player, strategy, moves, delay)
+        self._batched_moves = []
+        self._heartbeat = None
+        # shard channel = loop time it was last woken
+        self._woken = {}
+
+    @property
+    def shard(self):
+        ''' the shard channel this consumer plays for '''
+        return self.scope['channel']
+
+    @classmethod
+    def lanes(cls):
+        ''' returns the think lanes, [(process pool of one process, stop event)], started on first use
+            Setting a lane's stop event stops its pondering.  The event can't be sent with the work,
+            so the process inherits it from strategies when it forks, all the lanes fork here at once,
+            with the fork start method whatever the platform's default is.
+        '''
+        if cls._lanes is None:
+            lanes = []
+            context = multiprocessing.get_context('fork')
+            try:
+                for _ in range(cls.THINK_PROCESSES):
+                    stop = context.Event()
+                    strategies.set_stop_event(stop)
+                    executor = ProcessPoolExecutor(max_workers = 1, mp_context = context)
+                    # the process starts with its first work
+                    executor.submit(int).result()
+                    lanes.append((executor, stop))
+            finally:
+                strategies.set_stop_event(None)
+            cls._lanes = lanes
+        return cls._lanes
+
+    @classmethod
+    def lane(cls, game_id):
+        ''' returns the game's lane number '''
+        return hash(game_id) % cls.THINK_PROCESSES
 
     @classmethod
     async def send_play_game_async(cls, game):
-        ''' tells consumer to start running '''
-        logger.info('Game player sending playing to register computer player')
+        ''' tells the game's shard to play its computer players '''
+        since = timezone.now() - datetime.timedelta(seconds = cls.LEASE)
+        channel = await database_sync_to_async(sharding.owner)(game.id, since)
+        logger.info('Game player sending game %s to %s' % (game.id, channel))
         channel_layer = get_channel_layer()
         await channel_layer.send(
-            "game-player",
+            channel,
             {
                 "type" : "play.game",
                 "game" : game.id,                
             }
         )
 
+    @classmethod
+    async def start_shards_async(cls):
+        ''' wakes every shard, so they start their heartbeats and take over orphaned games '''
+        channel_layer = get_channel_layer()
+        for channel in sharding.shard_channels():
+            try:
+                await channel_layer.send(channel, {"type" : "player.start"})
+            except ChannelFull:
+                logger.warning('Shard %s is full, not running?' % channel)
+
+    async def player_start(self, data):
+        self._start_heartbeat()
+
     async def play_game(self, data):
-        ''' Handles a new game to play, registers AI players to play the game '''
-        logger.info('Game player got message to play game %s' % data)
+        ''' Handles a new game to play, registers AI players to play the game
+            Also takes over orphaned games, the game may be part way through, so it plays on if it's the AI's move
+        '''
+        logger.info('Game player %s got message to play game %s' % (self.shard, data))
+        self._start_heartbeat()
         game_id = data['game']
-        game = Game.objects.get(pk = game_id)
-        for player in (game.player1, game.player2):
-            if isinstance(player, ComputerPlayer):
-                strategy_class = '%sStrategy' % STRATEGIES[player.strategy]
-                strategy_class = getattr(strategies, strategy_class)
-                strategy = strategy_class(game, player)
-                strategy.start()
-                self._game_players[game.id, player.id] = strategy
-        play_channel = PlayConsumer._CHANNEL_PLAY % game.id
-        await self.channel_layer.group_add(play_channel, self.channel_name)
+        if not await database_sync_to_async(self._claim)(game_id):
+            logger.info('Game %s is leased to another shard' % game_id)
+            return
+        if await database_sync_to_async(self._add_strategies)(game_id):
+            play_channel = PlayConsumer._CHANNEL_PLAY % game_id
+            await self.channel_layer.group_add(play_channel, self.channel_name)
+            await self.play_update({'game' : game_id})
+        else:
+            await database_sync_to_async(self._release)(game_id)
+
+    def _add_strategies(self, game_id):
+        ''' creates and starts the strategies for the computer players in the game, returns True if it has any '''
+        snapshot = GameSnapshot.load(game_id)
+        for player in (snapshot.player1, snapshot.player2):
+            if isinstance(player, ComputerPlayer) and (game_id, player.id) not in self._game_players:
+                strategy = strategies.strategy_class(player.strategy)(snapshot.game, player)
+                self._game_players[game_id, player.id] = strategy
+        return any(key[0] == game_id for key in self._game_players)
+
+    def _claim(self, game_id):
+        ''' takes the game's lease, unless another live shard has it, returns True if it's this shard's '''
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds = self.LEASE)
+        leases = GameLease.objects.filter(Q(game_id = game_id) & (Q(shard = self.shard) | Q(expires__lt = now)))
+        if leases.update(shard = self.shard, expires = expires):
+            return True
+        try:
+            with transaction.atomic():
+                GameLease.objects.create(game_id = game_id, shard = self.shard, expires = expires)
+        except IntegrityError:
+            return False
+        return True
+
+    def _release(self, game_id):
+        GameLease.objects.filter(game_id = game_id, shard = self.shard).delete()
+
+    async def _drop_game(self, game_id):
+        ''' stops playing the game, when it's over or the lease went to another shard, and stops its pondering '''
+        self._queued_moves.pop(game_id, None)
+        self._pondering.pop(game_id, None)
+        self._pondered.pop(game_id, None)
+        lane = self.lane(game_id)
+        if self._lane_ponders.get(lane) == game_id:
+            self.lanes()[lane][1].set()
+        for key in [key for key in self._game_players if key[0] == game_id]:
+            strategy = self._game_players.pop(key)
+            logger.info('Removing %s from game %s' % (strategy, game_id))
+        await self.channel_layer.group_discard(PlayConsumer._CHANNEL_PLAY % game_id, self.channel_name)
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        ''' renews the leases, drops games that aren't this shard's anymore, takes its orphaned games,
+            and wakes the shards that aren't live
+        '''
+        loop = asyncio.get_event_loop()
+        while True:
+            games = {game_id for (game_id, _) in self._game_players}
+            try:
+                (lost, orphans, asleep) = await database_sync_to_async(self._renew)(games)
+            except Exception:
+                logger.exception('Shard %s heartbeat failed' % self.shard)
+            else:
+                for game_id in lost:
+                    logger.info('Shard %s lost game %s' % (self.shard, game_id))
+                    await self._drop_game(game_id)
+                for game_id in orphans:
+                    logger.info('Shard %s taking orphaned game %s' % (self.shard, game_id))
+                    try:
+                        await self.play_game({'game' : game_id})
+                    except Exception:
+                        logger.exception('Shard %s failed to take game %s' % (self.shard, game_id))
+                for channel in asleep:
+                    if loop.time() - self._woken.get(channel, -self.WAKE) < self.WAKE:
+                        continue
+                    self._woken[channel] = loop.time()
+                    try:
+                        await self.channel_layer.send(channel, {'type' : 'player.start'})
+                    except ChannelFull:
+                        logger.warning('Shard %s is full, not running?' % channel)
+            await asyncio.sleep(self.HEARTBEAT)
+
+    def _renew(self, games):
+        ''' records the heartbeat and renews the leases of the games, in the database
+            returns (games this shard lost, orphaned games this shard owns on the ring,
+                     configured shards that aren't live, if this is the first live shard, so only it wakes them)
+        '''
+        now = timezone.now()
+        PlayerShard.objects.update_or_create(channel = self.shard, defaults = {'heartbeat' : now})
+        playing = (Game.Status.AVAILABLE.value, Game.Status.RUNNING.value)
+        GameLease.objects.filter(shard = self.shard).exclude(game__status__in = playing).delete()
+        leases = GameLease.objects.filter(shard = self.shard, game_id__in = games)
+        leases.update(expires = now + datetime.timedelta(seconds = self.LEASE))
+        lost = games - set(leases.values_list('game_id', flat = True))
+
+        live = sharding.live_shards(now - datetime.timedelta(seconds = self.LEASE))
+        ring = sharding.HashRing(live)
+        orphans = Game.objects.filter(status__in = playing).filter(
+            Q(player1__computerplayer__isnull = False) | Q(player2__computerplayer__isnull = False)).filter(
+            Q(gamelease__isnull = True) | Q(gamelease__expires__lt = now)).values_list('id', flat = True)
+        asleep = set(sharding.shard_channels()) - set(live) if live[0] == self.shard else set()
+        return (lost, [game_id for game_id in orphans if ring.shard(game_id) == self.shard], asleep)
 
     async def play_update(self, data):
         ''' play update recieved, relay to clients '''
         logger.info('Game player play update received, playing strategies: %s' % (data))
         game_id = data['game']
-        game = Game.objects.get(pk = game_id)
+        snapshot = await database_sync_to_async(GameSnapshot.load)(game_id)
+        game = snapshot.game
         if game.status == Game.Status.RUNNING.value:
-            player = game.next_move
+            player = snapshot.next_move
             strategy = self._game_players.get((game_id, player.id))
-            if strategy:
-                async def move_delayed():
-                    logger.info('Making move for %s in game %s; %s' % (player, game_id, game))
-                    strategy.reload_game()
-                    strategy.make_move()
-                    await PlayConsumer.send_play_update_async(game)
-
-                logger.info('Queuing move for %s in game %s; %s' % (player, game_id, game))
-                loop = asyncio.get_event_loop()
-                loop.call_later(self.MOVE_DELAY, lambda : asyncio.ensure_future(move_delayed()))
+            if strategy and self._queued_moves.get(game_id) != game.ply:
+                delay = self._move_delay(snapshot)
+                # a pondering lane drops the answers for the other replies
+                self._pondering.pop(game_id, None)
+                column = self._pondered.pop(game_id, {}).get(game.moves)
+                if column is not None:
+                    logger.info('Pondered move for %s in game %s, ply %d' % (strategy, game_id, game.ply))
+                    self._queued_moves[game_id] = game.ply
+                    asyncio.get_event_loop().call_later(delay,
+                        lambda : asyncio.ensure_future(self._play_move(game_id, player, column, game.ply)))
+                elif strategy.BATCHED:
+                    logger.info('Batching move for %s in game %s, ply %d' % (strategy, game_id, game.ply))
+                    self._batch_move(game_id, player, strategy, game.moves, delay)
+                else:
+                    logger.info('Queuing move for %s in game %s, ply %d' % (strategy, game_id, game.ply))
+                    self._queue_move(game_id, player, strategy, game.moves, delay)
         elif game.status in (Game.Status.FINISHED.value, Game.Status.ABANDONED.value):
-            for player in (game.player1, game.player2):
-                if player:
-                    strategy = self._game_players.get((game_id, player.id))
-                    if strategy:
-                        strategy.stop()
-                        logger.info('Game over, removing %s from game %s; %s' % (player, game_id, game))
-                        del self._game_players[(game_id, player.id)]
+            logger.info('Game %s over' % game_id)
+            await self._drop_game(game_id)
+            await database_sync_to_async(self._release)(game_id)
+
+    def _move_delay(self, snapshot):
+        ''' seconds to wait before a computer move, only computer against computer games wait '''
+        if isinstance(snapshot.player1, ComputerPlayer) and isinstance(snapshot.player2, ComputerPlayer):
+            return self.MOVE_DELAY
+        return 0
+
+    def _queue_move(self, game_id, player, strategy, moves, delay):
+        ''' queues the move to think in the game's lane, due after delay seconds, and stops the lane's pondering '''
+        self._queued_moves[game_id] = len(moves)
+        lane = self.lane(game_id)
+        self._put_lane(lane, self.THINK, delay, game_id, player, strategy, moves)
+        self.lanes()[lane][1].set()
+
+    def _queue_ponder(self, game_id, player, strategy, moves):
+        ''' queues pondering the replies to the moves in the game's lane, after the lane's moves '''
+        self._pondering[game_id] = moves
+        self._pondered.pop(game_id, None)
+        self._put_lane(self.lane(game_id), self.PONDER, 0, game_id, player, strategy, moves)
+
+    def _put_lane(self, lane, priority, delay, game_id, player, strategy, moves):
+        queue = self._lane_queues.get(lane)
+        if queue is None:
+            # a thinker task per lane, taking the earliest due move first
+            queue = self._lane_queues[lane] = asyncio.PriorityQueue()
+            asyncio.ensure_future(self._thinker(lane))
+        self._sequence += 1
+        due = asyncio.get_event_loop().time() + delay
+        queue.put_nowait((priority, due, self._sequence, game_id, player, strategy, moves))
+
+    def _batch_move(self, game_id, player, strategy, moves, delay):
+        ''' adds the move to the next batch, the batch is chosen after BATCH_INTERVAL '''
+        if not self._batched_moves:
+            asyncio.get_event_loop().call_later(self.BATCH_INTERVAL, self._choose_batch)
+        self._queued_moves[game_id] = len(moves)
+        self._batched_moves.append((game_id, player, strategy, moves, delay))
+
+    def _choose_batch(self):
+        ''' chooses the batched moves, one call per strategy class, and plays them when they are due '''
+        loop = asyncio.get_event_loop()
+        (moves_batch, self._batched_moves) = (self._batched_moves, [])
+        by_class = {}
+        for move in moves_batch:
+            by_class.setdefault(type(move[2]), []).append(move)
+        for (strategy_class, batched) in by_class.items():
+            positions = [engine.Position(int(column) for column in moves) for (_, _, _, moves, _) in batched]
+            columns = strategy_class.choose_columns(positions)
+            logger.info('Chose %d moves for %s' % (len(columns), strategy_class.__name__))
+            for ((game_id, player, _, moves, delay), column) in zip(batched, columns):
+                loop.call_later(delay, lambda game_id = game_id, player = player, column = column, ply = len(moves):
+                    asyncio.ensure_future(self._play_move(game_id, player, column, ply)))
+
+    async def _thinker(self, lane):
+        ''' thinks about the lane's queued moves and ponders, one at a time, then plays the moves when they are due '''
+        loop = asyncio.get_event_loop()
+        (executor, stop) = self.lanes()[lane]
+        queue = self._lane_queues[lane]
+        while True:
+            (priority, due, _, game_id, player, strategy, moves) = await queue.get()
+            if priority == self.PONDER:
+                await self._ponder(executor, stop, game_id, player, strategy, moves)
+                continue
+            try:
+                column = await loop.run_in_executor(executor, strategies.think, player.strategy, moves)
+            except Exception:
+                logger.exception('Thinking failed for %s in game %s' % (strategy, game_id))
+                self._queued_moves.pop(game_id, None)
+            else:
+                # the move is played when it's due, without holding up the next one to think about
+                loop.call_at(due, lambda game_id = game_id, player = player, column = column, ply = len(moves):
+                    asyncio.ensure_future(self._play_move(game_id, player, column, ply)))
+
+    async def _ponder(self, executor, stop, game_id, player, strategy, moves):
+        ''' ponders in the lane, unless the reply already came in, and keeps the answers if it's still waiting '''
+        if self._pondering.get(game_id) != moves:
+            return
+        # moves queued, and the game dropped, from here on stop the pondering
+        stop.clear()
+        lane = self.lane(game_id)
+        self._lane_ponders[lane] = game_id
+        try:
+            pondered = await asyncio.get_event_loop().run_in_executor(
+                executor, strategies.ponder, player.strategy, moves)
+        except Exception:
+            logger.exception('Pondering failed for %s in game %s' % (strategy, game_id))
+            pondered = {}
+        finally:
+            del self._lane_ponders[lane]
+        if self._pondering.get(game_id) == moves:
+            del self._pondering[game_id]
+            self._pondered[game_id] = pondered
+            logger.info('%s pondered %d replies in game %s' % (strategy, len(pondered), game_id))
+
+    async def _play_move(self, game_id, player, column, ply):
+        ''' commits a thought out move, and lets everyone know '''
+        if self._queued_moves.get(game_id) == ply:
+            del self._queued_moves[game_id]
+        logger.info('Making move for %s in game %s; column %d, ply %d' % (player, game_id, column, ply))
+        game = await database_sync_to_async(self._commit_move)(game_id, player, column, ply)
+        if game:
+            strategy = self._game_players.get((game_id, player.id))
+            if strategy and strategy.PONDER and game.status == Game.Status.RUNNING.value:
+                self._queue_ponder(game_id, player, strategy, game.moves)
+            await PlayConsumer.send_play_update_async(game)
+
+    @staticmethod
+    def _commit_move(game_id, player, column, ply):
+        ''' makes the move, returns the game if it was played, or None '''
+        game = Game.objects.get(pk = game_id)
+        return game if game.make_move(player, column, ply) else None
@@ -0,0 +1,286 @@
+''' Bitboard connect4 engine
+
+    A position is held as two integer bitboards (one per player) plus the column heights.
+    Each column uses ROWS + 1 bits, the extra top bit is a sentinel that is never set,
+    so shifts never wrap a line from one column into the next:
+
+         6 13 20 27 34 41 48   <- sentinel row
+         5 12 19 26 33 40 47
+         4 11 18 25 32 39 46
+         3 10 17 24 31 38 45
+         2  9 16 23 30 37 44
+         1  8 15 22 29 36 43
+         0  7 14 21 28 35 42   <- row 0, the bottom of the board
+
+    Rows and columns match the Coin model, row 0 is the bottom, player 1 always moves first.
+    The template friendly list of lists board is only built by to_board for rendering.
+
+    Positions also keep Zobrist keys, for the board and its left to right mirror image.
+    The keys are from a fixed seed, so every process agrees on them, and can share tables keyed by them.
+'''
+import random
+
+ROWS = 6
+COLS = 7
+# bits per column, including the sentinel
+H1 = ROWS + 1
+CELLS = ROWS * COLS
+
+# one bit at the bottom of each column
+BOTTOM = sum(1 << (col * H1) for col in range(COLS))
+# the sentinel bit on top of each column
+TOP = BOTTOM << ROWS
+# every playable cell
+FULL = BOTTOM * ((1 << ROWS) - 1)
+
+
+# Zobrist keys for each player and bit index, the same in every process
+_zobrist_random = random.Random(0x436F6E6E65637434)
+ZOBRIST = [[_zobrist_random.getrandbits(64) for bit_index in range(COLS * H1)] for player in range(2)]
+# key of the empty board, so no position has a key of 0
+ZOBRIST_EMPTY = _zobrist_random.getrandbits(64) | 1
+# bit index of the same cell, mirrored left to right
+MIRROR = [(COLS - 1 - bit_index // H1) * H1 + bit_index % H1 for bit_index in range(COLS * H1)]
+
+
+def bit(row, column):
+    ''' returns the single bit for a row and column '''
+    return 1 << (column * H1 + row)
+
+
+def cell(bit_index):
+    ''' returns the (row, column) of a bit index '''
+    return (bit_index % H1, bit_index // H1)
+
+
+def cells(board):
+    ''' returns the list of (row, column) cells set in the bitboard, ordered by column then row '''
+    found = []
+    while board:
+        low = board & -board
+        found.append(cell(low.bit_length() - 1))
+        board ^= low
+    return found
+
+
+# bit shifts for each direction; vertical, horizontal, and the two diagonals
+DIRECTIONS = (1, H1, H1 - 1, H1 + 1)
+
+
+def has_four(board):
+    ''' returns True if the bitboard has four in a row in any direction '''
+    for shift in DIRECTIONS:
+        pairs = board & (board >> shift)
+        if pairs & (pairs >> (2 * shift)):
+            return True
+    return False
+
+
+def popcount(board):
+    ''' number of bits set in the bitboard '''
+    return bin(board).count('1')
+
+
+def threats(board, mask):
+    ''' returns a bitboard of the empty cells that would complete four in a row for the board
+        mask is all the coins on the board; the cells may not be playable yet
+    '''
+    # vertical, only upwards can be open
+    found = (board << 1) & (board << 2) & (board << 3)
+    for shift in (H1, H1 - 1, H1 + 1):
+        # the gap can be at either end, or in either middle spot of the line
+        pair = (board << shift) & (board << 2 * shift)
+        found |= pair & (board << 3 * shift)
+        found |= pair & (board >> shift)
+        pair = (board >> shift) & (board >> 2 * shift)
+        found |= pair & (board << shift)
+        found |= pair & (board >> 3 * shift)
+    return found & (FULL ^ mask)
+
+
+def winning_line(board, row, column):
+    ''' returns a bitboard of the four winning cells through the coin at row, column, or 0 if it isn't a winner
+        Only lines through that coin are checked, so it's the test for the move just played.
+        Each direction is walked with shifts from the coin, up to 3 cells each way until a gap; the four
+        are the lowest run of four with the coin, in the first direction with one, even if the line is longer
+        or the coin completes more than one line.  The sentinel bits are never set, so walks can't wrap.
+    '''
+    move = bit(row, column)
+    for shift in DIRECTIONS:
+        start = move
+        down = 0
+        while down < 3 and (start >> shift) & board:
+            start >>= shift
+            down += 1
+        up = 0
+        probe = move << shift
+        while down + up < 3 and probe & board:
+            probe <<= shift
+            up += 1
+        if down + up == 3:
+            return start | start << shift | start << 2 * shift | start << 3 * shift
+    return 0
+
+
+class Position():
+    ''' a connect4 position, player 0 is Game.player1 and player 1 is Game.player2 '''
+
+    __slots__ = ('boards', 'heights', 'history', 'ply', 'key', 'mirror_key')
+
+    def __init__(self, moves = ()):
+        ''' creates a position, optionally playing a sequence of columns from an empty board '''
+        self.boards = [0, 0]
+        # number of coins on the board
+        self.ply = 0
+        # Zobrist keys of the board, and the board mirrored left to right
+        self.key = ZOBRIST_EMPTY
+        self.mirror_key = ZOBRIST_EMPTY
+        # bit index of the next free cell in each column
+        self.heights = [col * H1 for col in range(COLS)]
+        # stack of columns played, used for undo
+        self.history = []
+        for column in moves:
+            self.play(column)
+
+    @classmethod
+    def from_board(cls, board):
+        ''' builds a position from the template board shape, a list of rows of [player, color, win]
+            The move order can't be recovered from a board, so the position has no undo history
+        '''
+        position = cls()
+        for (row_index, row) in enumerate(board):
+            for (col_index, col) in enumerate(row):
+                if col[0]:
+                    bit_index = col_index * H1 + row_index
+                    position.boards[col[0] - 1] |= 1 << bit_index
+                    position.key ^= ZOBRIST[col[0] - 1][bit_index]
+                    position.mirror_key ^= ZOBRIST[col[0] - 1][MIRROR[bit_index]]
+        mask = position.mask
+        position.ply = popcount(mask)
+        for col in range(COLS):
+            while mask & (1 << position.heights[col]):
+                position.heights[col] += 1
+        return position
+
+    def copy(self):
+        ''' returns an independent copy of this position '''
+        position = Position()
+        position.boards = list(self.boards)
+        position.heights = list(self.heights)
+        position.history = list(self.history)
+        position.ply = self.ply
+        position.key = self.key
+        position.mirror_key = self.mirror_key
+        return position
+
+    @property
+    def mask(self):
+        ''' bitboard of all coins on the board '''
+        return self.boards[0] | self.boards[1]
+
+    @property
+    def player(self):
+        ''' the player to move, 0 or 1 '''
+        return self.ply & 1
+
+    @property
+    def playable(self):
+        ''' bitboard of the cells a coin can be dropped into '''
+        return (self.mask + BOTTOM) & FULL
+
+    @property
+    def canonical_key(self):
+        ''' returns (key, mirrored), the smaller of the key and mirror key, and True if it's the mirror key
+            A position and its mirror image have the same canonical key
+        '''
+        return (self.mirror_key, True) if self.mirror_key < self.key else (self.key, False)
+
+    @property
+    def last_move(self):
+        ''' (row, column) of the last move played, or None if there is no history '''
+        if self.history:
+            column = self.history[-1]
+            return (self.heights[column] - 1 - column * H1, column)
+
+    @property
+    def is_full(self):
+        ''' True when the board has no more space '''
+        return self.mask == FULL
+
+    def can_play(self, column):
+        ''' True if a coin can be dropped in the column '''
+        return 0 <= column < COLS and not (1 << self.heights[column]) & TOP
+
+    def legal_moves(self):
+        ''' list of columns that are not full '''
+        return [col for col in range(COLS) if not (1 << self.heights[col]) & TOP]
+
+    def col_full(self):
+        ''' list of bools for each column, True if the column is full '''
+        return [bool((1 << self.heights[col]) & TOP) for col in range(COLS)]
+
+    def play(self, column):
+        ''' drops a coin for the player to move in the column, returns the row it landed on
+            The column is assumed to be legal, check with can_play first
+        '''
+        bit_index = self.heights[column]
+        player = self.ply & 1
+        self.boards[player] |= 1 << bit_index
+        self.key ^= ZOBRIST[player][bit_index]
+        self.mirror_key ^= ZOBRIST[player][MIRROR[bit_index]]
+        self.heights[column] = bit_index + 1
+        self.history.append(column)
+        self.ply += 1
+        return bit_index - column * H1
+
+    def undo(self):
+        ''' takes back the last move played, returns the column '''
+        column = self.history.pop()
+        self.ply -= 1
+        bit_index = self.heights[column] - 1
+        player = self.ply & 1
+        self.heights[column] = bit_index
+        self.boards[player] ^= 1 << bit_index
+        self.key ^= ZOBRIST[player][bit_index]
+        self.mirror_key ^= ZOBRIST[player][MIRROR[bit_index]]
+        return column
+
+    def is_winner(self, player):
+        ''' True if the player (0 or 1) has four in a row '''
+        return has_four(self.boards[player])
+
+    def winning_cells(self, row, column):
+        ''' returns the list of (row, column) of the four winning cells through the coin at row, column
+            The list is empty if the coin isn't part of a win, see winning_line
+        '''
+        cell_bit = bit(row, column)
+        board = self.boards[0] if self.boards[0] & cell_bit else self.boards[1] if self.boards[1] & cell_bit else 0
+        return cells(winning_line(board, row, column)) if board else []
+
+    def is_winning_move(self, column):
+        ''' True if the player to move wins by playing the column, without playing it '''
+        return has_four(self.boards[self.player] | (1 << self.heights[column]))
+
+    def threats(self, player):
+        ''' bitboard of the empty cells that would win for the player (0 or 1) '''
+        return threats(self.boards[player], self.mask)
+
+    def to_board(self, colors = (None, None), winners = ()):
+        ''' returns the template board shape, a list of rows of columns
+                each cell is [player, color, win];
+                    player is (1 or 2) or None (empty), win is True if the cell is in winners
+            colors is the (player1, player2) color for the cells, winners is a collection of (row, column)
+        '''
+        board = []
+        for row in range(ROWS):
+            board_row = []
+            for col in range(COLS):
+                cell_bit = bit(row, col)
+                if self.boards[0] & cell_bit:
+                    board_row.append([1, colors[0], (row, col) in winners])
+                elif self.boards[1] & cell_bit:
+                    board_row.append([2, colors[1], (row, col) in winners])
+                else:
+                    board_row.append((None, None, False))
+            board.append(board_row)
+        return board
@@ -0,0 +1,108 @@
+''' Pattern statistics for the learning strategy
+
+    The statistics are the results of finished games, for every position reached in their opening moves,
+    kept in a record file, see records, of fixed size records sorted by canonical position key, like the opening book.
+    Each record counts the games through the position, and the points for the player who moved into it,
+    2 for a win and 1 for a draw.
+
+    The header keeps the last game trained, (last move date, game id), so training again only reads
+    the games finished since, and OVERLAP before.  A game's last move date is set before its move commits,
+    so a game can commit after a later one was trained; the games trained in the OVERLAP are kept
+    after the records, so the games read again are skipped.
+
+    File layout, little endian:
+        header: magic b'C4PS', record count (uint32), last move date in microseconds (int64), game id (uint32),
+            recent game count (uint32)
+        records: canonical key (uint64), games (uint32), points (uint32)
+        recent games: game id (uint32), last move date in microseconds (int64)
+'''
+import datetime
+import struct
+from django.utils import timezone
+from . import engine, records
+
+MAGIC = b'C4PS'
+HEADER = struct.Struct('<4sIqII')
+RECORD = struct.Struct('<QII')
+RECENT = struct.Struct('<Iq')
+
+# games are read again this far before the last game trained, longer than a move takes to commit
+OVERLAP = datetime.timedelta(minutes = 10)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo = timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds = 1)
+
+
+class PatternStats(records.RecordFile):
+    ''' read only pattern statistics, memory mapped from a file '''
+
+    MAGIC = MAGIC
+    HEADER = HEADER
+    RECORD = RECORD
+    KIND = 'a pattern statistics file'
+
+    def __init__(self, path):
+        ''' opens the statistics, raises OSError if the file can't be read, or ValueError if it isn't statistics '''
+        super().__init__(path)
+        (_, _, microseconds, game_id, self.recent_count) = self.header
+        self.watermark = (EPOCH + microseconds * MICROSECOND, game_id) if game_id else None
+
+    def trailer_size(self):
+        return self.header[4] * RECENT.size
+
+    def items(self):
+        ''' yields (key, (games, points)) for every record, in key order '''
+        for index in range(self.count):
+            (key, games, points) = self.record(index)
+            yield (key, (games, points))
+
+    def recent(self):
+        ''' returns the games trained in the OVERLAP before the watermark, a dictionary of game id: last move date '''
+        return {game_id : EPOCH + microseconds * MICROSECOND for (game_id, microseconds) in (
+            RECENT.unpack_from(self._map, self.records_end + index * RECENT.size)
+            for index in range(self.recent_count))}
+
+    def lookup(self, position):
+        ''' returns (games, points) for the player who moved into the position, or None if it wasn't seen '''
+        record = self.find(position.canonical_key[0])
+        return record[1:] if record else None
+
+
+def train(games, stats, plies, trained = None):
+    ''' adds the results of games to stats, a dictionary of canonical key: [games, points]
+        games is an iterable of (game id, moves, winner, last move date), in the order they finished,
+        only the positions up to plies moves are counted.  trained is an optional dictionary of
+        game id: last move date, of games to skip, the games trained are added to it.
+        Returns (games trained, watermark), the watermark is None if there were no games
+    '''
+    count = 0
+    watermark = None
+    for (game_id, moves, winner, last_move_date) in games:
+        if trained is not None:
+            if game_id in trained:
+                continue
+            trained[game_id] = last_move_date
+        position = engine.Position()
+        for column in moves[:plies]:
+            position.play(int(column))
+            # the player who just moved, player 1 moves on odd plies
+            mover = 2 - position.ply % 2
+            entry = stats.setdefault(position.canonical_key[0], [0, 0])
+            entry[0] += 1
+            entry[1] += 2 if winner == mover else 1 if not winner else 0
+        count += 1
+        watermark = (last_move_date, game_id)
+    return (count, watermark)
+
+
+def write(path, stats, watermark, trained = None):
+    ''' writes the statistics from train to a file, sorted by key, with the watermark of the last game,
+        and the games from trained, game id: last move date, in the OVERLAP before it
+    '''
+    (last_move_date, game_id) = watermark or (EPOCH, 0)
+    recent = sorted((game_id, date) for (game_id, date) in (trained or {}).items()
+                    if date >= last_move_date - OVERLAP)
+    records.write(path,
+        HEADER.pack(MAGIC, len(stats), (last_move_date - EPOCH) // MICROSECOND, game_id, len(recent)),
+        RECORD, ((key, games, points) for (key, (games, points)) in stats.items()),
+        b''.join(RECENT.pack(recent_id, (date - EPOCH) // MICROSECOND) for (recent_id, date) in recent))
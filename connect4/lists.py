@@ -0,0 +1,58 @@
+''' The games lists in the lobby, shared by the list views and the list update broadcasts
+
+    A list is summarized as an ordered dictionary of game id: the text shown for the game,
+    and list updates carry the difference between two summaries, so the lobby doesn't fetch the list again.
+    Lists are loaded with a query for the games and a query per player type, however long they are.
+'''
+from collections import OrderedDict
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from .models import Game
+from .snapshot import GameSnapshot
+
+AVAILABLE = 'available_games'
+RUNNING = 'running_games'
+USER = 'user_games'
+
+# the user's previous games are limited, in case someone really likes it
+USER_GAMES_LIMIT = 50
+
+
+def games(list_id, user = None):
+    ''' returns the games queryset for a list, the user games list needs the user, or their id
+        games are annotated with last_action, the last move date or the created date without moves,
+        available games are oldest first, the others most recently played first
+    '''
+    queryset = Game.objects.annotate(last_action = Coalesce('last_move_date', 'created_date'))
+    if list_id == AVAILABLE:
+        return queryset.filter(status = Game.Status.AVAILABLE.value).order_by('created_date', 'id')
+    elif list_id == RUNNING:
+        return queryset.filter(status = Game.Status.RUNNING.value).order_by('-last_action', '-id')
+    elif list_id == USER:
+        return queryset.filter(
+            Q(status = Game.Status.FINISHED.value) &
+            (Q(player1__userplayer__user = user) | Q(player2__userplayer__user = user))
+        ).order_by('-last_action', '-id')[:USER_GAMES_LIMIT]
+    raise ValueError('Unknown games list %s' % list_id)
+
+
+def load(list_id, user = None):
+    ''' returns the list's games, with their players loaded as their real types '''
+    found = list(games(list_id, user))
+    GameSnapshot.resolve_players(found)
+    return found
+
+
+def summaries(list_id, user = None):
+    ''' returns the list summary, an ordered dictionary of game id: text '''
+    return OrderedDict((game.id, str(game)) for game in load(list_id, user))
+
+
+def diff(old, new):
+    ''' returns (added, removed, updated) between two summaries
+        added and updated are lists of {'id', 'text'}, removed is a list of ids
+    '''
+    added = [{'id' : pk, 'text' : text} for (pk, text) in new.items() if pk not in old]
+    removed = [pk for pk in old if pk not in new]
+    updated = [{'id' : pk, 'text' : text} for (pk, text) in new.items() if pk in old and old[pk] != text]
+    return (added, removed, updated)
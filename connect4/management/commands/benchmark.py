@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from connect4 import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Runs the engine, model and strategy benchmarks, and fails if any is slower than its baseline '
+            'by more than the tolerance')
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs = '*',
+            help = 'benchmarks to run, all of them by default; %s' % ', '.join(benchmark.BENCHMARKS))
+        parser.add_argument('--tolerance', type = float, default = benchmark.TOLERANCE,
+            help = 'fraction slower than the baseline that still passes')
+        parser.add_argument('--save', action = 'store_true',
+            help = 'save the results as the new baselines')
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(benchmark.BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks; %s' % ', '.join(sorted(unknown)))
+        baselines = benchmark.load_baselines()
+
+        def progress(name, result):
+            baseline = baselines.get(name)
+            change = ' %+6.1f%%' % (100 * (result / baseline - 1)) if baseline else ''
+            self.stdout.write('%-22s%12.3f/reference run%s' % (name, result, change))
+
+        results = benchmark.run(options['names'] or None, progress = progress)
+        if options['save']:
+            benchmark.save_baselines(results)
+            self.stdout.write(self.style.SUCCESS('Saved %d baselines to %s' % (len(results), benchmark.BASELINES)))
+            return
+        slower = benchmark.regressions(results, baselines, options['tolerance'])
+        if slower:
+            raise CommandError('Slower than baseline; %s' % ', '.join(
+                '%s %.3f against %.3f/reference run' % regression for regression in slower))
+        self.stdout.write(self.style.SUCCESS('No regressions beyond %.0f%%' % (100 * options['tolerance'])))
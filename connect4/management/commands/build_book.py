@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from connect4 import book, strategies
+
+
+class Command(BaseCommand):
+    help = 'Builds the opening book for the searching computer players by deep searching the opening positions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plies', type = int, default = 8,
+            help = 'number of opening moves covered by the book')
+        parser.add_argument('--time', type = float, default = 1.0,
+            help = 'search time per position, in seconds')
+        parser.add_argument('--output', default = settings.CONNECT4_OPENING_BOOK,
+            help = 'book file to write')
+
+    def handle(self, *args, **options):
+        def progress(count):
+            if count % 100 == 0:
+                self.stdout.write('Searched %d positions' % count)
+
+        entries = book.build(options['plies'], options['time'], strategies.transposition_table(), progress)
+        book.write(options['output'], entries)
+        self.stdout.write(self.style.SUCCESS('Wrote %d positions to %s' % (len(entries), options['output'])))
@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import time
+import django
+from django.core.management.base import BaseCommand
+from connect4 import tournament
+from connect4.models import STRATEGIES
+
+
+class Command(BaseCommand):
+    help = ('Plays a round robin tournament between the computer player strategies in memory, '
+            'and reports results, Elo estimates and think times')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strategies', type = int, nargs = '+', default = sorted(STRATEGIES),
+            choices = sorted(STRATEGIES), help = 'strategy numbers to play')
+        parser.add_argument('--games', type = int, default = 10,
+            help = 'openings each pair plays, once with each color')
+        parser.add_argument('--opening', type = int, default = 2,
+            help = 'random moves played before the strategies start, so games differ')
+        parser.add_argument('--time', type = float, default = 0.1,
+            help = 'think time per move for strategies with a time budget, in seconds')
+        parser.add_argument('--processes', type = int, default = os.cpu_count() or 1,
+            help = 'worker processes playing games')
+
+    def handle(self, *args, **options):
+        numbers = options['strategies']
+        if len(numbers) < 2:
+            self.stderr.write('A tournament needs at least two strategies')
+            return
+        match_list = tournament.matches(numbers, options['games'], options['opening'], options['time'])
+        self.stdout.write('Playing %d games in %d processes' % (len(match_list), options['processes']))
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(options['processes'], initializer = django.setup) as pool:
+            outcomes = pool.map(tournament.play_game, match_list, chunksize = 1)
+        elapsed = time.perf_counter() - start
+
+        # wins, draws, losses of row against column, and each strategy's think times
+        table = {(row, col) : [0, 0, 0] for row in numbers for col in numbers}
+        think_times = {number : [] for number in numbers}
+        results = []
+        for ((first, second, _, _), (winner, _, times)) in zip(match_list, outcomes):
+            for (number, opponent, player) in ((first, second, 1), (second, first, 2)):
+                table[number, opponent][0 if winner == player else 1 if not winner else 2] += 1
+                think_times[number].extend(times[player - 1])
+            results.append((first, second, 1.0 if winner == 1 else 0.5 if not winner else 0.0))
+        ratings = tournament.elo(results)
+
+        names = {number : STRATEGIES[number] for number in numbers}
+        width = max(len(name) for name in names.values()) + 2
+        self.stdout.write('\nWins/draws/losses, row against column')
+        self.stdout.write(''.ljust(width) + ''.join(names[col].rjust(width) for col in numbers))
+        for row in numbers:
+            self.stdout.write(names[row].ljust(width) + ''.join(
+                ('-' if row == col else '%d/%d/%d' % tuple(table[row, col])).rjust(width) for col in numbers))
+
+        self.stdout.write('\n%s%8s%12s%12s%8s' % ('Strategy'.ljust(width), 'Elo', 'mean ms', 'p99 ms', 'moves'))
+        for number in sorted(numbers, key = lambda number: -ratings[number]):
+            times = think_times[number]
+            self.stdout.write('%s%8.0f%12.2f%12.2f%8d' % (
+                names[number].ljust(width), ratings[number],
+                1000 * sum(times) / len(times) if times else 0.0,
+                1000 * tournament.percentile(times, 0.99), len(times)))
+
+        self.stdout.write(self.style.SUCCESS('\n%d games in %.1fs, %.2f games/sec' % (
+            len(match_list), elapsed, len(match_list) / elapsed)))
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from connect4 import learning
+from connect4.models import Game
+
+
+class Command(BaseCommand):
+    help = ('Trains the pattern statistics for the learning computer players from finished games, '
+            'adding the games finished since the last run')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plies', type = int, default = 16,
+            help = 'number of opening moves of each game to learn from')
+        parser.add_argument('--chunk', type = int, default = 2000,
+            help = 'games read from the database at a time')
+        parser.add_argument('--output', default = settings.CONNECT4_PATTERN_STATS,
+            help = 'statistics file to update')
+        parser.add_argument('--restart', action = 'store_true',
+            help = 'forget the existing statistics and train on every game')
+
+    def handle(self, *args, **options):
+        stats = {}
+        watermark = None
+        trained = {}
+        if not options['restart']:
+            try:
+                existing = learning.PatternStats(options['output'])
+            except (OSError, ValueError) as e:
+                self.stdout.write('Training from scratch; %s' % e)
+            else:
+                stats = {key : list(entry) for (key, entry) in existing.items()}
+                watermark = existing.watermark
+                trained = existing.recent()
+                existing.close()
+
+        games = Game.objects.filter(status = Game.Status.FINISHED.value).exclude(last_move_date = None)
+        if watermark:
+            # games committed late can have an earlier last move date, the ones trained already are skipped
+            games = games.filter(last_move_date__gte = watermark[0] - learning.OVERLAP)
+        # stream the games in finish order, a chunk at a time, the moves string has the whole game
+        games = games.order_by('last_move_date', 'pk').values_list(
+            'pk', 'moves', 'winner', 'last_move_date').iterator(chunk_size = options['chunk'])
+
+        (count, last_game) = learning.train(games, stats, options['plies'], trained)
+        if not count:
+            self.stdout.write(self.style.SUCCESS('No new games to train'))
+            return
+        learning.write(options['output'], stats, max(last_game, watermark or last_game), trained)
+        self.stdout.write(self.style.SUCCESS('Trained %d games, %d positions in %s' % (
+            count, len(stats), options['output'])))
@@ -0,0 +1,187 @@
+''' Monte Carlo tree search for the computer players
+
+    The tree is grown with UCT selection, and each new leaf is scored by a batch of random playouts,
+    played together as numpy arrays of bitboards, so a batch costs about as much as one Python game.
+    All the playouts in a batch start from the same leaf, so the same player is to move in all of them
+    at each step, and only the columns differ.
+
+    Trees are kept between moves, keyed by the moves string of their root, so when the opponent's reply
+    comes in, the search carries on from the subtree already grown under it.
+'''
+from collections import OrderedDict
+import math
+import time
+import numpy
+from . import engine
+from .search import BudgetedSearch, SearchTimeout, MOVE_ORDER
+
+# exploration constant for UCT
+EXPLORATION = 1.4
+
+_ROW_TOP = numpy.int64(engine.ROWS)
+_SHIFTS = tuple(numpy.uint64(shift) for shift in engine.DIRECTIONS)
+_DOUBLE_SHIFTS = tuple(numpy.uint64(2 * shift) for shift in engine.DIRECTIONS)
+
+
+def playouts(position, count, rng = numpy.random):
+    ''' plays count random games from the position together, returns the points for the player to move,
+        1 for each win and 0.5 for each draw
+    '''
+    player = position.player
+    boards = [numpy.full(count, position.boards[0], dtype = numpy.uint64),
+              numpy.full(count, position.boards[1], dtype = numpy.uint64)]
+    heights = numpy.tile(numpy.array(position.heights, dtype = numpy.int64), (count, 1))
+    games = numpy.arange(count)
+    active = numpy.ones(count, dtype = bool)
+    points = 0.0
+    mover = player
+    for ply in range(position.ply, engine.CELLS):
+        # a random legal column for each game, the random numbers for full columns are zeroed
+        legal = heights % engine.H1 != _ROW_TOP
+        columns = (rng.random_sample(heights.shape) * legal).argmax(axis = 1)
+        bit_indices = heights[games, columns]
+        board = boards[mover]
+        board |= numpy.left_shift(numpy.uint64(1), bit_indices.astype(numpy.uint64)) * active
+        heights[games, columns] += active
+        won = numpy.zeros(count, dtype = bool)
+        for (shift, double_shift) in zip(_SHIFTS, _DOUBLE_SHIFTS):
+            pairs = board & (board >> shift)
+            won |= (pairs & (pairs >> double_shift)) != 0
+        won &= active
+        if mover == player:
+            points += won.sum()
+        active &= ~won
+        if not active.any():
+            return float(points)
+        mover = 1 - mover
+    # the games still going filled the board
+    return float(points + 0.5 * active.sum())
+
+
+class Node():
+    ''' a node of the search tree, the position after move '''
+
+    __slots__ = ('move', 'children', 'untried', 'visits', 'points', 'terminal')
+
+    def __init__(self, move, position):
+        ''' position is the position at the node, after the move was played '''
+        self.move = move
+        self.children = []
+        # centre columns are expanded first
+        self.untried = [col for col in reversed(MOVE_ORDER) if position.can_play(col)]
+        # visits and points are for the player who played move into the node
+        self.visits = 0
+        self.points = 0.0
+        # the points per visit when the node ends the game, None if it doesn't
+        self.terminal = None
+        if move is not None and position.is_winner(1 - position.player):
+            self.terminal = 1.0
+        elif position.is_full:
+            self.terminal = 0.5
+        if self.terminal is not None:
+            self.untried = []
+
+    def select(self):
+        ''' returns the child with the best UCT score '''
+        log_visits = math.log(self.visits)
+        return max(self.children, key = lambda child:
+            child.points / child.visits + EXPLORATION * math.sqrt(log_visits / child.visits))
+
+    def child(self, move):
+        ''' returns the child for the move, or None if it wasn't expanded '''
+        return next((child for child in self.children if child.move == move), None)
+
+
+class MonteCarloSearch(BudgetedSearch):
+    ''' Monte Carlo tree search within a time budget, the node budget counts playouts
+        After a search, nodes is the number of playouts, and nodes_per_second the playouts per second
+    '''
+
+    def __init__(self, time_budget = 1.0, node_budget = None, batch = 64, trees = 16, stop_event = None):
+        ''' batch is the number of playouts played together for each new leaf,
+            trees is the number of trees kept, for the games playing in this process
+        '''
+        super().__init__(time_budget, node_budget, stop_event)
+        self.batch = batch
+        self.trees = OrderedDict()
+        self.max_trees = trees
+        self.reused = 0
+
+    def search(self, position):
+        ''' returns (column, win rate) for the player to move, the win rate counts draws as half '''
+        start = time.monotonic()
+        self._start_budget(start)
+        position = position.copy()
+        moves = ''.join(str(col) for col in position.history)
+        root = self._reuse_tree(moves, position)
+        # take an immediate win without searching
+        win = next((col for col in MOVE_ORDER if position.can_play(col) and position.is_winning_move(col)), None)
+        if win is not None:
+            self.elapsed = time.monotonic() - start
+            return (win, 1.0)
+        try:
+            while True:
+                self._iterate(root, position)
+                if self.nodes >= self._next_check:
+                    self._check_budget()
+        except SearchTimeout:
+            pass
+        self.elapsed = time.monotonic() - start
+        best = max(root.children, key = lambda child: child.visits)
+        # keep the subtree for the move played, for the next move in this game
+        self._keep_tree(moves + str(best.move), best)
+        return (best.move, best.points / best.visits)
+
+    def _reuse_tree(self, moves, position):
+        ''' returns the kept tree for the moves, descending through the moves played since, or a new tree '''
+        for played in range(3):
+            root = self.trees.pop(moves[:len(moves) - played], None)
+            if root:
+                for col in moves[len(moves) - played:]:
+                    root = root.child(int(col))
+                    if not root:
+                        break
+                else:
+                    self.reused = root.visits
+                    return root
+        self.reused = 0
+        return Node(None, position)
+
+    def _keep_tree(self, moves, root):
+        self.trees[moves] = root
+        while len(self.trees) > self.max_trees:
+            self.trees.popitem(last = False)
+
+    def _iterate(self, root, position):
+        ''' grows the tree by one leaf, scored with a batch of playouts '''
+        path = [root]
+        node = root
+        played = 0
+        # select down to a node with moves to try
+        while not node.untried and node.children:
+            node = node.select()
+            position.play(node.move)
+            played += 1
+            path.append(node)
+        # expand one move
+        if node.untried:
+            col = node.untried.pop()
+            position.play(col)
+            played += 1
+            node = Node(col, position)
+            path[-1].children.append(node)
+            path.append(node)
+        count = self.batch
+        if node.terminal is not None:
+            points = node.terminal * count
+        else:
+            # the playout points are for the player to move, the node's points are for the player who moved
+            points = count - playouts(position, count)
+        self.nodes += count
+        for _ in range(played):
+            position.undo()
+        # back up, each level scores for the other player
+        for node in reversed(path):
+            node.visits += count
+            node.points += points
+            points = count - points
@@ -0,0 +1,41 @@
+# Generated by Django 2.0.2 on 2018-03-10 10:12
+
+from django.db import migrations, models
+
+
+def replay_coins(apps, schema_editor):
+    ''' fills in the board state for existing games from their coins '''
+    Game = apps.get_model('connect4', 'Game')
+    for game in Game.objects.all():
+        coins = list(game.coin_set.order_by('created_date', 'id'))
+        if coins:
+            game.moves = ''.join(str(coin.column) for coin in coins)
+            game.ply = len(coins)
+            game.last_move_date = coins[-1].created_date
+            game.save(update_fields = ('moves', 'ply', 'last_move_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect4', '0009_auto_20180224_2158'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='last_move_date',
+            field=models.DateTimeField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='moves',
+            field=models.CharField(blank=True, default='', editable=False, max_length=42),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='ply',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(replay_coins, migrations.RunPython.noop),
+    ]
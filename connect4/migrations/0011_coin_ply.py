@@ -0,0 +1,33 @@
+# Generated by Django 2.0.2 on 2018-03-10 14:37
+
+from django.db import migrations, models
+
+
+def number_coins(apps, schema_editor):
+    ''' numbers the coins of existing games in move order '''
+    Game = apps.get_model('connect4', 'Game')
+    for game in Game.objects.all():
+        for (ply, coin) in enumerate(game.coin_set.order_by('created_date', 'id'), 1):
+            coin.ply = ply
+            coin.save(update_fields = ('ply',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect4', '0010_game_board_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coin',
+            name='ply',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(number_coins, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='coin',
+            unique_together={('game', 'ply')},
+        ),
+    ]
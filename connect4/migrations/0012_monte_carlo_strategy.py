@@ -0,0 +1,18 @@
+# Generated by Django 2.0.2 on 2018-03-11 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect4', '0011_coin_ply'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='computerplayer',
+            name='strategy',
+            field=models.IntegerField(choices=[(1, 'Random - plays completely randomly'), (2, 'Dumb - only looks at current move, but not ahead'), (3, 'Smart - brute force depth search scoring strategy'), (4, 'Learning - learning model that adjusts strategy with history and pattern matching'), (5, 'MonteCarlo - tree search scored by random playouts, stronger with more time')], default=1),
+        ),
+    ]
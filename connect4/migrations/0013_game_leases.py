@@ -0,0 +1,29 @@
+# Generated by Django 2.0.2 on 2018-03-12 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect4', '0012_monte_carlo_strategy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerShard',
+            fields=[
+                ('channel', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('heartbeat', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameLease',
+            fields=[
+                ('game', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='connect4.Game')),
+                ('shard', models.CharField(db_index=True, max_length=100)),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -2,11 +2,13 @@ from enum import Enum
 import logging
 import threading
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from polymorphic.models import PolymorphicModel
+from . import engine
 
 
 class Player(PolymorphicModel):
@@ -51,12 +53,14 @@ STRATEGIES = {
     2 : 'Dumb',
     3 : 'Smart',
     4 : 'Learning',
+    5 : 'MonteCarlo',
 }
 STRATEGY_DESCRIPTIONS = {
     1 : 'plays completely randomly',
     2 : 'only looks at current move, but not ahead',
     3 : 'brute force depth search scoring strategy',
     4 : 'learning model that adjusts strategy with history and pattern matching',
+    5 : 'tree search scored by random playouts, stronger with more time',
 }
 
 class ComputerPlayer(Player):
@@ -78,6 +82,10 @@ class ComputerPlayer(Player):
         return '%s - %s - %s' % (self.get_short_name(), STRATEGIES[self.strategy], super().__str__())
 
 
+class StaleMove(Exception):
+    ''' raised inside the move transaction when another move was committed first '''
+
+
 class Game(models.Model):
     class Status(Enum):
         AVAILABLE = 0
@@ -86,8 +94,8 @@ class Game(models.Model):
         ABANDONED = 3
 
     # board size
-    ROWS = 6
-    COLS = 7
+    ROWS = engine.ROWS
+    COLS = engine.COLS
 
     player1 = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='player_1')
     player1color = models.IntegerField(default = 0x000000) # black
@@ -96,6 +104,11 @@ class Game(models.Model):
     status = models.IntegerField(default = Status.AVAILABLE.value)
     winner = models.IntegerField(default = None, blank = True, null = True)
     created_date = models.DateTimeField(default=timezone.now)
+    # denormalized board state, so reads don't need to replay the coins; the Coin table is the audit log
+    # moves is the sequence of columns played, one digit per move, ply is the number of moves
+    moves = models.CharField(max_length = engine.CELLS, default = '', blank = True, editable = False)
+    ply = models.IntegerField(default = 0, editable = False)
+    last_move_date = models.DateTimeField(default = None, blank = True, null = True, editable = False)
 
     def __str__(self):        
         player1 = self.winner_name if self.winner else self.player1_name
@@ -151,21 +164,22 @@ class Game(models.Model):
         return coins[0].created_date if coins else self.created_date
 
     @property
-    def last_move(self):        
-        last_move = self.coin_set.order_by('-created_date')
-        if last_move:
-            return last_move[0]
+    def last_move(self):
+        ''' returns the last Coin played, or None '''
+        if self.ply:
+            return self.coin_set.filter(ply = self.ply).first()
+
+    @property
+    def next_player(self):
+        ''' the player number (1 or 2) to move next, player 1 always goes first '''
+        # FIXME: make more fair with random starter
+        return 1 + self.ply % 2
     
     @property
     def next_move(self):
         ''' Retuns the user with the next move, if there are 2 players, and the game isn't over '''
-        last_move = self.last_move
-        if self.player1 and self.player2 and self.status == self.Status.RUNNING.value:
-            if last_move:
-                return self.player1 if last_move.player == self.player2 else self.player2
-            else:
-                # FIXME: make more fair with random starter
-                return self.player1
+        if self.player2_id and self.status == self.Status.RUNNING.value:
+            return self.player1 if self.next_player == 1 else self.player2
 
     @property
     def next_move_user(self):
@@ -173,7 +187,12 @@ class Game(models.Model):
 
     @property
     def last_action_date(self):
-        return self.last_move.created_date if self.last_move else self.start_time
+        return self.last_move_date or self.created_date
+
+    @property
+    def position(self):
+        ''' returns an engine Position from the stored moves '''
+        return engine.Position(int(column) for column in self.moves)
 
     @property
     def _build_board(self):
@@ -183,15 +202,12 @@ class Game(models.Model):
                     player is (1 or 2) or None (empty), win is True if winning move
             col_full is a list of bools to specific if the column is full
         '''
-        # FIXME: this does no validation, it assumes all the moves and players are valid
-        board = [[(None, None) for col in range(self.COLS)] for row in range(self.ROWS)]
-        for coin in self.coin_set.all():
-            player = 1 if coin.player == self.player1 else 2 if coin.player == self.player2 else None
-            color = self.player1color if player == 1 else self.player2color if player == 2 else None
-            # color converted to web hex for the template
-            board[coin.row][coin.column] = [player, '#{0:06X}'.format(color), coin.winner]
-        col_full = [all(board[row][col][0] for row in range(self.ROWS)) for col in range(self.COLS)]
-        return (board, col_full)
+        position = self.position
+        # only the last move can win, so the winning cells are the four through it
+        winners = position.winning_cells(*position.last_move) if self.winner else ()
+        # color converted to web hex for the template
+        board = position.to_board((self.player1_color_web, self.player2_color_web), winners)
+        return (board, position.col_full())
 
     @property
     def board(self):
@@ -204,105 +220,82 @@ class Game(models.Model):
         return self._build_board[1]
 
     def join_up(self, player):
-        ''' join the game '''
-        # FIXME: race condition not handled
-        if self.player1 != player and not self.player2:
-            self.player2 = player
-            self.status = self.Status.RUNNING.value
-            self.save()
-            return True
-        else:
-            return False
-
-    def make_move(self, player, column):
-        ''' make a move for the given player and column '''
-        # validate correct player, and column range
-        if player == self.next_move and 0 <= column < self.COLS:
-            player_num = 1 if self.player1 == player else 2
-            (board, col_full) = self._build_board
-            if not col_full[column]:
-                # determine the row the coin falls to
-                for (row_index, row) in enumerate(board):
-                    if not row[column][0]:
-                        # valid move, create the move
-                        coin = self.coin_set.create(game=self, player=player, row=row_index, column=column)
-                        coin.save()
-                        # check if they won!  Add their coin to the board, so we don't need to reload
-                        # FIXME: this is a race condition, I need to figure out how to do transactions
-                        # if the user is really fast, they could try and place another coin                        
-                        board[row_index][column] = (player_num, None, False)
-                        if self._is_winner(board, row_index, column):
-                            self.status = self.Status.FINISHED.value
-                            self.winner = player_num
-                            self.save()
-                            player.wins += 1
-                            player.save()
-                            player2 = self.player1 if player_num == 2 else self.player2
-                            player2.losses += 1
-                            player2.save()
-                        # no winner, see if it's a draw
-                        elif len(self.coin_set.all()) == self.ROWS * self.COLS:
-                            self.status = self.Status.FINISHED.value
-                            self.save()   
-                            self.player1.draws += 1
-                            self.player1.save()
-                            self.player2.draws += 1                         
-                            self.player2.save()
-                        return True
-        logging.warning('Invalid move received %s, %s, %s' % (self.id, player, column))
+        ''' join the game, the update only matches if nobody else joined first '''
+        if self.player1_id != player.pk and not self.player2_id:
+            joined = Game.objects.filter(
+                pk = self.pk, status = self.Status.AVAILABLE.value, player2__isnull = True
+            ).update(player2 = player, status = self.Status.RUNNING.value)
+            if joined:
+                self.player2 = player
+                self.status = self.Status.RUNNING.value
+                return True
         return False
 
-    def _is_winner(self, board, row, column):
-        ''' Helper to find if the last move is a winner, returns True if winning move
-            Only checks the last move, which is player from row, column on the board
+    def make_move(self, player, column, ply = None):
+        ''' make a move for the given player and column
+            ply is optional, it's the number of moves the caller saw, so stale requests are rejected
+            The move is committed with a compare and swap on the game ply, and Coin (game, ply) is unique,
+            so a double click, or an AI racing a human, can't place two coins for one turn
         '''
-        player = board[row][column][0]
-        def _four_in_a_row(cells):
-            ''' helper to loop through cell sequence that is adjacent, list of tuple (row, col) '''
-            sequential = 0
-            for (i, (r, c)) in enumerate(cells):
-                if board[r][c][0] == player:
-                    sequential += 1
-                    if sequential == 4:
-                        # found a winner, mark the board
-                        self._mark_winners(cells[i-3:i+1])
-                        return True
-                else:
-                    sequential = 0
-            return False
-        # build lists of winning lists
-        cells_lists = [
-            # verticle
-            [(r, column) for r in range(self.ROWS)],
-            # horizontal
-            [(row, c) for c in range(self.COLS)],
-            # diagnally upper left to lower right (reverse y coordinate, not screen)
-            [(row + offset, column + offset) for offset
-                in range(- max(row, column), max(self.ROWS, self.COLS))
-                if 0 <= row + offset < self.ROWS and 0 <= column + offset < self.COLS],
-            # diagnally upper right to lower left (reverse y coordinate, not screen)
-            [(row - offset, column + offset) for offset
-                in range(- max(row, column), max(self.ROWS, self.COLS))
-                if 0 <= row - offset < self.ROWS and 0 <= column + offset < self.COLS],
-        ]
-        is_winner = any(_four_in_a_row(cells) for cells in cells_lists)
-        return is_winner
+        position = self.position
+        # validate correct player, column range, and that the caller saw the current board
+        next_player_id = self.player1_id if self.next_player == 1 else self.player2_id
+        if (self.status == self.Status.RUNNING.value and self.player2_id and
+                player.pk == next_player_id and position.can_play(column) and ply in (None, self.ply)):
+            player_num = self.next_player
+            # valid move, drop the coin to find the row
+            row_index = position.play(column)
+            coin = Coin(game=self, player=player, ply=self.ply + 1, row=row_index, column=column)
+            # check if they won!
+            winners = position.winning_cells(row_index, column)
+            state = {
+                'moves' : self.moves + str(column),
+                'ply' : coin.ply,
+                'last_move_date' : coin.created_date,
+                'status' : self.Status.FINISHED.value if winners or position.is_full else self.status,
+                'winner' : player_num if winners else None,
+            }
+            try:
+                # the coin and the board state are written together, in one short transaction
+                with transaction.atomic():
+                    updated = Game.objects.filter(
+                        pk = self.pk, ply = self.ply, status = self.Status.RUNNING.value
+                    ).update(**state)
+                    if not updated:
+                        raise StaleMove()
+                    coin.save()
+                    if winners:
+                        self._mark_winners(winners)
+                        Player.objects.filter(pk = player.pk).update(wins = F('wins') + 1)
+                        Player.objects.filter(pk = self.player2_id if player_num == 1 else self.player1_id).update(
+                            losses = F('losses') + 1)
+                    # no winner, see if it's a draw
+                    elif position.is_full:
+                        Player.objects.filter(pk__in = (self.player1_id, self.player2_id)).update(
+                            draws = F('draws') + 1)
+            except (StaleMove, IntegrityError):
+                logging.warning('Stale move received %s, %s, %s, ply %s' % (self.id, player, column, ply))
+                self.refresh_from_db()
+                return False
+            for (field, value) in state.items():
+                setattr(self, field, value)
+            return True
+        logging.warning('Invalid move received %s, %s, %s' % (self.id, player, column))
+        return False
 
     def _mark_winners(self, cells):
-        ''' marks winning coins '''
-        for coin in self.coin_set.all():
-            (r, c) = (coin.row, coin.column)
-            if (r, c) in cells:
-                coin.winner = True
-                coin.save()
+        ''' marks winning coins, cells is a list of (row, column), in a single update '''
+        query = Q()
+        for (row, column) in cells:
+            query |= Q(row = row, column = column)
+        self.coin_set.filter(query).update(winner = True)
 
     @property
     def _is_abandoned(self):
         ''' deterimes if this game has been abandoned (with no moves after an hour) '''
         if self.status in (self.Status.AVAILABLE.value, self.Status.RUNNING.value):
             now = timezone.now()
-            last_change = self.last_move.created_date if self.last_move else self.start_time
-            delta = now - last_change
+            delta = now - self.last_action_date
             return (delta.total_seconds() > 60 * 60)
         return False
         
@@ -313,30 +306,67 @@ class Game(models.Model):
         '''
         # this kicks off an abandoned game thread... no idea if this is a good way!
         # https://stackoverflow.com/questions/21945052/simple-approach-to-launching-background-task-in-django
-        def clean():
-            for game in Game.objects.all():
-                if game._is_abandoned:
-                    game.status = Game.Status.ABANDONED.value
-                    game.save()
-                    game.player1.abandoned += 1
-                    game.player1.save()
-                    if game.player2:
-                        game.player2.abandoned += 1
-                        game.player2.save()
-        threading.Thread(target = clean, daemon = True).start()
+        threading.Thread(target = cls.abandon_stale, daemon = True).start()
+
+    @classmethod
+    def abandon_stale(cls):
+        ''' marks the abandoned games, and counts them for their players
+            A game is only marked if it hasn't moved since it was read, so a move coming in wins,
+            and the updates touch only the status and the counts, like the moves do
+        '''
+        playing = (cls.Status.AVAILABLE.value, cls.Status.RUNNING.value)
+        for game in cls.objects.filter(status__in = playing):
+            if not game._is_abandoned:
+                continue
+            abandoned = cls.objects.filter(pk = game.pk, ply = game.ply, status__in = playing).update(
+                status = cls.Status.ABANDONED.value)
+            if abandoned == 1:
+                Player.objects.filter(pk__in = [pk for pk in (game.player1_id, game.player2_id) if pk]).update(
+                    abandoned = F('abandoned') + 1)
+
+
+def describe_move(name, column, row, win = False, draw = False):
+    ''' the moves list text for a coin, rows are counted from the top for people '''
+    return '%s column %d, for row %d%s' % (
+        name, column + 1, (Game.ROWS - row), ', To Win!' if win else ', To Draw!' if draw else '')
 
 
 class Coin(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    # the move number in the game, 1 for the first move
+    ply = models.IntegerField(editable = False)
     column = models.IntegerField()
     row = models.IntegerField()
     created_date = models.DateTimeField(default=timezone.now)
     winner = models.BooleanField(default = False)
 
+    class Meta:
+        unique_together = ('game', 'ply')
+
     def __str__(self):        
-        last = self == self.game.last_move
-        return '%s column %d, for row %d%s' % (
-            self.player.get_short_name(), self.column + 1, (Game.ROWS - self.row),
-            ', To Win!' if last and self.winner else ', To Draw!' if last and self.game.is_draw else ''
-        )
+        last = self.ply == self.game.ply
+        return describe_move(self.player.get_short_name(), self.column, self.row,
+            last and self.winner, last and self.game.is_draw)
+
+
+class PlayerShard(models.Model):
+    ''' a game player worker channel, alive while its heartbeat is recent '''
+    channel = models.CharField(max_length = 100, primary_key = True)
+    heartbeat = models.DateTimeField()
+
+    def __str__(self):
+        return '%s - %s' % (self.channel, self.heartbeat)
+
+
+class GameLease(models.Model):
+    ''' the game player shard playing a game's computer players, until the lease expires
+        shards renew their leases while they're alive, a game with an expired lease is orphaned,
+        and a live shard takes it over
+    '''
+    game = models.OneToOneField(Game, on_delete = models.CASCADE, primary_key = True)
+    shard = models.CharField(max_length = 100, db_index = True)
+    expires = models.DateTimeField(db_index = True)
+
+    def __str__(self):
+        return '%s - %s until %s' % (self.game_id, self.shard, self.expires)
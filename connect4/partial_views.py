@@ -1,14 +1,15 @@
 
+from . import lists
 from .models import Game
+from .snapshot import GameSnapshot
 from django.views import generic
-from django.db.models import Q
 
 class GamesList(generic.ListView):
     template_name = 'connect4/game_list.html'
     context_object_name = 'games'
 
     def get_queryset(self):
-        return Game.objects.filter(status = self.status.value)
+        return lists.load(self.list_id)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -21,35 +22,32 @@ class GamesList(generic.ListView):
 class AvailableGames(GamesList):
     ''' generic list view for available games list '''
     list_name = 'Available Games'
-    list_id = 'available_games'
-    status = Game.Status.AVAILABLE
+    list_id = lists.AVAILABLE
 
 class RunningGames(GamesList):
     ''' generic list view for available games list '''
     list_name = 'Games in Progress'
-    list_id = 'running_games'
-    status = Game.Status.RUNNING
+    list_id = lists.RUNNING
 
 class UserGames(GamesList):
     ''' generic list view for available games list '''
     list_name = 'Your Previous Games'
-    list_id = 'user_games'
+    list_id = lists.USER
 
     def get_queryset(self):
         if self.request.user.is_authenticated:
-            games = Game.objects.filter(
-                Q(status = Game.Status.FINISHED.value) &
-                (Q(player1__userplayer__user = self.request.user) | Q(player2__userplayer__user = self.request.user))
-            )
-            # limit to 50, in case someone really likes it
-            games = games[:50]
-            return games
+            return lists.load(self.list_id, self.request.user)
 
 
 class BoardView(generic.DetailView):
     ''' game board view '''
     model = Game
     template_name = 'connect4/board.html'
+    context_object_name = 'game'
+
+    def get_object(self, queryset = None):
+        ''' the template reads the game through a snapshot, so derived properties are only loaded once '''
+        return GameSnapshot(super().get_object(queryset))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -0,0 +1,80 @@
+''' Files of fixed size records sorted by key, for the opening book and the pattern statistics
+
+    A file is a header, the records in key order, then anything else the file keeps.
+    It's read through a memory map with a binary search, so a lookup reads a few pages,
+    and nothing is loaded into each process up front.
+    The header starts with the magic and the record count, and each record starts with its key.
+'''
+import mmap
+import os
+
+
+class RecordFile():
+    ''' read only records, memory mapped from a file
+        Subclasses set MAGIC, HEADER and RECORD, the header and record structs, and KIND for errors
+    '''
+
+    MAGIC = None
+    HEADER = None
+    RECORD = None
+    KIND = 'a record file'
+
+    def __init__(self, path):
+        ''' opens the file, raises OSError if it can't be read, or ValueError if it isn't this kind of file '''
+        self.path = path
+        with open(path, 'rb') as record_file:
+            self._map = mmap.mmap(record_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.header = self.HEADER.unpack_from(self._map, 0)
+        (magic, self.count) = self.header[:2]
+        if magic != self.MAGIC or len(self._map) != self.records_end + self.trailer_size():
+            self._map.close()
+            raise ValueError('%s is not %s' % (path, self.KIND))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._map.close()
+
+    @property
+    def records_end(self):
+        ''' the offset after the records '''
+        return self.HEADER.size + self.count * self.RECORD.size
+
+    def trailer_size(self):
+        ''' returns the size of what the file keeps after the records, from the header '''
+        return 0
+
+    def record(self, index):
+        return self.RECORD.unpack_from(self._map, self.HEADER.size + index * self.RECORD.size)
+
+    def find(self, key):
+        ''' returns the record with the key, or None if there isn't one '''
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            record = self.record(middle)
+            if record[0] < key:
+                low = middle + 1
+            elif record[0] > key:
+                high = middle
+            else:
+                return record
+        return None
+
+
+def write(path, header, record, rows, trailer = b''):
+    ''' writes a record file, header and trailer are packed bytes, rows are the record tuples, key first,
+        they're written in key order
+    '''
+    temp_path = path + '.tmp'
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    with open(temp_path, 'wb') as record_file:
+        record_file.write(header)
+        for row in sorted(rows, key = lambda row : row[0]):
+            record_file.write(record.pack(*row))
+        record_file.write(trailer)
+    # replace the old file in one step, so readers never see a partial file
+    os.replace(temp_path, path)
@@ -0,0 +1,93 @@
+''' Process local fan out of channel layer groups
+
+    With the relay, a process joins a group once, on a channel of its own, and hands each message
+    to its consumers in that group in memory.  The channel layer sends one message per process
+    instead of one per socket, which matters for the lobby groups every socket joins.
+    It's opt-in with the CONNECT4_LOBBY_RELAY setting.
+'''
+import asyncio
+import logging
+from django.conf import settings
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+class GroupRelay():
+    ''' relays groups' messages from the channel layer to the consumers in this process
+        Consumers join with add(group, consumer) instead of the channel layer's group_add,
+        and get group messages through their dispatch, like messages on their own channel
+    '''
+
+    # seconds between joining the groups again, so they don't expire from the channel layer
+    REFRESH = 3600
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # group: set of consumers
+        self._consumers = {}
+        # group: (relay channel, reader task, refresh task)
+        self._relays = {}
+        # joining and leaving the channel layer groups waits, so a group can't be joined twice
+        self._lock = asyncio.Lock()
+
+    def consumers(self, group):
+        ''' returns the consumers in the group, in this process '''
+        return set(self._consumers.get(group, ()))
+
+    async def add(self, group, consumer):
+        ''' adds the consumer to the group, the first one joins the process to the group '''
+        async with self._lock:
+            self._consumers.setdefault(group, set()).add(consumer)
+            if group not in self._relays:
+                channel = await self.channel_layer.new_channel('relay')
+                await self.channel_layer.group_add(group, channel)
+                self._relays[group] = (channel,
+                    asyncio.ensure_future(self._read(group, channel)),
+                    asyncio.ensure_future(self._refresh(group, channel)))
+                logger.info('Relaying group %s on %s' % (group, channel))
+
+    async def discard(self, group, consumer):
+        ''' removes the consumer from the group, the last one leaves the group '''
+        async with self._lock:
+            consumers = self._consumers.get(group)
+            if consumers is None:
+                return
+            consumers.discard(consumer)
+            if not consumers:
+                del self._consumers[group]
+                (channel, reader, refresher) = self._relays.pop(group)
+                reader.cancel()
+                refresher.cancel()
+                await asyncio.wait([reader, refresher])
+                await self.channel_layer.group_discard(group, channel)
+                logger.info('Stopped relaying group %s on %s' % (group, channel))
+
+    async def _read(self, group, channel):
+        ''' hands each message on the relay channel to the group's consumers '''
+        while True:
+            message = await self.channel_layer.receive(channel)
+            for consumer in self.consumers(group):
+                try:
+                    await consumer.dispatch(message)
+                except Exception:
+                    # one broken socket mustn't stop the others getting the message
+                    logger.exception('Relaying %s to %s failed' % (message.get('type'), consumer))
+
+    async def _refresh(self, group, channel):
+        while True:
+            await asyncio.sleep(self.REFRESH)
+            await self.channel_layer.group_add(group, channel)
+
+
+_lobby_relay = None
+
+
+def lobby_relay():
+    ''' returns the process's relay for the lobby groups, or None if the relay is off '''
+    global _lobby_relay
+    if not settings.CONNECT4_LOBBY_RELAY:
+        return None
+    if _lobby_relay is None:
+        _lobby_relay = GroupRelay(get_channel_layer())
+    return _lobby_relay
@@ -35,9 +35,15 @@ def join_game(request, pk):
 
 @login_required
 def make_move(request, pk, column):
-    ''' makes a move for the current player and updates the game '''
+    ''' makes a move for the current player and updates the game
+        the optional ply query parameter is the number of moves the client saw, stale moves are rejected
+    '''
     game = get_object_or_404(Game, pk = pk)
-    response = game.make_move(request.user.userplayer, column)
+    try:
+        ply = int(request.GET['ply']) if 'ply' in request.GET else None
+    except ValueError:
+        raise Http404('Invalid ply')
+    response = game.make_move(request.user.userplayer, column, ply)
     if response:
         PlayConsumer.send_play_update(game)
         if game.status == Game.Status.FINISHED.value:
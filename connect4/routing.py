@@ -1,13 +1,16 @@
 
 from django.urls import path
-from . import consumers
+from . import consumers, sharding
 
 urlpatterns = [    
     path('games/', consumers.GamesConsumer),
     path('play/<int:pk>/', consumers.PlayConsumer),
+    path('stream/', consumers.StreamConsumer),
 ]
 
 channel_names = {
     "game-seed" : consumers.GameSeedConsumer,
-    "game-player" : consumers.GamePlayerConsumer,
+    consumers.GamesListConsumer.CHANNEL : consumers.GamesListConsumer,
 }
+# one game player channel per shard
+channel_names.update((channel, consumers.GamePlayerConsumer) for channel in sharding.shard_channels())
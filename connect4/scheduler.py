@@ -0,0 +1,80 @@
+''' Delayed jobs on the event loop, for the seed consumer's seeding and joining
+
+    Jobs are keys, like ('join', game id), in a heap ordered by when they're due, run by one task
+    that sleeps until the earliest job.  A key is scheduled once at a time, and each job is a heap entry
+    and a dictionary entry, so thousands of pending jobs don't need thousands of loop timers.
+'''
+import asyncio
+import heapq
+import logging
+from itertools import count
+
+logger = logging.getLogger(__name__)
+
+
+class JobScheduler():
+    ''' runs handler(key) for each scheduled key when it's due, one job at a time '''
+
+    def __init__(self, handler):
+        self.handler = handler
+        # (due, sequence, key), cancelled jobs stay in the heap until they're due, and are skipped then
+        self._heap = []
+        # key: sequence of its heap entry
+        self._jobs = {}
+        self._sequence = count()
+        self._wake = asyncio.Event()
+        self._runner = None
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def schedule(self, key, delay):
+        ''' schedules the job in delay seconds, unless it's already scheduled, returns True if it was added '''
+        if key in self._jobs:
+            return False
+        due = asyncio.get_event_loop().time() + delay
+        sequence = next(self._sequence)
+        if not self._heap or due < self._heap[0][0]:
+            # the runner is sleeping until a later job
+            self._wake.set()
+        heapq.heappush(self._heap, (due, sequence, key))
+        self._jobs[key] = sequence
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run())
+        return True
+
+    def cancel(self, key):
+        ''' cancels the job if it's scheduled '''
+        self._jobs.pop(key, None)
+
+    def stop(self):
+        ''' cancels every job, and the runner '''
+        self._jobs.clear()
+        self._heap.clear()
+        if self._runner:
+            self._runner.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while self._heap:
+            (due, sequence, key) = self._heap[0]
+            if self._jobs.get(key) != sequence:
+                heapq.heappop(self._heap)
+                continue
+            wait = due - loop.time()
+            if wait > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            del self._jobs[key]
+            try:
+                await self.handler(key)
+            except Exception:
+                logger.exception('Job %s failed' % (key,))
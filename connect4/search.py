@@ -0,0 +1,299 @@
+''' Game tree search for the computer players
+
+    Negamax with alpha-beta pruning over engine positions, searched with iterative deepening,
+    so there is always a best move from the last completed depth when the time or node budget runs out.
+    An optional transposition table saves searching the same positions again, across depths and games.
+    Late positions, with few empty cells, can be solved exactly by the Solver instead.
+'''
+from collections import OrderedDict
+import time
+from . import engine
+from .transposition import EXACT, LOWER, UPPER
+
+# score for a win, less the number of moves played, so faster wins score higher
+WIN_SCORE = 1000
+# any score beyond this is a forced win or loss
+WIN_THRESHOLD = WIN_SCORE - engine.CELLS - 1
+
+# centre columns first, they are part of the most lines, so give the earliest cutoffs
+MOVE_ORDER = sorted(range(engine.COLS), key = lambda col: abs(engine.COLS // 2 - col))
+
+# how often the budget is checked, in nodes
+CHECK_INTERVAL = 1024
+
+
+class SearchTimeout(Exception):
+    ''' raised inside the search when the budget is used up '''
+
+
+def outcome(score, ply):
+    ''' describes a proven score for the player to move at ply, returns (result, moves)
+        result is 'win', 'loss' or 'draw', moves is the number of moves until the game ends, None for a draw
+    '''
+    if score > WIN_THRESHOLD:
+        return ('win', WIN_SCORE - score - ply)
+    elif score < -WIN_THRESHOLD:
+        return ('loss', WIN_SCORE + score - ply)
+    return ('draw', None)
+
+
+def evaluate(position):
+    ''' heuristic score of a position for the player to move
+        open threats count for the most, then coins in the centre column
+    '''
+    mask = position.mask
+    player = position.player
+    me = position.boards[player]
+    them = position.boards[1 - player]
+    centre = engine.FULL & (((1 << engine.ROWS) - 1) << (engine.COLS // 2 * engine.H1))
+    return (4 * (engine.popcount(engine.threats(me, mask)) - engine.popcount(engine.threats(them, mask))) +
+            engine.popcount(me & centre) - engine.popcount(them & centre))
+
+
+class BudgetedSearch():
+    ''' base for searches with a time and node budget, nodes and elapsed describe the last search '''
+
+    def __init__(self, time_budget = None, node_budget = None, stop_event = None):
+        ''' time_budget is in seconds and node_budget in nodes, either can be None for no limit
+            stop_event is an optional threading or multiprocessing Event, to cancel the search from elsewhere
+        '''
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.stop_event = stop_event
+        self.nodes = 0
+        self.elapsed = 0.0
+        self._deadline = None
+        self._next_check = CHECK_INTERVAL
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.elapsed if self.elapsed else 0.0
+
+    def _start_budget(self, start):
+        ''' resets the counters and deadline for a search starting at the start time '''
+        self._deadline = start + self.time_budget if self.time_budget is not None else None
+        self.nodes = 0
+        self._next_check = CHECK_INTERVAL
+
+    def _check_budget(self):
+        ''' raises SearchTimeout when the time or nodes are used up '''
+        self._next_check = self.nodes + CHECK_INTERVAL
+        if self.node_budget is not None and self.nodes >= self.node_budget:
+            raise SearchTimeout()
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            raise SearchTimeout()
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise SearchTimeout()
+
+
+class Searcher(BudgetedSearch):
+    ''' Searches a position for the best move within a time and node budget
+        After a search, depth is the deepest search completed
+    '''
+
+    def __init__(self, time_budget = 1.0, node_budget = None, max_depth = engine.CELLS, table = None,
+                 stop_event = None, root_margin = 0):
+        ''' table is an optional TranspositionTable
+            root moves scoring within root_margin of the best are given exact scores in root_scores,
+            root_scores is column: score from the deepest search completed
+        '''
+        super().__init__(time_budget, node_budget, stop_event)
+        self.table = table
+        self.max_depth = max_depth
+        self.root_margin = root_margin
+        self.depth = 0
+        self.root_scores = {}
+
+    def search(self, position):
+        ''' returns (column, score) for the player to move, score is from their point of view
+            A copy of the position is searched, a timeout can leave it part way down the tree
+        '''
+        start = time.monotonic()
+        position = position.copy()
+        self._start_budget(start)
+        self.depth = 0
+        self.root_scores = {}
+        moves = [col for col in MOVE_ORDER if position.can_play(col)]
+        # take an immediate win, and don't bother searching a single choice
+        best = next(((col, WIN_SCORE - position.ply - 1) for col in moves if position.is_winning_move(col)), None)
+        if not best and len(moves) == 1:
+            best = (moves[0], 0)
+        if not best:
+            entry = self.table.probe(position) if self.table else None
+            if entry and entry[3] in moves:
+                moves.remove(entry[3])
+                moves.insert(0, entry[3])
+            best = (moves[0], 0)
+            for depth in range(1, min(self.max_depth, engine.CELLS - position.ply) + 1):
+                try:
+                    best = self._search_root(position, moves, depth)
+                except SearchTimeout:
+                    break
+                self.depth = depth
+                # search the best move first next time, it's the most likely to cause cutoffs
+                moves.remove(best[0])
+                moves.insert(0, best[0])
+                if abs(best[1]) > WIN_THRESHOLD:
+                    # the result is proven, deeper won't change it
+                    break
+        self.elapsed = time.monotonic() - start
+        return best
+
+    def _search_root(self, position, moves, depth):
+        ''' searches each root move to depth, returns (column, score) '''
+        alpha = -WIN_SCORE
+        best = None
+        scores = {}
+        for col in moves:
+            position.play(col)
+            score = -self._negamax(position, depth - 1, -WIN_SCORE, -(alpha - self.root_margin))
+            position.undo()
+            scores[col] = score
+            if best is None or score > best[1]:
+                best = (col, score)
+                alpha = max(alpha, score)
+        self.root_scores = scores
+        if self.table:
+            self.table.store(position, best[1], depth, EXACT, best[0])
+        return best
+
+    def _negamax(self, position, depth, alpha, beta):
+        ''' returns the score for the player to move, the opponent's last move wasn't a win '''
+        self.nodes += 1
+        if self.nodes >= self._next_check:
+            self._check_budget()
+        if position.ply == engine.CELLS:
+            return 0
+        playable = position.playable
+        # the player to move wins now if they can
+        if position.threats(position.player) & playable:
+            return WIN_SCORE - position.ply - 1
+        if depth == 0:
+            return evaluate(position)
+        # the player can't win sooner than their next turn, tighten the bounds
+        beta = min(beta, WIN_SCORE - position.ply - 3)
+        if alpha >= beta:
+            return beta
+        moves = MOVE_ORDER
+        if self.table:
+            entry = self.table.probe(position)
+            if entry:
+                (score, entry_depth, flag, move) = entry
+                if entry_depth >= depth:
+                    if flag == EXACT:
+                        return score
+                    elif flag == LOWER:
+                        alpha = max(alpha, score)
+                    else:
+                        beta = min(beta, score)
+                    if alpha >= beta:
+                        return score
+                if move is not None:
+                    # the stored best move first
+                    moves = [move] + [col for col in MOVE_ORDER if col != move]
+        original_alpha = alpha
+        best = -WIN_SCORE
+        best_move = None
+        for col in moves:
+            if position.can_play(col):
+                position.play(col)
+                score = -self._negamax(position, depth - 1, -beta, -alpha)
+                position.undo()
+                if score > best:
+                    best = score
+                    best_move = col
+                    if score > alpha:
+                        alpha = score
+                        if alpha >= beta:
+                            break
+        if self.table:
+            flag = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+            self.table.store(position, best, depth, flag, best_move)
+        return best
+
+
+class Solver(BudgetedSearch):
+    ''' Exact solver for late positions, finds the perfect move and the proven result
+
+        Solved positions are kept in a bounded least recently used cache of (lower, upper) score bounds,
+        keyed by canonical key, which is kept between solves, so each move reuses the last move's work.
+        A time or node budget still applies, for positions that turn out to be too big to solve.
+    '''
+
+    def __init__(self, cache_size = 2 ** 18, time_budget = None, node_budget = None):
+        ''' cache_size is the number of positions kept '''
+        super().__init__(time_budget, node_budget)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def solve(self, position):
+        ''' returns (column, score) with the exact score for the player to move, see outcome
+            raises SearchTimeout if the budget runs out first
+        '''
+        start = time.monotonic()
+        position = position.copy()
+        self._start_budget(start)
+        try:
+            moves = [col for col in MOVE_ORDER if position.can_play(col)]
+            best = next(((col, WIN_SCORE - position.ply - 1) for col in moves if position.is_winning_move(col)), None)
+            if not best:
+                for col in moves:
+                    position.play(col)
+                    score = -self._negamax(position, -WIN_SCORE, WIN_SCORE if best is None else -best[1])
+                    position.undo()
+                    if best is None or score > best[1]:
+                        best = (col, score)
+            return best
+        finally:
+            self.elapsed = time.monotonic() - start
+
+    def _negamax(self, position, alpha, beta):
+        ''' returns the exact score for the player to move within the alpha beta window '''
+        self.nodes += 1
+        if self.nodes >= self._next_check:
+            self._check_budget()
+        if position.ply == engine.CELLS:
+            return 0
+        if position.threats(position.player) & position.playable:
+            return WIN_SCORE - position.ply - 1
+        # the player can't win before their next turn, or lose before the opponent's
+        beta = min(beta, WIN_SCORE - position.ply - 3)
+        alpha = max(alpha, -(WIN_SCORE - position.ply - 2))
+        if alpha >= beta:
+            return alpha
+        (key, mirrored) = position.canonical_key
+        bounds = self.cache.get(key)
+        if bounds:
+            self.cache.move_to_end(key)
+            (lower, upper) = bounds
+            if lower >= beta:
+                return lower
+            if upper <= alpha:
+                return upper
+            alpha = max(alpha, lower)
+            beta = min(beta, upper)
+        else:
+            (lower, upper) = (-WIN_SCORE, WIN_SCORE)
+        original_alpha = alpha
+        best = -WIN_SCORE
+        for col in MOVE_ORDER:
+            if position.can_play(col):
+                position.play(col)
+                score = -self._negamax(position, -beta, -alpha)
+                position.undo()
+                if score > best:
+                    best = score
+                    if score > alpha:
+                        alpha = score
+                        if alpha >= beta:
+                            break
+        if best <= original_alpha:
+            upper = min(upper, best)
+        elif best >= beta:
+            lower = max(lower, best)
+        else:
+            (lower, upper) = (best, best)
+        self.cache[key] = (lower, upper)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return best
@@ -0,0 +1,49 @@
+''' Partitions the games with computer players across the game player shard channels
+
+    Each game player worker runs one shard channel, game-player.<n>, for n up to CONNECT4_PLAYER_SHARDS.
+    A game's shard comes from a consistent hash ring of the live shards, so adding a shard only moves
+    its share of the games, and a shard dying only moves its own games to the others.
+'''
+import bisect
+import hashlib
+from django.conf import settings
+from .models import PlayerShard
+
+SHARD_CHANNEL = 'game-player.%d'
+
+
+def shard_channels():
+    ''' returns the channel names of every configured shard '''
+    return [SHARD_CHANNEL % shard for shard in range(settings.CONNECT4_PLAYER_SHARDS)]
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing():
+    ''' consistent hash ring of shard channels, each shard has POINTS points on the ring, so games spread evenly '''
+
+    POINTS = 64
+
+    def __init__(self, shards):
+        self._points = sorted((_hash('%s#%d' % (shard, point)), shard)
+                              for shard in shards for point in range(self.POINTS))
+        self._hashes = [point_hash for (point_hash, _) in self._points]
+
+    def shard(self, game_id):
+        ''' returns the shard for the game, the first point clockwise from the game's hash '''
+        index = bisect.bisect(self._hashes, _hash(str(game_id))) % len(self._points)
+        return self._points[index][1]
+
+
+def live_shards(since):
+    ''' returns the shard channels with a heartbeat since the time '''
+    return sorted(PlayerShard.objects.filter(heartbeat__gte = since).values_list('channel', flat = True))
+
+
+def owner(game_id, since):
+    ''' returns the shard channel for the game, from the shards live since the time,
+        or from the configured shards if none are live yet, so the first game wakes its shard
+    '''
+    return HashRing(live_shards(since) or shard_channels()).shard(game_id)
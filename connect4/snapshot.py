@@ -0,0 +1,83 @@
+from django.utils.functional import cached_property
+from .models import Game, UserPlayer, ComputerPlayer, describe_move
+
+
+class GameSnapshot():
+    ''' Read only view of a game, loaded once per request or consumer message
+
+        The players are resolved to their polymorphic types with a query per player type,
+        and the coins are fetched with one query, when first needed.
+        Any other Game attribute or property is read from the game once and memoized,
+        so templates can use the snapshot in place of the game without repeating queries.
+    '''
+
+    def __init__(self, game):
+        self.game = game
+        self._resolve_players()
+
+    @classmethod
+    def load(cls, pk):
+        ''' loads the game for the snapshot, raises Game.DoesNotExist '''
+        return cls(Game.objects.get(pk = pk))
+
+    def _resolve_players(self):
+        ''' loads both players as their real types, and caches them on the game '''
+        self.resolve_players([self.game])
+
+    @staticmethod
+    def resolve_players(games):
+        ''' loads the players of the games as their real types, and caches them on the games,
+            with a query per player type, however many games there are
+        '''
+        ids = {pk for game in games for pk in (game.player1_id, game.player2_id) if pk}
+        players = {player.pk : player for player in UserPlayer.objects.select_related('user').filter(pk__in = ids)}
+        if len(players) < len(ids):
+            players.update((player.pk, player) for player in ComputerPlayer.objects.filter(pk__in = ids))
+        for game in games:
+            game.player1 = players.get(game.player1_id)
+            if game.player2_id:
+                game.player2 = players.get(game.player2_id)
+
+    def __getattr__(self, name):
+        ''' reads anything else from the game, and memoizes it for the rest of the snapshot '''
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(self.game, name)
+        setattr(self, name, value)
+        return value
+
+    @cached_property
+    def coins(self):
+        ''' the moves of the game in order, with their game and player already loaded '''
+        coins = list(self.game.coin_set.order_by('ply'))
+        for coin in coins:
+            coin.game = self.game
+            coin.player = self.game.player1 if coin.player_id == self.game.player1_id else self.game.player2
+        return coins
+
+    @cached_property
+    def last_move(self):
+        ''' the last coin played, from the coins '''
+        return self.coins[-1] if self.coins else None
+
+    @cached_property
+    def move_list(self):
+        ''' the moves list text for each coin, from the coins, the last one says if it won or drew '''
+        names = {self.game.player1_id : self.player1_name, self.game.player2_id : self.player2_name}
+        draw = self.is_draw
+        last = self.last_move
+        return [describe_move(names[coin.player_id], coin.column, coin.row,
+                              coin is last and coin.winner, coin is last and draw)
+                for coin in self.coins]
+
+    @cached_property
+    def _build_board(self):
+        return self.game._build_board
+
+    @cached_property
+    def board(self):
+        return self._build_board[0]
+
+    @cached_property
+    def col_full(self):
+        return self._build_board[1]
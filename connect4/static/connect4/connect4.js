@@ -2,14 +2,82 @@
 const board_rows = 6;
 const board_columns = 7
 
+function stream_socket_url(url) {
+    var ws_scheme = window.location.protocol == "https:" ? "wss" : "ws";
+    return ws_scheme + '://' + window.location.host + "/connect4ws/" + url;
+}
+
 function connect_socket(url) {
     console.log('Connecting to socket ' + url);
 
-    var ws_scheme = window.location.protocol == "https:" ? "wss" : "ws";
-    var chat_socket = new ReconnectingWebSocket(ws_scheme + '://' + window.location.host + "/connect4ws/" + url);
+    var chat_socket = new ReconnectingWebSocket(stream_socket_url(url));
     return chat_socket
 }
 
+// the stream is the page's one connection, multiplexing the lobby lists and games
+// with a shared worker every tab shares one websocket, otherwise the page has its own
+const stream_worker_url = document.currentScript.src.replace(/connect4\.js.*$/, 'stream_worker.js');
+var stream_send;
+var stream_handlers = [];
+var stream_subscriptions = [];
+
+function connect_stream() {
+    if(window.SharedWorker) {
+        var worker = new SharedWorker(stream_worker_url);
+        worker.port.onmessage = (event) => stream_receive(event.data);
+        worker.port.start();
+        worker.port.postMessage({action: 'connect', url: stream_socket_url('stream/')});
+        stream_send = (content) => worker.port.postMessage(content);
+        // tell the worker to drop this tab's subscriptions
+        $(window).on('pagehide', () => stream_send({action: 'close'}));
+    }
+    else {
+        var socket = connect_socket('stream/');
+        var waiting = [];
+        socket.onmessage = (message) => stream_receive(JSON.parse(message.data));
+        socket.onopen = () => {
+            // subscribe again after reconnecting, then send what waited for the connection
+            stream_subscriptions.forEach((content) => socket.send(JSON.stringify(content)));
+            waiting.splice(0).forEach((content) => socket.send(JSON.stringify(content)));
+        };
+        stream_send = (content) => {
+            if(socket.readyState == WebSocket.OPEN) {
+                socket.send(JSON.stringify(content));
+            } else if(content.action != 'subscribe') {
+                waiting.push(content);
+            }
+        };
+    }
+}
+
+function stream_receive(data) {
+    console.log('Got stream message: ' + data.type);
+    stream_handlers.forEach((handler) => handler(data));
+}
+
+// calls handler with every message on the stream
+function on_stream(handler) {
+    if(!stream_send) {
+        connect_stream();
+    }
+    stream_handlers.push(handler);
+}
+
+// subscribes to the lobby lists, {stream: 'lists'}, or a game, {stream: 'game', game: pk}
+function stream_subscribe(stream) {
+    if(!stream_send) {
+        connect_stream();
+    }
+    var content = Object.assign({action: 'subscribe'}, stream);
+    stream_subscriptions.push(content);
+    stream_send(content);
+}
+
+// sends a play command, the game is in the command
+function stream_command(content) {
+    stream_send(content);
+}
+
 // helper to turn setTimeout into a Promise
 var wait = ms => new Promise(resolve => setTimeout(resolve, ms));
 
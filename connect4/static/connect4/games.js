@@ -1,4 +1,7 @@
 
+// last update version applied to each list
+var list_versions = {};
+
 function get_games_list(list) {
     http_get('/connect4/' + list).then((data) => {
         console.log('Replacing ' + list);
@@ -6,6 +9,38 @@ function get_games_list(list) {
     });
 }
 
+function games_list_entry(game) {
+    return $('<li class="gamelist"></li>').attr('id', game.id).append(
+        $('<a class="gamelist"></a>').attr('href', '/connect4/play/' + game.id).text(game.text));
+}
+
+function apply_games_update(data) {
+    // a missed update, or a list without its html yet, needs the whole list
+    var list = data.list;
+    var version = list_versions[list];
+    list_versions[list] = data.version;
+    var entries = $('#' + list + ' ul.gamelist');
+    if(!entries.length || (version !== undefined && data.version != version + 1)) {
+        get_games_list(list);
+        return;
+    }
+    var entry = (id) => entries.children('li[id="' + id + '"]');
+    data.removed.forEach((id) => entry(id).remove());
+    data.added.concat(data.updated).forEach((game) => {
+        var found = entry(game.id);
+        if(found.length) {
+            found.replaceWith(games_list_entry(game));
+        } else {
+            entries.append(games_list_entry(game));
+        }
+    });
+    // appending in order moves each entry to the end, leaving them in order
+    data.order.forEach((id) => entries.append(entry(id)));
+    if(entries.children('li').length != data.order.length) {
+        get_games_list(list);
+    }
+}
+
 function create_game() {
     console.log('Creating game')
     http_get('/connect4/rester/create_game').then((data) => {
@@ -17,18 +52,12 @@ function create_game() {
 }
 
 $(document).ready(() => {
-    var socket = connect_socket('games/');
-    
-    socket.onmessage = (message) => {
-        var data = JSON.parse(message.data);
-
-        console.log('Got games socket: ' + data);
-        if('list' in data) {
-            var list = data['list'];
-
-            get_games_list(list);        
+    on_stream((data) => {
+        if(data.type == 'games.update') {
+            apply_games_update(data);
         }
-    };
+    });
+    stream_subscribe({stream: 'lists'});
 
     get_games_list('available_games');
     get_games_list('running_games');
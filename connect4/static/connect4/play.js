@@ -1,6 +1,11 @@
 
 var game_pk;
 var prompt_leave;
+var game_ply;
+// the user's player number in the game, 0 if they're watching
+var user_player;
+
+const game_running = 1;
 
 // loads the board
 function get_board() {
@@ -10,23 +15,61 @@ function get_board() {
     });
 }
 
-// sends a joingame request
+// adds the move from a play update to the board in place, or reloads the board if it can't
+function apply_update(data) {
+    var move = data.move;
+    if(!move || data.ply != game_ply + 1) {
+        // not the next move, like a join or a missed update
+        get_board();
+        return;
+    }
+    game_ply = data.ply;
+    // board rows are rendered top down
+    var cell = (row, column) => $('#row' + (board_rows - 1 - row) + 'col' + column);
+    cell(move.row, move.column).css('background', move.color).empty().append($('<span>').text(move.name));
+    if(move.row == board_rows - 1) {
+        $('#placetoken' + move.column).replaceWith($('<span class="columnfull">').text('Column Full'));
+    }
+    data.winners.forEach(([row, column]) => {
+        cell(row, column).removeClass('board').addClass('boardwinner');
+    });
+    $('#moveslist').append($('<li class="moveslist">').text(move.description));
+
+    if(data.status != game_running) {
+        // the game is over, reload for the result and the players' stats
+        get_board();
+        return;
+    }
+    var user_move = data.next_player == user_player;
+    $('.placecoin').css('visibility', user_move ? 'visible' : 'hidden');
+    $('#moveinfo').text(user_move ?
+        "It's your move.  Place a coin in your desired column." :
+        'Waiting for ' + data.next_move + ' to make a move.');
+}
+
+// sends a joingame request on the stream
 function join_game() {
     console.log('Joining join ' + game_pk);
-    http_get('/connect4/rester/join_game/' + game_pk + '/', (data) => {
-        console.log('Join result ' + data);
-        if(data) {
-            prompt_leave = true;
-        }
-    });
+    stream_command({action: 'join', game: game_pk});
 }
 
-// make a move in the game
+// make a move in the game, on the stream
 function make_move(column) {
     console.log('Making move in column ' + column);
-    http_get('/connect4/rester/make_move/' + game_pk + '/' + column + '/', (data) => {
-        console.log('Move result ' + data);
-    });
+    // send the ply the board was rendered at, so a stale or double click is rejected
+    stream_command({action: 'move', game: game_pk, column: column, ply: game_ply});
+}
+
+// handles the answer to a join or move
+function command_ack(data) {
+    console.log(data.action + ' result ' + data.ok + ', ply ' + data.ply);
+    if(data.ok && data.action == 'join') {
+        prompt_leave = true;
+    }
+    else if(!data.ok && data.ply != game_ply) {
+        // the move was stale, the board missed an update
+        get_board();
+    }
 }
 
 // called at page load to setup game
@@ -46,17 +89,18 @@ function play_game() {
             }
         });
 
-        // connect to websocket
-        var socket = connect_socket('play/' + game_pk + '/');
-
-        // wire up receive message
-        socket.onmessage = function(message) {
-            var data = JSON.parse(message.data);
-
-            console.log('Received message: ' + data);
+        // wire up receive message, the stream may carry other games too
+        on_stream((data) => {
+            if(data.game != game_pk) {
+                return;
+            }
             if(data.type == 'play.update') {
-                get_board();
+                apply_update(data);
             }
-        };
+            else if(data.type == 'play.ack') {
+                command_ack(data);
+            }
+        });
+        stream_subscribe({stream: 'game', game: game_pk});
     });
 }
@@ -0,0 +1,99 @@
+// shared worker holding one stream websocket for all of a client's tabs
+// tabs send subscribes, unsubscribes and play commands, and get the updates for their subscriptions
+// the server is subscribed while any tab is, and command acks go back to the tab that sent the command
+
+var socket = null;
+var socket_url = null;
+var reconnect_wait = 1000;
+// messages waiting for the socket to open
+var waiting = [];
+// stream key: set of ports subscribed, 'lists' or 'game:<pk>'
+var subscribers = {};
+// command id sent to the server: [port, the tab's command id]
+var commands = {};
+var next_command = 1;
+
+function stream_key(content) {
+    return content.stream == 'game' ? 'game:' + content.game : content.stream;
+}
+
+function subscribe_content(key, action) {
+    var [stream, game] = key.split(':');
+    return game === undefined ? {action: action, stream: stream} : {action: action, stream: stream, game: +game};
+}
+
+function send(content) {
+    if(socket && socket.readyState == WebSocket.OPEN) {
+        socket.send(JSON.stringify(content));
+    } else {
+        waiting.push(content);
+    }
+}
+
+function connect() {
+    socket = new WebSocket(socket_url);
+    socket.onopen = () => {
+        reconnect_wait = 1000;
+        // the server forgot the subscriptions with the old connection
+        var pending = waiting.splice(0).filter((content) => content.action != 'subscribe' && content.action != 'unsubscribe');
+        Object.keys(subscribers).forEach((key) => socket.send(JSON.stringify(subscribe_content(key, 'subscribe'))));
+        pending.forEach((content) => socket.send(JSON.stringify(content)));
+    };
+    socket.onmessage = (message) => receive(JSON.parse(message.data));
+    socket.onclose = () => {
+        setTimeout(connect, reconnect_wait);
+        reconnect_wait = Math.min(reconnect_wait * 2, 30000);
+    };
+}
+
+function receive(data) {
+    if(data.type == 'play.ack' || data.type == 'stream.ack') {
+        var command = commands[data.id];
+        if(command) {
+            delete commands[data.id];
+            command[0].postMessage(Object.assign({}, data, {id: command[1]}));
+        }
+        return;
+    }
+    var key = data.type == 'play.update' ? 'game:' + data.game : 'lists';
+    (subscribers[key] || new Set()).forEach((port) => port.postMessage(data));
+}
+
+function unsubscribe(port, key) {
+    var ports = subscribers[key];
+    if(ports && ports.delete(port) && !ports.size) {
+        delete subscribers[key];
+        send(subscribe_content(key, 'unsubscribe'));
+    }
+}
+
+function port_message(port, content) {
+    if(content.action == 'connect') {
+        if(!socket) {
+            socket_url = content.url;
+            connect();
+        }
+    } else if(content.action == 'close') {
+        Object.keys(subscribers).forEach((key) => unsubscribe(port, key));
+    } else if(content.action == 'subscribe') {
+        var key = stream_key(content);
+        if(!subscribers[key]) {
+            subscribers[key] = new Set();
+            send(subscribe_content(key, 'subscribe'));
+        }
+        subscribers[key].add(port);
+    } else if(content.action == 'unsubscribe') {
+        unsubscribe(port, stream_key(content));
+    } else {
+        // a play command, answered to this port only
+        var id = next_command++;
+        commands[id] = [port, content.id];
+        send(Object.assign({}, content, {id: id}));
+    }
+}
+
+onconnect = (event) => {
+    var port = event.ports[0];
+    port.onmessage = (message) => port_message(port, message.data);
+    port.start();
+};
@@ -1,44 +1,279 @@
 
+import logging
 import random
+from django.conf import settings
+from . import batch, engine, mcts, search
+from .book import OpeningBook
+from .learning import PatternStats
+from .models import STRATEGIES
+from .transposition import TranspositionTable
+
+logger = logging.getLogger(__name__)
+
+# the transposition table for all the searching strategies in this process, see transposition_table
+_transposition_table = None
+# the opening book, False if it couldn't be opened, see opening_book
+_opening_book = None
+# the endgame solver and its cache of solved positions, see endgame_solver
+_endgame_solver = None
+# the Monte Carlo search, with the trees kept between moves, see monte_carlo_search
+_monte_carlo_search = None
+# the learning strategy's pattern statistics, False if they couldn't be opened, see pattern_stats
+_pattern_stats = None
+# the think process's stop event, set when a move comes in to think about, so pondering stops, see set_stop_event
+_stop_event = None
+
+
+def transposition_table():
+    ''' returns the process wide transposition table, created on first use from the settings '''
+    global _transposition_table
+    if _transposition_table is None:
+        _transposition_table = TranspositionTable(
+            settings.CONNECT4_TRANSPOSITION_SIZE, settings.CONNECT4_TRANSPOSITION_PATH)
+    return _transposition_table
+
+
+def endgame_solver():
+    ''' returns the process wide endgame solver, so solved positions are reused by every game '''
+    global _endgame_solver
+    if _endgame_solver is None:
+        _endgame_solver = search.Solver(settings.CONNECT4_SOLVER_CACHE_SIZE)
+    return _endgame_solver
+
+
+def opening_book():
+    ''' returns the opening book, opened on first use from the settings, or None if there isn't one '''
+    global _opening_book
+    if _opening_book is None:
+        try:
+            _opening_book = OpeningBook(settings.CONNECT4_OPENING_BOOK)
+        except (OSError, ValueError) as e:
+            logger.warning('No opening book, searching all moves; %s' % e)
+            _opening_book = False
+    return _opening_book or None
+
+
+def monte_carlo_search():
+    ''' returns the process wide Monte Carlo search, so its trees are reused for the next move in each game
+        The game player thinks for a game in the same process every move, see GamePlayerConsumer.lane
+    '''
+    global _monte_carlo_search
+    if _monte_carlo_search is None:
+        _monte_carlo_search = mcts.MonteCarloSearch(trees = settings.CONNECT4_MONTE_CARLO_TREES)
+    return _monte_carlo_search
+
+
+def pattern_stats():
+    ''' returns the pattern statistics, opened on first use from the settings, or None if there aren't any '''
+    global _pattern_stats
+    if _pattern_stats is None:
+        try:
+            _pattern_stats = PatternStats(settings.CONNECT4_PATTERN_STATS)
+        except (OSError, ValueError) as e:
+            logger.warning('No pattern statistics, learning strategy plays like smart; %s' % e)
+            _pattern_stats = False
+    return _pattern_stats or None
+
+
+def strategy_class(strategy):
+    ''' returns the strategy class for a ComputerPlayer strategy number '''
+    return globals()['%sStrategy' % STRATEGIES[strategy]]
+
+
+def think(strategy, moves):
+    ''' chooses a column without a game or database, used to think in worker processes
+        strategy is a ComputerPlayer strategy number, moves is the Game moves string; returns the column
+    '''
+    return strategy_class(strategy)().choose_column(engine.Position(int(column) for column in moves))
+
+
+def set_stop_event(event):
+    ''' sets the stop event for pondering, think processes forked after this inherit it
+        The event is a multiprocessing.Event, it can't be passed to a process with its work
+    '''
+    global _stop_event
+    _stop_event = event
+
+
+def ponder(strategy, moves):
+    ''' searches the answers to the opponent's likely replies, the most likely first, used in worker processes
+        strategy is a ComputerPlayer strategy number, moves is the Game moves string after the strategy's move
+        returns {moves after the reply: column}, with the replies searched before the stop event was set
+    '''
+    player = strategy_class(strategy)()
+    position = engine.Position(int(column) for column in moves)
+    pondered = {}
+    for reply in player._likely_replies(position):
+        if _stop_event and _stop_event.is_set():
+            break
+        if position.is_winning_move(reply):
+            continue
+        position.play(reply)
+        column = player.choose_column(position.copy(), _stop_event)
+        position.undo()
+        if _stop_event and _stop_event.is_set():
+            # cut short, the answer may not be the best
+            break
+        pondered[moves + str(reply)] = column
+    logger.info('%s pondered %d replies after %s' % (player, len(pondered), moves))
+    return pondered
+
 
 class StrategyBase():
     ''' base class for game player strategies '''
 
-    def __init__(self, game, player):
-        ''' initializes the strategy with the game, and the player the strategy is playing '''
+    # strategies that ponder think about their answers to the opponent's likely replies during the opponent's turn
+    PONDER = False
+    # batched strategies choose moves for many games at once, with choose_columns
+    BATCHED = False
+
+    def __init__(self, game = None, player = None):
+        ''' initializes the strategy with the game, and the player the strategy is playing, both optional
+            The strategy chooses columns for engine positions, the game player commits them, see think
+        '''
         self.game = game
         self.player = player
 
-    def start(self):
-        ''' allows the strategy to start a work thread if needed '''
-        pass
-
-    def stop(self):
-        ''' tells the strategy to clean up '''
-        pass
+    def __str__(self):
+        return '%s for %s' % (self.__class__.__name__, self.player.get_short_name() if self.player else 'no player')
 
-    def reload_game(self):
-        ''' updates the game object from the database.  Necessary when playing a human, and game is updated in rester '''
-        self.game.refresh_from_db()
+    def _likely_replies(self, position):
+        ''' the opponent's replies, in the order to ponder them '''
+        return position.legal_moves()
 
-    def make_move(self):
-        ''' tells the strategy to make it's next move, should call Game.make_move and return result '''
+    def choose_column(self, position, stop_event = None):
+        ''' returns the column to play for the engine position, the player to move is this strategy
+            stop_event is an optional threading or multiprocessing Event to cut the thinking short
+        '''
         pass
 
+    @classmethod
+    def choose_columns(cls, positions):
+        ''' returns the columns to play for a list of positions, one at a time unless the strategy is BATCHED '''
+        return [cls().choose_column(position) for position in positions]
+
 
 class RandomStrategy(StrategyBase):
     ''' Implements a random strategy that just moves randomly '''
 
-    def make_move(self):
-        available_columns = [i for (i, col) in enumerate(self.game.col_full)]
-        column = random.choice(available_columns)
-        return self.game.make_move(self.player, column)
+    def choose_column(self, position, stop_event = None):
+        return random.choice(position.legal_moves())
 
 class DumbStrategy(RandomStrategy):
     ''' Dumb strategy only looks to current move to win or prevent win, or make an adjacent move '''
 
+    BATCHED = True
+
+    def choose_column(self, position, stop_event = None):
+        return batch.choose_columns([position])[0]
+
+    @classmethod
+    def choose_columns(cls, positions):
+        ''' scores the moves for all the positions in one pass, see batch '''
+        return batch.choose_columns(positions)
+
 class SmartStrategy(RandomStrategy):
     ''' Smart strategy build a scored depth search of possible moves then chooses the best it has so far '''
 
+    # per move budget, seconds and nodes, None for no limit
+    TIME_BUDGET = 1.0
+    NODE_BUDGET = None
+    # positions with this many empty cells or fewer are solved exactly
+    SOLVE_EMPTY = 14
+    PONDER = True
+    # root moves scoring within this of the best get exact scores, for _choose_searched
+    MARGIN = 0
+
+    def choose_column(self, position, stop_event = None):
+        book = opening_book()
+        entry = book.lookup(position) if book else None
+        if entry and position.can_play(entry[0]):
+            logger.info('%s played column %d from the opening book, scored %d' % (self, entry[0], entry[1]))
+            return entry[0]
+        if engine.CELLS - position.ply <= self.SOLVE_EMPTY:
+            solver = endgame_solver()
+            (solver.time_budget, solver.node_budget, solver.stop_event) = (
+                self.TIME_BUDGET, self.NODE_BUDGET, stop_event)
+            try:
+                (column, score) = solver.solve(position)
+            except search.SearchTimeout:
+                logger.info('%s ran out of time solving, searching instead' % self)
+            else:
+                logger.info('%s solved column %d, %s; %d nodes in %.2fs' % (
+                    self, column, search.outcome(score, position.ply), solver.nodes, solver.elapsed))
+                return column
+        table = transposition_table()
+        searcher = search.Searcher(time_budget = self.TIME_BUDGET, node_budget = self.NODE_BUDGET, table = table,
+            stop_event = stop_event, root_margin = self.MARGIN)
+        (column, score) = searcher.search(position)
+        logger.info('%s searched to depth %d; %d nodes in %.2fs, %d nodes/sec; column %d scored %d; '
+            'table hit rate %.2f' % (
+            self, searcher.depth, searcher.nodes, searcher.elapsed, searcher.nodes_per_second,
+            column, score, table.hit_rate))
+        return self._choose_searched(position, searcher, column, score)
+
+    def _choose_searched(self, position, searcher, column, score):
+        ''' returns the column to play after a search, the searched best column '''
+        return column
+
+    def _likely_replies(self, position):
+        ''' the reply from the last search first, then the centre columns '''
+        entry = transposition_table().probe(position)
+        replies = [col for col in search.MOVE_ORDER if position.can_play(col)]
+        if entry and entry[3] in replies:
+            replies.remove(entry[3])
+            replies.insert(0, entry[3])
+        return replies
+
 class LearningStrategy(SmartStrategy):
-    ''' Learning strategy expands on smart strategy to adjust scoring based on previous history '''
+    ''' Learning strategy expands on smart strategy to adjust scoring based on previous history
+
+        Moves the search scores close to the best are compared by how the games through
+        the position after the move went, from the pattern statistics.
+    '''
+
+    MARGIN = 4
+    # score points for a move that always won, against one that won half the time
+    WEIGHT = 8
+    # positions need this many games before their history counts
+    MIN_GAMES = 3
+
+    def _choose_searched(self, position, searcher, column, score):
+        stats = pattern_stats()
+        if not stats or abs(score) > search.WIN_THRESHOLD:
+            return column
+        best = None
+        for (col, col_score) in searcher.root_scores.items():
+            if col_score < score - self.MARGIN:
+                continue
+            position.play(col)
+            entry = stats.lookup(position)
+            position.undo()
+            if entry and entry[0] >= self.MIN_GAMES:
+                # points are 2 per win, so the win rate is points / (2 * games)
+                col_score += 2 * self.WEIGHT * (entry[1] / (2 * entry[0]) - 0.5)
+            if best is None or col_score > best[0]:
+                best = (col_score, col)
+        if not best:
+            return column
+        if best[1] != column:
+            logger.info('%s chose column %d over %d from history' % (self, best[1], column))
+        return best[1]
+
+
+class MonteCarloStrategy(RandomStrategy):
+    ''' Monte Carlo strategy grows a search tree scored by random playouts, for as long as it has to think '''
+
+    # per move budget, seconds, and playouts; None for no limit
+    TIME_BUDGET = 1.0
+    NODE_BUDGET = None
+
+    def choose_column(self, position, stop_event = None):
+        searcher = monte_carlo_search()
+        (searcher.time_budget, searcher.node_budget, searcher.stop_event) = (
+            self.TIME_BUDGET, self.NODE_BUDGET, stop_event)
+        (column, win_rate) = searcher.search(position)
+        logger.info('%s ran %d playouts in %.2fs, %d playouts/sec, %d reused; column %d win rate %.2f' % (
+            self, searcher.nodes, searcher.elapsed, searcher.nodes_per_second, searcher.reused,
+            column, win_rate))
+        return column
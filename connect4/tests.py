@@ -1,3 +1,1120 @@
-from django.test import TestCase
+import asyncio
+from collections import OrderedDict
+import datetime
+import io
+import os
+import random
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import numpy
+from . import batch, benchmark, book, engine, learning, lists, relay, routing, search, sharding, strategies, tournament
+from .consumers import GamePlayerConsumer, GamesListConsumer, PlayConsumer, StreamConsumer
+from .scheduler import JobScheduler
+from .models import Coin, ComputerPlayer, Game, GameLease, Player, PlayerShard
+from .snapshot import GameSnapshot
+from .transposition import EXACT, LOWER, TranspositionTable
 
-# Create your tests here.
+
+# the (row, column) steps of each line direction; vertical, horizontal, and the two diagonals
+LINE_STEPS = ((1, 0), (0, 1), (-1, 1), (1, 1))
+
+
+def naive_lines():
+    ''' returns every line of four cells on the board, as lists of (row, column) '''
+    lines = []
+    for row in range(engine.ROWS):
+        for column in range(engine.COLS):
+            for (row_step, column_step) in LINE_STEPS:
+                line = [(row + i * row_step, column + i * column_step) for i in range(4)]
+                if all(0 <= r < engine.ROWS and 0 <= c < engine.COLS for (r, c) in line):
+                    lines.append(line)
+    return lines
+
+
+def naive_has_four(board):
+    return any(all(board & engine.bit(*cell) for cell in line) for line in naive_lines())
+
+
+class EngineTests(SimpleTestCase):
+
+    def setUp(self):
+        self.random = random.Random(4)
+
+    def random_game(self):
+        ''' returns a position from random moves, up to a win or a full board '''
+        position = engine.Position()
+        while not position.is_full:
+            column = self.random.choice(position.legal_moves())
+            position.play(column)
+            if position.is_winner(1 - position.player):
+                break
+        return position
+
+    def state(self, position):
+        return (list(position.boards), list(position.heights), position.ply, position.key, position.mirror_key)
+
+    def test_play_and_undo(self):
+        position = engine.Position([3, 3, 4])
+        before = self.state(position)
+        self.assertEqual(position.play(3), 2)
+        self.assertEqual(position.last_move, (2, 3))
+        self.assertEqual((position.ply, position.player), (4, 0))
+        self.assertEqual(position.undo(), 3)
+        self.assertEqual(self.state(position), before)
+        self.assertEqual(position.history, [3, 3, 4])
+
+    def test_col_full(self):
+        position = engine.Position([2] * engine.ROWS)
+        self.assertFalse(position.can_play(2))
+        self.assertFalse(position.can_play(-1))
+        self.assertFalse(position.can_play(engine.COLS))
+        self.assertEqual(position.col_full(), [column == 2 for column in range(engine.COLS)])
+        self.assertNotIn(2, position.legal_moves())
+
+    def test_from_board(self):
+        for _ in range(20):
+            position = self.random_game()
+            board = position.to_board(('#000000', '#FF0000'))
+            self.assertEqual(self.state(engine.Position.from_board(board)), self.state(position))
+
+    def test_has_four_matches_board_scan(self):
+        for _ in range(500):
+            board = self.random.getrandbits(64) & self.random.getrandbits(64) & engine.FULL
+            self.assertEqual(engine.has_four(board), naive_has_four(board))
+
+    def test_threats_match_board_scan(self):
+        for _ in range(50):
+            position = self.random_game()
+            if not position.is_full:
+                position.undo()
+            for player in range(2):
+                board = position.boards[player]
+                expected = 0
+                for (row, column) in engine.cells(engine.FULL ^ position.mask):
+                    if naive_has_four(board | engine.bit(row, column)):
+                        expected |= engine.bit(row, column)
+                self.assertEqual(position.threats(player), expected)
+
+    def test_zobrist_keys(self):
+        for _ in range(20):
+            position = self.random_game()
+            key = mirror_key = engine.ZOBRIST_EMPTY
+            for player in range(2):
+                for (row, column) in engine.cells(position.boards[player]):
+                    key ^= engine.ZOBRIST[player][column * engine.H1 + row]
+                    mirror_key ^= engine.ZOBRIST[player][(engine.COLS - 1 - column) * engine.H1 + row]
+            self.assertEqual((position.key, position.mirror_key), (key, mirror_key))
+            mirrored = engine.Position(engine.COLS - 1 - column for column in position.history)
+            self.assertEqual((mirrored.key, mirrored.mirror_key), (mirror_key, key))
+            self.assertEqual(mirrored.canonical_key[0], position.canonical_key[0])
+        # the same coins in another order are the same position
+        self.assertEqual(engine.Position([3, 4, 2]).key, engine.Position([2, 4, 3]).key)
+        self.assertNotEqual(engine.Position([3, 4]).key, engine.Position([4, 3]).key)
+
+    def test_winning_cells_are_the_four(self):
+        for _ in range(200):
+            position = self.random_game()
+            (row, column) = position.last_move
+            board = position.boards[1 - position.player]
+            winners = position.winning_cells(row, column)
+            through = [line for line in naive_lines() if (row, column) in line and
+                       all(board & engine.bit(*cell) for cell in line)]
+            if through:
+                self.assertIn(sorted(winners), [sorted(line) for line in through])
+            else:
+                self.assertEqual(winners, [])
+
+    def test_longer_lines_give_four(self):
+        # player 1 fills the bottom row 0, 1, 2, 4, 5 then 3 makes a line of six with 6 empty
+        position = engine.Position([0, 0, 1, 1, 2, 2, 4, 4, 5, 5, 3])
+        self.assertEqual(position.winning_cells(0, 3), [(0, 0), (0, 1), (0, 2), (0, 3)])
+        # a coin completing a column and a row marks one line, the column is the first direction
+        board = sum(engine.bit(*cell) for cell in ((0, 0), (0, 1), (0, 2), (0, 3), (1, 3), (2, 3), (3, 3)))
+        self.assertEqual(engine.cells(engine.winning_line(board, 0, 3)), [(0, 3), (1, 3), (2, 3), (3, 3)])
+        self.assertEqual(engine.winning_line(board, 1, 3) & engine.bit(0, 0), 0)
+        # the middle of a line of seven
+        board = sum(engine.bit(0, column) for column in range(engine.COLS))
+        self.assertEqual(engine.cells(engine.winning_line(board, 0, 5)), [(0, 2), (0, 3), (0, 4), (0, 5)])
+
+
+# player 1 has three in column 0, and it's their move
+WIN_MOVES = [0, 6, 0, 6, 0, 6]
+# player 1 has three in column 0, and player 2 must block
+BLOCK_MOVES = [0, 6, 0, 6, 0]
+
+
+class SearcherTests(SimpleTestCase):
+
+    def test_searcher_wins_and_blocks(self):
+        for table in (None, TranspositionTable(2 ** 10)):
+            searcher = search.Searcher(time_budget = None, max_depth = 6, table = table)
+            (column, score) = searcher.search(engine.Position(WIN_MOVES))
+            self.assertEqual(column, 0)
+            self.assertEqual(search.outcome(score, len(WIN_MOVES)), ('win', 1))
+            self.assertEqual(searcher.search(engine.Position(BLOCK_MOVES))[0], 0)
+            # the mirror image blocks the mirrored column
+            self.assertEqual(searcher.search(engine.Position(6 - column for column in BLOCK_MOVES))[0], 6)
+
+
+class OpeningBookTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'book.bin')
+
+    def open_book(self):
+        opened = book.OpeningBook(self.path)
+        self.addCleanup(opened.close)
+        return opened
+
+    def test_write_and_lookup(self):
+        entries = {}
+        for (moves, column, score) in (([], 3, 1), ([0], 1, 5), ([3, 2], 4, -2)):
+            (key, mirrored) = engine.Position(moves).canonical_key
+            entries[key] = (engine.COLS - 1 - column if mirrored else column, score)
+        book.write(self.path, entries)
+        opened = self.open_book()
+        self.assertEqual(len(opened), 3)
+        self.assertEqual(opened.lookup(engine.Position()), (3, 1))
+        self.assertEqual(opened.lookup(engine.Position([0])), (1, 5))
+        self.assertEqual(opened.lookup(engine.Position([3, 2])), (4, -2))
+        # mirrored positions, with mirrored moves
+        self.assertEqual(opened.lookup(engine.Position([6])), (5, 5))
+        self.assertEqual(opened.lookup(engine.Position([3, 4])), (2, -2))
+        self.assertIsNone(opened.lookup(engine.Position([1])))
+
+    def test_built_book_covers_replies(self):
+        entries = book.build(3, 0.01)
+        book.write(self.path, entries)
+        opened = self.open_book()
+        self.assertEqual(len(opened), len(entries))
+        (first, _) = opened.lookup(engine.Position())
+        # the book player moving first, then second, answers every reply
+        for reply in range(engine.COLS):
+            self.assertIsNotNone(opened.lookup(engine.Position([first, reply])))
+            self.assertIsNotNone(opened.lookup(engine.Position([reply])))
+
+    def test_not_a_book(self):
+        with open(self.path, 'wb') as book_file:
+            book_file.write(b'not a book')
+        with self.assertRaises(ValueError):
+            book.OpeningBook(self.path)
+
+
+def naive_score(position):
+    ''' returns the exact score for the player to move by searching every move, scored like search.Solver '''
+    moves = position.legal_moves()
+    if any(position.is_winning_move(column) for column in moves):
+        return search.WIN_SCORE - position.ply - 1
+    best = 0 if not moves else None
+    for column in moves:
+        position.play(column)
+        score = -naive_score(position)
+        position.undo()
+        best = score if best is None else max(best, score)
+    return best
+
+
+class SolverTests(SimpleTestCase):
+
+    def test_solver_matches_full_search(self):
+        solver = search.Solver()
+        rng = random.Random(9)
+        positions = [engine.Position(int(column) for column in GameMoveTests.DRAW[:ply]) for ply in (32, 33, 34)]
+        while len(positions) < 12:
+            position = engine.Position()
+            while position.ply < 34 and not position.is_full:
+                moves = [column for column in position.legal_moves() if not position.is_winning_move(column)]
+                if not moves:
+                    break
+                position.play(rng.choice(moves))
+            # without a win to take, so the solver has to search
+            if position.ply == 34 and not any(position.is_winning_move(column) for column in position.legal_moves()):
+                positions.append(position)
+        for position in positions:
+            (column, score) = solver.solve(position)
+            expected = naive_score(position.copy())
+            self.assertEqual(search.outcome(score, position.ply), search.outcome(expected, position.ply))
+            # the solver takes a win, blocks the opponent's only win, and its move gets the score
+            wins = [move for move in position.legal_moves() if position.is_winning_move(move)]
+            blocks = engine.cells(position.threats(1 - position.player) & position.playable)
+            if wins:
+                self.assertIn(column, wins)
+                continue
+            if len(blocks) == 1:
+                self.assertEqual(column, blocks[0][1])
+            position.play(column)
+            self.assertEqual(-naive_score(position), expected)
+
+    def test_outcome(self):
+        self.assertEqual(search.outcome(search.WIN_SCORE - 11, 8), ('win', 3))
+        self.assertEqual(search.outcome(-(search.WIN_SCORE - 12), 8), ('loss', 4))
+        self.assertEqual(search.outcome(3, 8), ('draw', None))
+
+
+class NoNoise():
+    ''' random source for batch without the tie breaking noise '''
+
+    def random_sample(self, shape):
+        return numpy.zeros(shape)
+
+
+class BatchTests(SimpleTestCase):
+
+    def test_wins_and_blocks(self):
+        positions = [engine.Position(WIN_MOVES), engine.Position(BLOCK_MOVES),
+                     engine.Position(6 - column for column in BLOCK_MOVES)]
+        self.assertEqual(batch.choose_columns(positions), [0, 0, 6])
+
+    def test_batch_matches_one_at_a_time(self):
+        rng = random.Random(12)
+        positions = []
+        while len(positions) < 200:
+            position = engine.Position()
+            for _ in range(rng.randrange(30)):
+                moves = [column for column in position.legal_moves() if not position.is_winning_move(column)]
+                if not moves:
+                    break
+                position.play(rng.choice(moves))
+            if position.legal_moves():
+                positions.append(position)
+        columns = batch.choose_columns(positions, NoNoise())
+        self.assertEqual(columns, [batch.choose_columns([position], NoNoise())[0] for position in positions])
+        for (position, column) in zip(positions, columns):
+            # the strategy takes a win, or blocks the opponent's only win
+            wins = [move for move in position.legal_moves() if position.is_winning_move(move)]
+            playable = engine.cells(position.threats(1 - position.player) & position.playable)
+            if wins:
+                self.assertIn(column, wins)
+            elif len(playable) == 1:
+                self.assertEqual(column, playable[0][1])
+
+
+class GameTestCase(TestCase):
+    ''' base test case with two user players '''
+
+    def setUp(self):
+        self.user1 = User.objects.create_user('player1', password = 'password1', first_name = 'One')
+        self.user2 = User.objects.create_user('player2', password = 'password2', first_name = 'Two')
+        self.player1 = self.user1.userplayer
+        self.player2 = self.user2.userplayer
+
+    def play_game(self, moves):
+        ''' creates a running game and plays the columns in moves, alternating players '''
+        game = Game.objects.create(player1 = self.player1)
+        game.join_up(self.player2)
+        for (ply, column) in enumerate(moves):
+            self.assertTrue(game.make_move(self.player1 if ply % 2 == 0 else self.player2, column))
+        return game
+
+
+class GameMoveTests(GameTestCase):
+    # fills the board without four in a row
+    DRAW = '146660203633536103043506522512202545444111'
+
+    def assertStats(self, player, wins, losses, draws):
+        player = Player.objects.get(pk = player.pk)
+        self.assertEqual((player.wins, player.losses, player.draws), (wins, losses, draws))
+
+    def test_stale_ply_rejected(self):
+        game = self.play_game([3])
+        self.assertFalse(game.make_move(self.player2, 3, 0))
+        self.assertTrue(game.make_move(self.player2, 3, 1))
+        game.refresh_from_db()
+        self.assertEqual((game.moves, game.ply, game.coin_set.count()), ('33', 2, 2))
+
+    def test_racing_moves_place_one_coin(self):
+        game = self.play_game([])
+        (first, second) = (Game.objects.get(pk = game.pk), Game.objects.get(pk = game.pk))
+        self.assertTrue(first.make_move(self.player1, 3, 0))
+        # the second instance still sees ply 0, the compare and swap on the game's ply rejects it
+        self.assertFalse(second.make_move(self.player1, 4, 0))
+        self.assertEqual(second.ply, 1)
+        game.refresh_from_db()
+        self.assertEqual((game.moves, game.ply, game.coin_set.count()), ('3', 1, 1))
+
+    def test_duplicate_coin_is_a_failed_move(self):
+        game = self.play_game([])
+        # a coin for the next ply, as if another move got past the game update
+        Coin.objects.create(game = game, player = self.player1, ply = 1, row = 5, column = 4)
+        self.assertFalse(game.make_move(self.player1, 3))
+        game.refresh_from_db()
+        self.assertEqual((game.moves, game.ply), ('', 0))
+        self.assertEqual(list(game.coin_set.values_list('column', flat = True)), [4])
+
+    def test_racing_joins(self):
+        game = Game.objects.create(player1 = self.player1)
+        computer = ComputerPlayer.objects.create(name = 'Computer', strategy = 1)
+        (first, second) = (Game.objects.get(pk = game.pk), Game.objects.get(pk = game.pk))
+        self.assertFalse(first.join_up(self.player1))
+        self.assertTrue(first.join_up(self.player2))
+        self.assertFalse(second.join_up(computer))
+        game.refresh_from_db()
+        self.assertEqual((game.player2_id, game.status), (self.player2.pk, Game.Status.RUNNING.value))
+
+    def test_win_marks_winners_and_stats(self):
+        game = self.play_game([0, 1, 0, 1, 0, 1, 0])
+        self.assertEqual((game.status, game.winner), (Game.Status.FINISHED.value, 1))
+        winners = game.coin_set.filter(winner = True)
+        self.assertEqual(sorted(winners.values_list('ply', flat = True)), [1, 3, 5, 7])
+        self.assertStats(self.player1, 1, 0, 0)
+        self.assertStats(self.player2, 0, 1, 0)
+        # the game is over
+        self.assertFalse(game.make_move(self.player2, 1))
+
+    def test_draw_stats(self):
+        game = self.play_game([int(column) for column in self.DRAW])
+        self.assertEqual((game.status, game.winner), (Game.Status.FINISHED.value, None))
+        self.assertFalse(game.coin_set.filter(winner = True).exists())
+        self.assertStats(self.player1, 0, 0, 1)
+        self.assertStats(self.player2, 0, 0, 1)
+
+    def stale(self, game):
+        ''' backdates the game's last move past the abandoned time '''
+        Game.objects.filter(pk = game.pk).update(last_move_date = timezone.now() - datetime.timedelta(hours = 2))
+
+    def test_abandon_stale(self):
+        game = self.play_game([3, 4])
+        self.stale(game)
+        Game.abandon_stale()
+        game.refresh_from_db()
+        self.assertEqual((game.status, game.moves, game.ply), (Game.Status.ABANDONED.value, '34', 2))
+        self.assertEqual([Player.objects.get(pk = player.pk).abandoned for player in (self.player1, self.player2)],
+                         [1, 1])
+        # an abandoned game isn't counted again
+        Game.abandon_stale()
+        self.assertEqual(Player.objects.get(pk = self.player1.pk).abandoned, 1)
+
+    def test_move_beats_abandoning(self):
+        game = self.play_game([3])
+        self.stale(game)
+        def move_first():
+            # the move comes in after the clean up read the game
+            self.assertTrue(Game.objects.get(pk = game.pk).make_move(self.player2, 4))
+            return True
+        with mock.patch.object(Game, '_is_abandoned', new_callable = mock.PropertyMock, side_effect = move_first):
+            Game.abandon_stale()
+        game.refresh_from_db()
+        self.assertEqual((game.status, game.moves), (Game.Status.RUNNING.value, '34'))
+        self.assertEqual(Player.objects.get(pk = self.player2.pk).abandoned, 0)
+
+
+class TrainLearningTests(GameTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'stats.bin')
+
+    def train(self):
+        output = io.StringIO()
+        call_command('train_learning', output = self.path, stdout = output)
+        return output.getvalue()
+
+    def games_through(self, moves):
+        stats = learning.PatternStats(self.path)
+        self.addCleanup(stats.close)
+        return stats.lookup(engine.Position(moves))[0]
+
+    def test_second_run_trains_new_games(self):
+        first = self.play_game([0, 1, 0, 1, 0, 1, 0])
+        self.assertIn('Trained 1 games', self.train())
+        self.assertIn('No new games', self.train())
+        self.play_game([0, 1, 0, 1, 0, 1, 0])
+        self.assertIn('Trained 1 games', self.train())
+        self.assertEqual(self.games_through([0]), 2)
+        # a game whose last move committed after the later games were trained
+        late = self.play_game([0, 1, 0, 1, 0, 1, 0])
+        Game.objects.filter(pk = late.pk).update(last_move_date = first.last_move_date)
+        self.assertIn('Trained 1 games', self.train())
+        self.assertIn('No new games', self.train())
+        self.assertEqual(self.games_through([0]), 3)
+
+
+class PlayMessageTests(GameTestCase):
+
+    def test_join_has_no_move(self):
+        message = PlayConsumer.play_message(self.play_game([]))
+        self.assertEqual((message['type'], message['ply'], message['status']), ('play.update', 0, Game.Status.RUNNING.value))
+        self.assertEqual((message['next_player'], message['next_move'], message['move'], message['winners']),
+                         (1, 'One', None, []))
+
+    def test_move(self):
+        message = PlayConsumer.play_message(self.play_game([3, 4]))
+        self.assertEqual((message['ply'], message['next_player'], message['next_move']), (2, 1, 'One'))
+        self.assertEqual(message['move'], {'column' : 4, 'row' : 0, 'player' : 2, 'name' : 'Two',
+            'color' : '#FF0000', 'description' : 'Two column 5, for row 6'})
+
+    def test_winning_move(self):
+        game = self.play_game([0, 1, 0, 1, 0, 1, 0])
+        message = PlayConsumer.play_message(game)
+        self.assertEqual((message['status'], message['next_player'], message['next_move']),
+                         (Game.Status.FINISHED.value, None, None))
+        self.assertEqual(message['move']['description'], 'One column 1, for row 3, To Win!')
+        self.assertEqual(message['winners'], [(0, 0), (1, 0), (2, 0), (3, 0)])
+
+
+class GameSnapshotTests(GameTestCase):
+
+    def test_derived_properties_are_memoized(self):
+        game = self.play_game([3, 3, 4])
+        # game, user players with their users, then coins
+        with self.assertNumQueries(3):
+            snapshot = GameSnapshot.load(game.pk)
+            for _ in range(2):
+                self.assertEqual(snapshot.next_move, self.player2)
+                self.assertEqual(snapshot.next_move_user, self.user2)
+                self.assertEqual(snapshot.player1_user, self.user1)
+                self.assertEqual(snapshot.player1_name, 'One')
+                self.assertEqual(snapshot.col_full, [False] * Game.COLS)
+                self.assertEqual(snapshot.board[0][3][0], 1)
+                self.assertEqual(snapshot.last_move.column, 4)
+                self.assertIsNone(snapshot.winner_name)
+
+    def test_board_render_queries(self):
+        game = self.play_game([])
+        self.client.login(username = 'player1', password = 'password1')
+        # session, user, game, players, coins
+        with self.assertNumQueries(5):
+            response = self.client.get('/connect4/rester/game_board/%d/' % game.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['is_user_move'])
+
+    def test_board_render_queries_with_moves(self):
+        # player1 wins down the first column, on the last move
+        game = self.play_game([0, 1, 0, 1, 0, 1, 0])
+        self.client.login(username = 'player1', password = 'password1')
+        # the same queries as an empty board, the moves list comes from the coins
+        with self.assertNumQueries(5):
+            response = self.client.get('/connect4/rester/game_board/%d/' % game.pk)
+        moves = response.context['game'].move_list
+        self.assertEqual(len(moves), 7)
+        self.assertEqual(moves[0], 'One column 1, for row 6')
+        self.assertEqual(moves[-1], 'One column 1, for row 3, To Win!')
+        self.assertEqual([str(coin) for coin in game.coin_set.order_by('ply')], moves)
+
+
+class GamesListTests(GameTestCase):
+
+    def setUp(self):
+        super().setUp()
+        computer = ComputerPlayer.objects.create(name = 'Robot', strategy = 1)
+        for _ in range(3):
+            Game.objects.create(player1 = self.player1)
+            Game.objects.create(player1 = computer)
+            Game.objects.create(player1 = computer).join_up(self.player2)
+            # player1 wins down the first column
+            self.play_game([0, 1, 0, 1, 0, 1, 0])
+
+    def get_list(self, list_id, queries):
+        ''' gets the list page, in the number of queries, returns the listed games '''
+        with self.assertNumQueries(queries):
+            response = self.client.get('/connect4/%s/' % list_id)
+        self.assertEqual(response.status_code, 200)
+        return response.context['games']
+
+    def test_list_queries_are_bounded(self):
+        # games, user players with their users, computer players
+        self.assertEqual(len(self.get_list('available_games', 3)), 6)
+        self.assertEqual(len(self.get_list('running_games', 3)), 3)
+        self.client.login(username = 'player1', password = 'password1')
+        # session, user, games, user players with their users
+        games = self.get_list('user_games', 4)
+        self.assertEqual(len(games), 3)
+        self.assertIn('One wins vs Two', str(games[0]))
+
+    def test_list_order(self):
+        self.assertEqual([game.pk for game in self.get_list('available_games', 3)],
+                         list(Game.objects.filter(status = Game.Status.AVAILABLE.value).order_by('pk')
+                              .values_list('pk', flat = True)))
+        running = self.get_list('running_games', 3)
+        self.assertEqual([game.pk for game in running], sorted((game.pk for game in running), reverse = True))
+
+
+class TournamentTests(SimpleTestCase):
+    # ComputerPlayer strategy numbers
+    (RANDOM, SMART) = (1, 3)
+
+    def test_elo_even_results(self):
+        self.assertEqual(tournament.elo([(self.RANDOM, self.SMART, 0.5)]), {self.RANDOM : 1500, self.SMART : 1500})
+        self.assertEqual(tournament.elo([(self.RANDOM, self.SMART, 1), (self.RANDOM, self.SMART, 0)]),
+                         {self.RANDOM : 1500, self.SMART : 1500})
+
+    def test_elo_one_sided_results(self):
+        # winning everything has no finite rating, the iterations hold it, however many games
+        ratings = tournament.elo([(self.SMART, self.RANDOM, 1)] * 4)
+        self.assertAlmostEqual(ratings[self.SMART], 1870.36, places = 2)
+        self.assertAlmostEqual(ratings[self.SMART] + ratings[self.RANDOM], 3000)
+        self.assertAlmostEqual(tournament.elo([(self.SMART, self.RANDOM, 1)] * 40)[self.SMART], ratings[self.SMART])
+
+    def test_percentile_edges(self):
+        self.assertEqual(tournament.percentile([], 0.99), 0.0)
+        self.assertEqual(tournament.percentile([3, 1, 2, 4], 0), 1)
+        self.assertEqual(tournament.percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(tournament.percentile([3, 1, 2, 4], 1), 4)
+
+    def test_matches_swap_colors(self):
+        found = tournament.matches([1, 2, 3], 2, 4, 0.1, random.Random(1))
+        self.assertEqual(len(found), 12)
+        for ((first, second, opening, budget), swapped) in zip(found[::2], found[1::2]):
+            self.assertEqual(swapped, (second, first, opening, budget))
+            self.assertEqual(len(opening), 4)
+            self.assertFalse(engine.Position(opening[:-1]).is_winning_move(opening[-1]))
+        self.assertEqual({(first, second) for (first, second, _, _) in found},
+                         {(1, 2), (2, 1), (1, 3), (3, 1), (2, 3), (3, 2)})
+
+    def test_play_game_takes_the_win(self):
+        (winner, ply, think_times) = tournament.play_game((self.SMART, self.RANDOM, [0, 1, 0, 1, 0, 1], 0.1))
+        self.assertEqual((winner, ply, [len(times) for times in think_times]), (1, 7, [1, 0]))
+        (winner, ply, think_times) = tournament.play_game((self.RANDOM, self.SMART, [0, 1, 0, 1, 0, 1, 2], 0.1))
+        self.assertEqual((winner, ply, [len(times) for times in think_times]), (2, 8, [0, 1]))
+
+
+class BenchmarkTests(TestCase):
+
+    def test_baselines_cover_benchmarks(self):
+        self.assertEqual(sorted(benchmark.load_baselines()), sorted(benchmark.BENCHMARKS))
+
+    @unittest.skipUnless(os.environ.get('CONNECT4_BENCHMARK'), 'set CONNECT4_BENCHMARK to run the benchmarks')
+    def test_no_regressions(self):
+        results = benchmark.run()
+        self.assertEqual(benchmark.regressions(results, benchmark.load_baselines()), [])
+
+
+class RelayConsumer():
+    ''' stands in for a consumer, keeping the messages dispatched to it '''
+
+    def __init__(self, broken = False):
+        self.messages = []
+        self.broken = broken
+
+    async def dispatch(self, message):
+        if self.broken:
+            raise RuntimeError('socket closed')
+        self.messages.append(message)
+
+
+class GroupRelayTests(SimpleTestCase):
+    GROUP = 'connect4.availablegames'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.layer = InMemoryChannelLayer()
+        self.relay = relay.GroupRelay(self.layer)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def relayed(self, consumers, count):
+        ''' waits until each consumer has count messages '''
+        for _ in range(100):
+            if all(len(consumer.messages) >= count for consumer in consumers):
+                return
+            await asyncio.sleep(0.01)
+
+    def test_group_joined_once_and_fanned_out(self):
+        consumers = [RelayConsumer() for _ in range(3)]
+
+        async def run():
+            for consumer in consumers:
+                await self.relay.add(self.GROUP, consumer)
+            self.assertEqual(len(self.layer.groups[self.GROUP]), 1)
+            await self.layer.group_send(self.GROUP, {'type' : 'games.update', 'version' : 1})
+            await self.relayed(consumers, 1)
+            for consumer in consumers:
+                await self.relay.discard(self.GROUP, consumer)
+        self.run_async(run())
+        for consumer in consumers:
+            self.assertEqual(consumer.messages, [{'type' : 'games.update', 'version' : 1}])
+
+    def test_last_consumer_leaves_group(self):
+        (first, second) = (RelayConsumer(), RelayConsumer())
+
+        async def run():
+            await self.relay.add(self.GROUP, first)
+            await self.relay.add(self.GROUP, second)
+            await self.relay.discard(self.GROUP, first)
+            await self.layer.group_send(self.GROUP, {'type' : 'games.update', 'version' : 1})
+            await self.relayed([second], 1)
+            await self.relay.discard(self.GROUP, second)
+            self.assertFalse(self.layer.groups.get(self.GROUP))
+            await self.layer.group_send(self.GROUP, {'type' : 'games.update', 'version' : 2})
+            await asyncio.sleep(0.05)
+        self.run_async(run())
+        self.assertEqual(first.messages, [])
+        self.assertEqual(second.messages, [{'type' : 'games.update', 'version' : 1}])
+        self.assertEqual(self.relay.consumers(self.GROUP), set())
+
+    def test_broken_consumer_does_not_stop_others(self):
+        (broken, working) = (RelayConsumer(broken = True), RelayConsumer())
+
+        async def run():
+            await self.relay.add(self.GROUP, broken)
+            await self.relay.add(self.GROUP, working)
+            for version in (1, 2):
+                await self.layer.group_send(self.GROUP, {'type' : 'games.update', 'version' : version})
+            await self.relayed([working], 2)
+            await self.relay.discard(self.GROUP, broken)
+            await self.relay.discard(self.GROUP, working)
+        with self.assertLogs(relay.logger, 'ERROR'):
+            self.run_async(run())
+        self.assertEqual([message['version'] for message in working.messages], [1, 2])
+
+    @override_settings(CONNECT4_LOBBY_RELAY = False)
+    def test_relay_is_opt_in(self):
+        self.assertIsNone(relay.lobby_relay())
+
+
+class HashRingTests(SimpleTestCase):
+    SHARDS = ['game-player.%d' % shard for shard in range(4)]
+
+    def test_games_spread_over_shards(self):
+        ring = sharding.HashRing(self.SHARDS)
+        owners = [ring.shard(game_id) for game_id in range(4000)]
+        for shard in self.SHARDS:
+            self.assertGreater(owners.count(shard), 500)
+
+    def test_removing_a_shard_only_moves_its_games(self):
+        (ring, smaller) = (sharding.HashRing(self.SHARDS), sharding.HashRing(self.SHARDS[:-1]))
+        for game_id in range(4000):
+            if ring.shard(game_id) != self.SHARDS[-1]:
+                self.assertEqual(ring.shard(game_id), smaller.shard(game_id))
+
+
+class JobSchedulerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.ran = []
+
+    async def handler(self, key):
+        self.ran.append(key)
+
+    def test_jobs_run_in_due_order_once_per_key(self):
+        async def run():
+            scheduler = JobScheduler(self.handler)
+            # each join gets its own game, not the last one scheduled
+            for (game_id, delay) in ((1, 0.03), (2, 0.01), (3, 0.02)):
+                self.assertTrue(scheduler.schedule(('join', game_id), delay))
+            self.assertFalse(scheduler.schedule(('join', 1), 0))
+            self.assertEqual(len(scheduler), 3)
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(scheduler), 0)
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.ran, [('join', 2), ('join', 3), ('join', 1)])
+
+    def test_cancelled_and_earlier_jobs(self):
+        async def run():
+            scheduler = JobScheduler(self.handler)
+            scheduler.schedule(('join', 1), 0.05)
+            scheduler.schedule(('join', 2), 0.05)
+            scheduler.cancel(('join', 2))
+            self.assertNotIn(('join', 2), scheduler)
+            # an earlier job wakes the runner sleeping until the later one
+            scheduler.schedule(('seed',), 0.01)
+            await asyncio.sleep(0.1)
+            # a cancelled key can be scheduled again
+            self.assertTrue(scheduler.schedule(('join', 2), 0))
+            await asyncio.sleep(0.02)
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.ran, [('seed',), ('join', 1), ('join', 2)])
+
+
+class PonderTests(SimpleTestCase):
+    # ComputerPlayer strategy number of SmartStrategy
+    SMART = 3
+
+    def setUp(self):
+        patcher = mock.patch.multiple(strategies.SmartStrategy, TIME_BUDGET = None, NODE_BUDGET = 2000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(strategies.set_stop_event, None)
+
+    def test_ponders_each_reply(self):
+        strategies.set_stop_event(threading.Event())
+        pondered = strategies.ponder(self.SMART, '3344')
+        self.assertEqual(sorted(pondered), ['3344%d' % column for column in range(engine.COLS)])
+        for (moves, column) in pondered.items():
+            self.assertTrue(engine.Position(int(played) for played in moves).can_play(column))
+
+    def test_stop_event_stops_pondering(self):
+        stop = threading.Event()
+        stop.set()
+        strategies.set_stop_event(stop)
+        self.assertEqual(strategies.ponder(self.SMART, '3344'), {})
+
+
+def monte_carlo_reused():
+    ''' returns the playouts reused by the last Monte Carlo search in the process, run in the think lanes '''
+    return strategies.monte_carlo_search().reused
+
+
+class ThinkLaneTests(SimpleTestCase):
+    # ComputerPlayer strategy number of MonteCarloStrategy
+    MONTE_CARLO = 5
+
+    def setUp(self):
+        # the lanes fork with the budget patched
+        for patcher in (mock.patch.object(GamePlayerConsumer, 'THINK_PROCESSES', 2),
+                        mock.patch.object(GamePlayerConsumer, '_lanes', None),
+                        mock.patch.object(strategies.MonteCarloStrategy, 'TIME_BUDGET', 0.1)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.lanes = GamePlayerConsumer.lanes()
+        for (executor, _) in self.lanes:
+            self.addCleanup(executor.shutdown)
+
+    def test_games_spread_over_lanes(self):
+        self.assertEqual(len(self.lanes), 2)
+        self.assertEqual({GamePlayerConsumer.lane(game_id) for game_id in range(10)}, {0, 1})
+
+    def test_second_move_reuses_tree(self):
+        game_id = 7
+        lane = GamePlayerConsumer.lane(game_id)
+        (executor, _) = self.lanes[lane]
+        column = executor.submit(strategies.think, self.MONTE_CARLO, '33').result()
+        moves = '33%d3' % column
+        executor.submit(strategies.think, self.MONTE_CARLO, moves).result()
+        self.assertGreater(executor.submit(monte_carlo_reused).result(), 0)
+        # another process starts the tree again
+        (other, _) = self.lanes[1 - lane]
+        other.submit(strategies.think, self.MONTE_CARLO, moves).result()
+        self.assertEqual(other.submit(monte_carlo_reused).result(), 0)
+
+    def test_dropping_pondering_game_stops_lane(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        consumer = GamePlayerConsumer({'type' : 'channel', 'channel' : sharding.SHARD_CHANNEL % 0})
+        consumer.channel_layer = InMemoryChannelLayer()
+        consumer.channel_name = 'game-player.0'
+        (game_id, other_id) = (7, 9)
+        lane = GamePlayerConsumer.lane(game_id)
+        (_, stop) = self.lanes[lane]
+        consumer._lane_ponders[lane] = game_id
+        # another game in the lane isn't pondering, so the lane goes on
+        loop.run_until_complete(consumer._drop_game(other_id))
+        self.assertFalse(stop.is_set())
+        loop.run_until_complete(consumer._drop_game(game_id))
+        self.assertTrue(stop.is_set())
+
+
+class TranspositionTableTests(SimpleTestCase):
+
+    def setUp(self):
+        # one bucket, so every position shares it
+        self.table = TranspositionTable(2)
+        self.addCleanup(self.table.close)
+
+    def position(self, moves):
+        return engine.Position(int(column) for column in moves)
+
+    def test_round_trip(self):
+        position = self.position('334')
+        self.assertIsNone(self.table.probe(position))
+        self.table.store(position, -7, 5, LOWER, 2)
+        self.assertEqual(self.table.probe(position), (-7, 5, LOWER, 2))
+        self.table.store(self.position('3'), 0, 1, EXACT)
+        self.assertEqual(self.table.probe(self.position('3')), (0, 1, EXACT, None))
+
+    def test_mirror_positions_share_an_entry(self):
+        self.table.store(self.position('01'), 3, 4, EXACT, 2)
+        self.assertEqual(self.table.probe(self.position('65')), (3, 4, EXACT, 4))
+
+    def test_torn_write_is_a_miss(self):
+        position = self.position('334')
+        self.table.store(position, 1, 2, EXACT, 3)
+        # another process's write to the key word, without the data word
+        for index in range(0, 4, 2):
+            self.table._words[index] ^= 1
+        self.assertIsNone(self.table.probe(position))
+
+    def test_deeper_entry_kept_while_fresh(self):
+        (deep, shallow, other) = (self.position('3'), self.position('34'), self.position('345'))
+        self.table.store(deep, 1, 10, EXACT, 3)
+        self.table.store(shallow, 2, 2, EXACT, 4)
+        self.assertEqual(self.table.probe(deep)[1], 10)
+        self.assertEqual(self.table.probe(shallow)[1], 2)
+        # the second slot is always replaced
+        self.table.store(other, 3, 2, EXACT, 5)
+        self.assertEqual(self.table.probe(deep)[1], 10)
+        self.assertIsNone(self.table.probe(shallow))
+
+    def test_old_deep_entry_replaced(self):
+        (deep, shallow) = (self.position('3'), self.position('34'))
+        now = 1000000.0
+        with mock.patch('time.time', return_value = now - TranspositionTable.AGE):
+            self.table.store(deep, 1, 10, EXACT, 3)
+        with mock.patch('time.time', return_value = now):
+            self.table.store(shallow, 2, 2, EXACT, 4)
+        self.assertEqual(self.table.probe(shallow)[1], 2)
+        self.assertIsNone(self.table.probe(deep))
+
+
+@override_settings(CONNECT4_PLAYER_SHARDS = 3)
+class ShardLeaseTests(TestCase):
+
+    def setUp(self):
+        self.shards = [GamePlayerConsumer({'type' : 'channel', 'channel' : sharding.SHARD_CHANNEL % shard})
+                       for shard in range(2)]
+        self.computer = ComputerPlayer.objects.create(name = 'Computer', strategy = 1)
+
+    def game(self):
+        return Game.objects.create(player1 = self.computer)
+
+    def expire(self, game):
+        GameLease.objects.filter(game = game).update(expires = timezone.now() - datetime.timedelta(seconds = 1))
+
+    def test_lease_taken_after_expiry(self):
+        (first, second) = self.shards
+        game = self.game()
+        self.assertTrue(first._claim(game.id))
+        self.assertTrue(first._claim(game.id))
+        self.assertFalse(second._claim(game.id))
+        self.expire(game)
+        self.assertTrue(second._claim(game.id))
+        self.assertEqual(GameLease.objects.get(game = game).shard, second.shard)
+
+    def test_renew_drops_games_leased_to_another_shard(self):
+        (first, second) = self.shards
+        (kept, moved) = (self.game(), self.game())
+        for game in (kept, moved):
+            first._claim(game.id)
+        self.expire(moved)
+        second._claim(moved.id)
+        (lost, orphans, _) = first._renew({kept.id, moved.id})
+        self.assertEqual((lost, orphans), ({moved.id}, []))
+        self.assertGreater(GameLease.objects.get(game = kept).expires, timezone.now())
+
+    def test_renew_drops_ended_games(self):
+        first = self.shards[0]
+        game = self.game()
+        first._claim(game.id)
+        Game.objects.filter(pk = game.pk).update(status = Game.Status.FINISHED.value)
+        (lost, orphans, _) = first._renew({game.id})
+        self.assertEqual((lost, orphans), ({game.id}, []))
+        self.assertFalse(GameLease.objects.filter(game = game).exists())
+
+    def test_orphans_taken_by_their_ring_shard_only(self):
+        for shard in self.shards:
+            shard._renew(set())
+        games = [self.game() for _ in range(20)]
+        ring = sharding.HashRing([shard.shard for shard in self.shards])
+        taken = []
+        for shard in self.shards:
+            (_, orphans, _) = shard._renew(set())
+            self.assertEqual(orphans, [game.id for game in games if ring.shard(game.id) == shard.shard])
+            taken += orphans
+        self.assertEqual(sorted(taken), [game.id for game in games])
+
+    def test_first_live_shard_wakes_the_others(self):
+        for shard in self.shards:
+            shard._renew(set())
+        self.assertEqual(self.shards[0]._renew(set())[2], {sharding.SHARD_CHANNEL % 2})
+        self.assertEqual(self.shards[1]._renew(set())[2], set())
+        # the first shard stopped, its heartbeat is too old
+        stopped = timezone.now() - datetime.timedelta(seconds = 2 * GamePlayerConsumer.LEASE)
+        PlayerShard.objects.filter(channel = self.shards[0].shard).update(heartbeat = stopped)
+        self.assertEqual(self.shards[1]._renew(set())[2], {self.shards[0].shard, sharding.SHARD_CHANNEL % 2})
+
+
+class GamesListUpdateTests(SimpleTestCase):
+    GROUP = 'connect4.availablegames'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.layer = InMemoryChannelLayer()
+        self.consumer = GamesListConsumer({'type' : 'channel'})
+        self.consumer.channel_layer = self.layer
+        # lists the worker queries, in turn
+        self.summaries = []
+        patcher = mock.patch.object(lists, 'summaries', side_effect = self.summary)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def summary(self, list_id, user_id):
+        result = self.summaries.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return OrderedDict(result)
+
+    def updates(self, *summaries):
+        ''' sends a change for each summaries, and returns the updates received '''
+        self.summaries.extend(summaries)
+        async def run():
+            channel = await self.layer.new_channel()
+            await self.layer.group_add(self.GROUP, channel)
+            received = []
+            for _ in summaries:
+                await self.consumer.lists_changed({'channel' : self.GROUP, 'list' : lists.AVAILABLE, 'user' : None})
+                await self.consumer._send_updates()
+                while True:
+                    try:
+                        received.append(await asyncio.wait_for(self.layer.receive(channel), 0.01))
+                    except asyncio.TimeoutError:
+                        break
+            return received
+        return self.loop.run_until_complete(run())
+
+    def test_diff(self):
+        old = OrderedDict([(1, 'a'), (2, 'b'), (3, 'c')])
+        new = OrderedDict([(4, 'd'), (3, 'c'), (2, 'B')])
+        self.assertEqual(lists.diff(old, new), ([{'id' : 4, 'text' : 'd'}], [1], [{'id' : 2, 'text' : 'B'}]))
+        self.assertEqual(lists.diff(new, new), ([], [], []))
+
+    def test_updates_are_numbered_diffs(self):
+        received = self.updates(
+            [(1, 'a'), (2, 'b')], [(1, 'a'), (2, 'b')], [(2, 'B'), (3, 'c')], [(3, 'c'), (2, 'B')])
+        # the unchanged list isn't sent, the reordered one is
+        self.assertEqual([update['version'] for update in received], [1, 2, 3])
+        self.assertEqual([update['order'] for update in received], [[1, 2], [2, 3], [3, 2]])
+        self.assertEqual(received[0]['added'], [{'id' : 1, 'text' : 'a'}, {'id' : 2, 'text' : 'b'}])
+        self.assertEqual((received[1]['added'], received[1]['removed'], received[1]['updated']),
+                         ([{'id' : 3, 'text' : 'c'}], [1], [{'id' : 2, 'text' : 'B'}]))
+        self.assertEqual((received[2]['added'], received[2]['removed'], received[2]['updated']), ([], [], []))
+
+    def test_failed_update_is_retried(self):
+        with mock.patch.object(GamesListConsumer, '_schedule_updates') as schedule:
+            received = self.updates([(1, 'a')], RuntimeError('database went away'))
+            # one for each change, and one to try again
+            self.assertEqual(schedule.call_count, 3)
+        self.assertEqual(len(received), 1)
+        self.assertIn(self.GROUP, self.consumer._pending)
+        # the retry sends the difference from the last update sent
+        self.summaries.append(OrderedDict([(2, 'b')]))
+        async def retry():
+            channel = await self.layer.new_channel()
+            await self.layer.group_add(self.GROUP, channel)
+            await self.consumer._send_updates()
+            return await self.layer.receive(channel)
+        update = self.loop.run_until_complete(retry())
+        self.assertEqual((update['version'], update['added'], update['removed']),
+                         (2, [{'id' : 2, 'text' : 'b'}], [1]))
+
+
+@override_settings(CHANNEL_LAYERS = {'default' : {'BACKEND' : 'channels.layers.InMemoryChannelLayer'}},
+                   CONNECT4_LOBBY_RELAY = False)
+class SocketTests(TransactionTestCase):
+    ''' the play and stream sockets, the database work runs in threads so the tests commit '''
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.communicators = []
+        self.addCleanup(lambda : self.loop.run_until_complete(self.disconnect()))
+        self.user1 = User.objects.create_user('player1', password = 'password1', first_name = 'One')
+        self.user2 = User.objects.create_user('player2', password = 'password2', first_name = 'Two')
+        self.game = Game.objects.create(player1 = self.user1.userplayer)
+
+    async def connect(self, path, user):
+        ''' returns a connected communicator for the socket, with the user in the scope like the auth middleware '''
+        router = URLRouter(routing.urlpatterns)
+        communicator = WebsocketCommunicator(lambda scope : router(dict(scope, user = user)), path)
+        (connected, _) = await communicator.connect()
+        self.assertTrue(connected)
+        self.communicators.append(communicator)
+        return communicator
+
+    async def disconnect(self):
+        for communicator in self.communicators:
+            try:
+                await communicator.disconnect()
+            except asyncio.CancelledError:
+                # channels 2.1 catches the concurrent.futures CancelledError, newer Pythons cancel with asyncio's
+                pass
+
+    async def command(self, communicator, content):
+        ''' sends the command, returns the ack and the play updates that came with it '''
+        await communicator.send_json_to(content)
+        messages = [await communicator.receive_json_from()]
+        while not await communicator.receive_nothing(0.05):
+            messages.append(await communicator.receive_json_from())
+        acks = [message for message in messages if message['type'] in ('play.ack', 'stream.ack')]
+        self.assertEqual(len(acks), 1)
+        return (acks[0], [message for message in messages if message['type'] == 'play.update'])
+
+    def test_join_and_move(self):
+        async def run():
+            play = await self.connect('/play/%d/' % self.game.pk, self.user2)
+            (ack, updates) = await self.command(play, {'action' : 'join', 'id' : 1})
+            self.assertEqual((ack['ok'], ack['ply'], ack['id'], ack['game']), (True, 0, 1, self.game.pk))
+            self.assertEqual(updates[0]['next_move'], 'One')
+            player1 = await self.connect('/play/%d/' % self.game.pk, self.user1)
+            (ack, updates) = await self.command(player1, {'action' : 'move', 'column' : 3, 'ply' : 0})
+            self.assertEqual((ack['ok'], ack['ply']), (True, 1))
+            self.assertEqual(updates[0]['move']['column'], 3)
+            # the other player's socket gets the update too
+            update = await play.receive_json_from()
+            self.assertEqual((update['type'], update['ply']), ('play.update', 1))
+        self.loop.run_until_complete(run())
+
+    def test_stale_and_invalid_moves(self):
+        self.game.join_up(self.user2.userplayer)
+        self.game.make_move(self.user1.userplayer, 3)
+        async def run():
+            play = await self.connect('/play/%d/' % self.game.pk, self.user2)
+            (ack, updates) = await self.command(play, {'action' : 'move', 'column' : 3, 'ply' : 0})
+            self.assertEqual((ack['ok'], ack['ply'], updates), (False, 1, []))
+            for content in ({'action' : 'move'}, {'action' : 'move', 'column' : 'x', 'ply' : 1},
+                            {'action' : 'resign'}, [1, 2], 'move', None):
+                (ack, updates) = await self.command(play, content)
+                self.assertEqual((ack['type'], ack['ok'], updates), ('play.ack', False, []))
+        self.loop.run_until_complete(run())
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.ply, 1)
+
+    def test_unauthenticated_join(self):
+        async def run():
+            play = await self.connect('/play/%d/' % self.game.pk, AnonymousUser())
+            (ack, updates) = await self.command(play, {'action' : 'join'})
+            self.assertEqual((ack['ok'], updates), (False, []))
+        self.loop.run_until_complete(run())
+        self.game.refresh_from_db()
+        self.assertIsNone(self.game.player2_id)
+
+    def test_stream_subscribe_and_commands(self):
+        async def run():
+            stream = await self.connect('/stream/', self.user2)
+            subscribe = {'action' : 'subscribe', 'stream' : 'game', 'game' : self.game.pk}
+            for _ in range(2):
+                (ack, _) = await self.command(stream, subscribe)
+                self.assertTrue(ack['ok'])
+            # subscribed once, so the join's update comes once
+            (ack, updates) = await self.command(stream, {'action' : 'join', 'game' : self.game.pk})
+            self.assertEqual((ack['type'], ack['ok'], len(updates)), ('play.ack', True, 1))
+            (ack, _) = await self.command(stream, dict(subscribe, action = 'unsubscribe'))
+            self.assertTrue(ack['ok'])
+            # player 1's move, not player 2's, and the update isn't sent after unsubscribing
+            (ack, updates) = await self.command(stream, {'action' : 'move', 'game' : self.game.pk, 'column' : 3})
+            self.assertEqual((ack['ok'], updates), (False, []))
+            for content in ({'action' : 'subscribe', 'stream' : 'nothing'}, {'action' : 'subscribe', 'stream' : 'game'},
+                            ['subscribe'], 7):
+                (ack, _) = await self.command(stream, content)
+                self.assertEqual((ack['type'], ack['ok']), ('stream.ack', False))
+        self.loop.run_until_complete(run())
+
+    def test_stream_game_limit(self):
+        async def run():
+            stream = await self.connect('/stream/', self.user1)
+            for (game_id, ok) in ((1, True), (2, True), (3, False), (1, True)):
+                (ack, _) = await self.command(stream, {'action' : 'subscribe', 'stream' : 'game', 'game' : game_id})
+                self.assertEqual(ack['ok'], ok)
+            await self.command(stream, {'action' : 'unsubscribe', 'stream' : 'game', 'game' : 1})
+            (ack, _) = await self.command(stream, {'action' : 'subscribe', 'stream' : 'game', 'game' : 3})
+            self.assertTrue(ack['ok'])
+        with mock.patch.object(StreamConsumer, 'MAX_GAMES', 2):
+            self.loop.run_until_complete(run())
@@ -0,0 +1,88 @@
+''' Headless games between the computer player strategies, for measuring their strength and speed
+
+    Games are played on engine positions only, no models, database or channel layer,
+    so matches can run in any number of worker processes.
+'''
+import math
+import random
+import time
+from . import engine, strategies
+
+
+def play_game(match):
+    ''' plays one game, match is (first strategy, second strategy, opening moves, time budget)
+        strategies are ComputerPlayer strategy numbers, the opening moves are played before the strategies start,
+        returns (winner, moves, think times) where winner is 1, 2 or 0 for a draw,
+        and think times is a list of seconds per move for each strategy
+    '''
+    (first, second, opening, time_budget) = match
+    players = []
+    for strategy in (first, second):
+        player = strategies.strategy_class(strategy)()
+        if time_budget is not None and hasattr(player, 'TIME_BUDGET'):
+            player.TIME_BUDGET = time_budget
+        players.append(player)
+    think_times = ([], [])
+    position = engine.Position(opening)
+    while not position.is_full:
+        player = position.player
+        start = time.perf_counter()
+        column = players[player].choose_column(position.copy())
+        think_times[player].append(time.perf_counter() - start)
+        position.play(column)
+        if position.is_winner(player):
+            return (player + 1, position.ply, think_times)
+    return (0, position.ply, think_times)
+
+
+def random_opening(plies, rng = random):
+    ''' returns a list of random moves, that don't end the game '''
+    position = engine.Position()
+    for _ in range(plies):
+        moves = [col for col in position.legal_moves() if not position.is_winning_move(col)]
+        position.play(rng.choice(moves))
+    return position.history
+
+
+def matches(strategy_numbers, games, opening_plies, time_budget, rng = random):
+    ''' returns the round robin match list for play_game, each pair plays games openings, with both colors '''
+    found = []
+    for _ in range(games):
+        opening = random_opening(opening_plies, rng)
+        for (index, first) in enumerate(strategy_numbers):
+            for second in strategy_numbers[index + 1:]:
+                found.append((first, second, opening, time_budget))
+                found.append((second, first, opening, time_budget))
+    return found
+
+
+def elo(results, iterations = 200):
+    ''' estimates ratings from game results, a list of (strategy, strategy, score for the first)
+        with 1 for a win and 0.5 for a draw; returns strategy: rating, averaging 1500
+    '''
+    players = {player for (first, second, _) in results for player in (first, second)}
+    ratings = {player : 1500.0 for player in players}
+    for _ in range(iterations):
+        expected = {player : 0.0 for player in players}
+        actual = {player : 0.0 for player in players}
+        counts = {player : 0 for player in players}
+        for (first, second, score) in results:
+            chance = 1 / (1 + 10 ** ((ratings[second] - ratings[first]) / 400))
+            expected[first] += chance
+            expected[second] += 1 - chance
+            actual[first] += score
+            actual[second] += 1 - score
+            counts[first] += 1
+            counts[second] += 1
+        for player in players:
+            ratings[player] += 32 * (actual[player] - expected[player]) / counts[player]
+        # keep the average fixed, only the differences mean anything
+        shift = 1500 - sum(ratings.values()) / len(ratings)
+        ratings = {player : rating + shift for (player, rating) in ratings.items()}
+    return ratings
+
+
+def percentile(values, fraction):
+    ''' returns the value at the fraction of the sorted values, nearest rank '''
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] if ordered else 0.0
@@ -0,0 +1,103 @@
+''' Fixed size transposition table for the game searches
+
+    Entries are kept in a flat array of 64 bit words, two words per slot and two slots per bucket,
+    indexed by the position's canonical Zobrist key, so a position and its mirror image share an entry.
+    The first slot keeps the deepest search, unless its entry is older than AGE seconds, and the second
+    slot takes whatever the first doesn't, so a long lived table doesn't fill up with old deep entries.
+    The array can be backed by a memory mapped file, so every worker process on a box shares the
+    same entries.  Slots are written without locks; the stored key is xor'd with the data word,
+    so a slot torn by two processes writing at once just reads as a miss.
+
+    Each data word packs the score, depth, bound flag and best move:
+        bits 0-11 score + SCORE_OFFSET, bits 12-17 depth, bits 18-19 flag, bits 20-23 move + 1,
+        bits 24-31 the age, the time it was stored in AGE seconds, modulo 256
+'''
+import mmap
+import os
+import time
+from . import engine
+
+# bound flags, the score is exact, or a lower or upper bound from an alpha-beta cutoff
+EXACT = 1
+LOWER = 2
+UPPER = 3
+
+SCORE_OFFSET = 2048
+WORD_BYTES = 8
+
+
+class TranspositionTable():
+    ''' fixed size table of searched positions, with depth preferred and always replaced slots '''
+
+    # seconds an entry keeps its depth preferred slot from shallower searches
+    AGE = 60
+
+    def __init__(self, size = 2 ** 20, path = None):
+        ''' size is the number of slots, path is an optional file to memory map and share between processes '''
+        self.size = size
+        self.buckets = max(size // 2, 1)
+        self.path = path
+        length = 4 * self.buckets * WORD_BYTES
+        if path:
+            with open(path, 'a+b') as table_file:
+                if os.fstat(table_file.fileno()).st_size != length:
+                    table_file.truncate(length)
+                self._buffer = mmap.mmap(table_file.fileno(), length)
+        else:
+            self._buffer = bytearray(length)
+        self._words = memoryview(self._buffer).cast('Q')
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+
+    def close(self):
+        ''' releases the table memory, and the file mapping if there is one '''
+        self._words.release()
+        if self.path:
+            self._buffer.close()
+
+    @property
+    def hit_rate(self):
+        ''' fraction of probes in this process that found an entry '''
+        return self.hits / self.probes if self.probes else 0.0
+
+    @property
+    def occupancy(self):
+        ''' fraction of the slots in use, for every process sharing the table; this scans the table '''
+        return sum(1 for index in range(0, 4 * self.buckets, 2) if self._words[index]) / (2 * self.buckets)
+
+    def probe(self, position):
+        ''' returns (score, depth, flag, move) for the position, or None if it isn't in the table
+            move is None if no best move was stored
+        '''
+        self.probes += 1
+        (key, mirrored) = position.canonical_key
+        index = 4 * (key % self.buckets)
+        data = self._words[index + 1]
+        if self._words[index] ^ data != key or not data:
+            data = self._words[index + 3]
+            if self._words[index + 2] ^ data != key or not data:
+                return None
+        self.hits += 1
+        move = (data >> 20 & 0xF) - 1
+        if move >= 0 and mirrored:
+            move = engine.COLS - 1 - move
+        return ((data & 0xFFF) - SCORE_OFFSET, data >> 12 & 0x3F, data >> 18 & 0x3, move if move >= 0 else None)
+
+    def store(self, position, score, depth, flag, move = None):
+        ''' stores a search result, in the bucket's first slot unless it has a deeper search of this age,
+            otherwise in the second slot
+        '''
+        (key, mirrored) = position.canonical_key
+        index = 4 * (key % self.buckets)
+        age = int(time.time() // self.AGE) & 0xFF
+        old_data = self._words[index + 1]
+        if old_data and (old_data >> 12 & 0x3F) > depth and old_data >> 24 == age:
+            index += 2
+        if move is not None and mirrored:
+            move = engine.COLS - 1 - move
+        data = ((score + SCORE_OFFSET) | depth << 12 | flag << 18 | (move + 1 if move is not None else 0) << 20 |
+                age << 24)
+        self._words[index] = key ^ data
+        self._words[index + 1] = data
+        self.stores += 1